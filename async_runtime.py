@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+'''
+An asyncio runtime for the flight controller.
+
+Every sensor in the queue gets its own coroutine that writes a sample
+every sensor.period seconds. The sensor's blocking calls run on its own
+executor thread (see Sensor.awrite()), so while the GPS waits on gpsd or
+the camera records a clip, the ADC channels keep being sampled.
+
+Other jobs (the status message, the LED, the heater) run the same way,
+on their own periods, and are guarded by the supervisor the same way.
+'''
+
+import asyncio
+
+from metrics import registry as metrics
+
+
+async def every(period, job, name=None):
+    #----------------------------------------
+    '''
+    every(seconds, coroutine function, name=None)
+
+    Awaits job() at a fixed rate. If a run takes longer than the period,
+    the missed deadlines are skipped rather than made up. Given a name,
+    each run's lateness goes into the '<name>.lateness' metric and the
+    skipped deadlines into '<name>.overruns'.
+    '''
+    #----------------------------------------
+
+    loop = asyncio.get_event_loop()
+    due = loop.time()
+    while True:
+        if name is not None:
+            metrics.time(name + '.lateness', loop.time() - due)
+        await job()
+        due += period
+        now = loop.time()
+        if due <= now:
+            missed = (now - due) // period + 1
+            due += missed * period
+            if name is not None:
+                metrics.count(name + '.overruns', int(missed))
+        await asyncio.sleep(due - now)
+
+
+def blocking(function, executor=None):
+    #----------------------------------------
+    '''
+    blocking(function, executor=None) -> coroutine function
+
+    Wraps an ordinary function so every() can await it on an executor.
+    '''
+    #----------------------------------------
+
+    async def job():
+        return await asyncio.get_event_loop().run_in_executor(executor, function)
+
+    return job
+
+
+def run(queue, jobs=(), supervisor=None):
+    #----------------------------------------
+    '''
+    run(list of sensors, list of (string, coroutine function, seconds), supervisor=None)
+
+    Samples every sensor in the queue on its own period, and runs the
+    other jobs, until something raises (KeyboardInterrupt included).
+    The sensors must already be started. Given a Supervisor (see
+    supervisor.py), each sensor's writes and each job go through it, so
+    one that raises or hangs does not stop the rest.
+    '''
+    #----------------------------------------
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    tasks = [loop.create_task(every(sensor.period, supervisor.awatch(sensor) if supervisor else sensor.awrite,
+                                    sensor.name)) for sensor in queue]
+    tasks += [loop.create_task(every(period, supervisor.aguard(name, job) if supervisor else job, name))
+              for name, job, period in jobs]
+
+    flight = asyncio.gather(*tasks)
+    try:
+        loop.run_until_complete(flight)
+    finally:
+        #Cancel whatever is left and let it finish cancelling.
+        flight.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        if not flight.cancelled():
+            flight.exception()
+        loop.close()
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+'''
+Reports how many MCP3008 samples per second each transport manages.
+
+    ./bench_adc.py [--seconds 2] [--channel 0] [--sim]
+
+Run it on the Pi with the chip wired to both the bit-bang pins main()
+uses and the SPI pins, or anywhere with --sim to time the Python side
+against the simulated chip.
+'''
+
+import argparse
+from time import perf_counter, process_time
+
+import hardware
+
+
+def bench(transport, channel, seconds):
+    #----------------------------------------
+    '''
+    bench(transport, channel #, seconds) -> (samples/sec, CPU sec/sample)
+
+    Converts the channel over and over for the given time.
+    '''
+    #----------------------------------------
+
+    samples = 0
+    cpu_start = process_time()
+    start = perf_counter()
+    end = start + seconds
+    while perf_counter() < end:
+        transport.convert(channel)
+        samples += 1
+    elapsed = perf_counter() - start
+    cpu = process_time() - cpu_start
+
+    return samples / elapsed, cpu / samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--seconds', type=float, default=2.0)
+    parser.add_argument('--channel', type=int, default=0)
+    parser.add_argument('--sim', action='store_true', help='use the simulated hardware')
+    args = parser.parse_args()
+
+    if args.sim:
+        hardware.set_backend('sim')
+
+    #Imported after the backend is chosen.
+    from fl_objects_2 import BitBangTransport, SpiTransport
+
+    transports = [('bit-bang, 0.1 ms delay', lambda: BitBangTransport(11, 13, 15, 16, clock_delay=0.0001)),
+                  ('bit-bang', lambda: BitBangTransport(11, 13, 15, 16)),
+                  ('spi', lambda: SpiTransport(0, 0))]
+
+    print('%-24s %14s %16s' % ('transport', 'samples/sec', 'CPU usec/sample'))
+    for name, make in transports:
+        try:
+            transport = make()
+        except Exception as error:
+            print('%-24s unavailable: %s' % (name, error))
+            continue
+        rate, cpu = bench(transport, args.channel, args.seconds)
+        transport.close()
+        print('%-24s %14.0f %16.1f' % (name, rate, cpu * 1e6))
+
+
+if __name__ == '__main__':
+    main()
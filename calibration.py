@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+'''
+Calibrations: turning the voltage an MCP3008 channel reads into the
+thing the sensor measures.
+
+    --Linear:       volts * gain + offset
+    --Polynomial:   c0 + c1 * volts + c2 * volts**2 + ...
+    --LookupTable:  straight lines between calibration points
+    --Expression:   the old conversion strings, i.e. '(volts - 1.25) / 0.005'
+
+Each of them works on a single reading or on a whole numpy array of
+them in one call, and each carries a version. describe() gives the
+calibration, its version and a fingerprint of its numbers, which the
+data files record so every reading can be traced to the calibration it
+was made with.
+'''
+
+import ast
+import json
+import zlib
+
+import numpy as np
+
+
+class Calibration(object):
+    #######################################################
+    '''
+    The parts every calibration has. Subclasses set kind and fill in
+    __call__() and _parameters().
+    '''
+    #######################################################
+
+    kind = 'none'
+
+    def __init__(self, units='', version=1):
+        self.units = units
+        self.version = version
+
+    def __call__(self, volts):
+        raise NotImplementedError
+
+    def _parameters(self):
+        return {}
+
+    def inverse(self, values, low=-1.0, high=6.0, points=4097):
+        #----------------------------------------
+        '''
+        inverse(number or array, low=-1.0, high=6.0, points=4097) -> volts
+
+        The voltage that would read as each value, i.e. to play recorded
+        readings back through a simulated ADC. This tabulates the
+        calibration from low to high volts and interpolates, so it
+        assumes the calibration only goes one way over that range.
+        '''
+        #----------------------------------------
+
+        volts = np.linspace(low, high, points)
+        readings = np.asarray(self(volts), dtype=np.float64)
+        order = np.argsort(readings)
+        result = np.interp(values, readings[order], volts[order])
+        return float(result) if np.ndim(result) == 0 else result
+
+    def describe(self):
+        #----------------------------------------
+        '''
+        describe() -> dictionary
+
+        Everything needed to apply the calibration again, plus its
+        version and a fingerprint of the numbers, so two calibrations
+        with the same version but different numbers can be told apart.
+        '''
+        #----------------------------------------
+
+        description = {'type': self.kind, 'units': self.units, 'version': self.version}
+        description.update(self._parameters())
+        fingerprint = zlib.crc32(json.dumps(self._parameters(), sort_keys=True).encode())
+        description['fingerprint'] = '%08x' % fingerprint
+
+        return description
+
+
+class Linear(Calibration):
+    #######################################################
+    '''
+    Linear(float, float, units='', version=1) -> calibration
+
+    volts * gain + offset.
+    '''
+    #######################################################
+
+    kind = 'linear'
+
+    def __init__(self, gain, offset=0.0, units='', version=1):
+        Calibration.__init__(self, units, version)
+        self.gain = gain
+        self.offset = offset
+
+    def __call__(self, volts):
+        return volts * self.gain + self.offset
+
+    def inverse(self, values, *args, **kwargs):
+        return (values - self.offset) / self.gain
+
+    def _parameters(self):
+        return {'gain': self.gain, 'offset': self.offset}
+
+
+class Polynomial(Calibration):
+    #######################################################
+    '''
+    Polynomial(list, units='', version=1) -> calibration
+
+    --coefficients: Lowest power first: [c0, c1, c2] is
+                        c0 + c1 * volts + c2 * volts**2.
+    '''
+    #######################################################
+
+    kind = 'polynomial'
+
+    def __init__(self, coefficients, units='', version=1):
+        Calibration.__init__(self, units, version)
+        self.coefficients = [float(c) for c in coefficients]
+
+    def __call__(self, volts):
+        #Horner's rule, which works the same on numbers and arrays.
+        result = 0.0
+        for c in reversed(self.coefficients):
+            result = result * volts + c
+        return result
+
+    def _parameters(self):
+        return {'coefficients': self.coefficients}
+
+
+class LookupTable(Calibration):
+    #######################################################
+    '''
+    LookupTable(list, list, units='', version=1) -> calibration
+
+    --volts:    The voltages of the calibration points, increasing.
+    --values:   What each of them means.
+
+    Readings in between are interpolated with straight lines. Readings
+    past either end get the value at that end.
+    '''
+    #######################################################
+
+    kind = 'table'
+
+    def __init__(self, volts, values, units='', version=1):
+        Calibration.__init__(self, units, version)
+        if len(volts) != len(values) or len(volts) < 2:
+            raise ValueError('a lookup table needs two or more points, with a value for each')
+        if any(b <= a for a, b in zip(volts, volts[1:])):
+            raise ValueError('lookup table voltages must increase')
+        self.volts = np.array(volts, dtype=np.float64)
+        self.values = np.array(values, dtype=np.float64)
+
+    def __call__(self, volts):
+        result = np.interp(volts, self.volts, self.values)
+        return float(result) if np.ndim(result) == 0 else result
+
+    def _parameters(self):
+        return {'volts': self.volts.tolist(), 'values': self.values.tolist()}
+
+
+class Expression(Calibration):
+    #######################################################
+    '''
+    Expression(string, units='', version=1) -> calibration
+
+    A conversion string in terms of volts, i.e. '(volts - 1.25) / 0.005'.
+    It is checked and compiled once; only arithmetic on volts and plain
+    numbers is allowed.
+    '''
+    #######################################################
+
+    kind = 'expression'
+
+    #Numbers parse as Constant from Python 3.8, and as Num before that.
+    _ALLOWED = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Name, ast.Load,
+                ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow,
+                ast.USub, ast.UAdd, ast.Constant if hasattr(ast, 'Constant') else ast.Num)
+
+    def __init__(self, text, units='', version=1):
+        Calibration.__init__(self, units, version)
+        tree = ast.parse(text, mode='eval')
+        for node in ast.walk(tree):
+            if not isinstance(node, self._ALLOWED):
+                raise ValueError('not allowed in a conversion: ' + type(node).__name__)
+            if isinstance(node, ast.Name) and node.id != 'volts':
+                raise ValueError('a conversion can only use volts, not ' + node.id)
+        self.text = text
+        self._code = compile(tree, '<conversion>', 'eval')
+
+    def __call__(self, volts):
+        result = eval(self._code, {'__builtins__': {}}, {'volts': volts})
+        #A constant expression gives a number even for an array of volts.
+        return result if np.ndim(result) == np.ndim(volts) else np.full(np.shape(volts), result)
+
+    def _parameters(self):
+        return {'expression': self.text}
+
+
+KINDS = {'linear': Linear, 'polynomial': Polynomial, 'table': LookupTable, 'expression': Expression}
+
+
+def make(spec):
+    #----------------------------------------
+    '''
+    make(calibration, string or dictionary) -> calibration
+
+    Takes a calibration as is, a conversion string, or a dictionary like
+    the ones describe() gives (i.e. {'type': 'linear', 'gain': 200,
+    'offset': -250}), and returns a calibration.
+    '''
+    #----------------------------------------
+
+    if isinstance(spec, Calibration):
+        return spec
+    if isinstance(spec, str):
+        return Expression(spec)
+
+    spec = dict(spec)
+    kind = KINDS[spec.pop('type')]
+    spec.pop('fingerprint', None)
+    if kind is Expression:
+        spec['text'] = spec.pop('expression')
+
+    return kind(**spec)
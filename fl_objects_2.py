@@ -1,4 +1,4 @@
-#!/usr/bin/python3.4
+#!/usr/bin/python3
 '''
 This is the flight controller program for a high-altitude balloon.
 The classes contained herein allow for easy interface with various
@@ -8,15 +8,50 @@ Elaine Jeffery
 4 August 2016
 '''
 
-import RPi.GPIO as GPIO
-import picamera
-import parser
-from gps3 import agps3
-from os import system, popen
-from time import time, sleep, asctime
+import functools
+import json
+import os
+import threading
+from collections import deque
+from queue import Queue, Empty, Full
+from time import time, sleep, asctime, monotonic, perf_counter
+
+import numpy as np
+
+#GPIO, the camera and gpsd all come from the hardware backend, which picks
+#RPi.GPIO (in board numbering), picamera and gps3 on the Pi, or the
+#simulator on a dev box. See hardware.py.
+from hardware import GPIO, get_backend
+from logwriter import LogWriter, BinaryLogWriter, SegmentedLogWriter, SegmentedBinaryLogWriter
+import calibration
+from metrics import registry as metrics
+from storage import free_bytes
+
+
+def _timed(method):
+    #----------------------------------------
+    '''
+    _timed(method) -> method
+
+    Wraps a sensor method so every call is timed into the metrics
+    histogram '<sensor name>.<method>', and every exception it raises
+    is counted in '<sensor name>.<method>.errors' (and raised again).
+    '''
+    #----------------------------------------
+
+    @functools.wraps(method)
+    def timed(self, *args, **kwargs):
+        start = perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        except Exception:
+            metrics.count(self.name + '.' + method.__name__ + '.errors')
+            raise
+        finally:
+            metrics.time(self.name + '.' + method.__name__, perf_counter() - start)
+
+    return timed
 
-#All classes defined herein use the board numbering system.
-GPIO.setmode(GPIO.BOARD)
 
 class Sensor(object):
     #######################################################
@@ -35,6 +70,14 @@ class Sensor(object):
     def __init__(self, name='default'):
         print('There is no class defined for', name)
 
+    def __init_subclass__(cls, **kwargs):
+        #Every sensor's start(), get(), write() and stop() are timed and
+        #their errors counted, without each sensor having to do it.
+        super().__init_subclass__(**kwargs)
+        for name in ('start', 'get', 'write', 'stop'):
+            if name in cls.__dict__:
+                setattr(cls, name, _timed(cls.__dict__[name]))
+
     def _name_file(self):
         #----------------------------------------
         '''
@@ -52,6 +95,130 @@ class Sensor(object):
         return file_name
 
 
+    #How the data file is batched and synced. Set this on a sensor to
+    #override logwriter.DEFAULT_POLICY, i.e. {'flush_records': 1}.
+    log_policy = {}
+
+    #'text' for the usual comma-delimited file, or 'binary' for packed
+    #records (see records.py). record_kind says which record layout to use.
+    log_format = 'text'
+    record_kind = None
+
+    #None for one data file, or the options for a SegmentedLogWriter, i.e.
+    #{'compression': 'zlib', 'segment_bytes': 2**20, 'segment_seconds': 600}
+    #({} for the defaults).
+    log_segments = None
+
+    #A journal.Journal that every record also goes into, so the data survive
+    #the power being cut. main() sets this for every sensor at once.
+    journal = None
+
+    #False when something else writes this sensor's data file, i.e. a
+    #worker process sampling it for the process that logs it (workers.py).
+    logging = True
+
+    def _log_header(self):
+        #----------------------------------------
+        '''
+        _log_header() -> dictionary
+
+        Anything the data file should record about how the data were
+        taken (i.e. the calibration). Written at the start of the file.
+        '''
+        #----------------------------------------
+
+        return {}
+
+
+    def _open_log(self):
+        #----------------------------------------
+        '''
+        _open_log() -> LogWriter
+
+        Opens the data file, which stays open until _close_log().
+        '''
+        #----------------------------------------
+
+        if not self.logging:
+            self.log = None
+            return None
+
+        self.file_name = self._name_file()
+        options = dict(self.log_policy)
+        if self.log_segments is not None:
+            options.update(self.log_segments)
+        if self.log_format == 'binary':
+            self.file_name = self.file_name[:-len('.txt')] + '.bin'
+            writer = BinaryLogWriter if self.log_segments is None else SegmentedBinaryLogWriter
+            self.log = writer(self.file_name, self.name, self.record_kind,
+                              header=self._log_header(), **options)
+        else:
+            writer = LogWriter if self.log_segments is None else SegmentedLogWriter
+            self.log = writer(self.file_name, header=self._log_header(), **options)
+        if self.journal is not None:
+            self.journal.header(self.name, self._log_header())
+            self.log.journal, self.log.journal_name = self.journal, self.name
+        self.log.open()
+
+        return self.log
+
+
+    def _close_log(self):
+        #----------------------------------------
+        '''
+        _close_log()
+
+        Writes out anything still held in memory and closes the data file.
+        '''
+        #----------------------------------------
+
+        if getattr(self, 'log', None) is not None:
+            self.log.close()
+
+
+    #How often the flight loop samples this sensor (seconds), and which
+    #sensor goes first when two are due at once (higher first).
+    period = 1.0
+    priority = 0
+
+    #How long (seconds) a call to this sensor may take before the supervisor
+    #gives up on it, or None for the supervisor's own (see supervisor.py).
+    deadline = None
+
+    #(time, reading) of the last sample the loop took, for everything else
+    #that wants the reading (the heater, the radio, the console). Reading it
+    #never goes to the hardware, so the sensor is read once per sample,
+    #however many things look at it. None until the first sample.
+    latest = None
+
+    #Only every decimation-th sample is kept. The storage governor raises
+    #this when the card is filling up too fast (see storage.py).
+    decimation = 1
+
+    def _keep(self):
+        #----------------------------------------
+        '''
+        _keep() -> boolean
+
+        Counts a sample and says whether it is one to keep.
+        '''
+        #----------------------------------------
+
+        self._samples = getattr(self, '_samples', 0) + 1
+        return self._samples % self.decimation == 0
+
+    def _cache(self, timestamp, fields):
+        #----------------------------------------
+        '''
+        _cache(float, list)
+
+        Keeps a sample, as it is logged, as self.latest. Subclasses keep
+        it in whatever shape their readers want.
+        '''
+        #----------------------------------------
+
+        self.latest = (timestamp, fields)
+
     def start(self):
         print('Method not defined for this subclass.')
 
@@ -74,31 +241,53 @@ class Sensor(object):
         print('Method not defined for this subclass.')
 
 
-class MCP3008(Sensor):
+    #The asyncio versions. Each runs the ordinary method on the sensor's
+    #own executor thread, so a sensor that blocks (the GPS waiting on gpsd,
+    #the camera recording) does not hold up the others. One thread per
+    #sensor keeps each sensor's own calls in order. asyncio and the thread pools
+    #are only imported by the asyncio runtime, so the others start sooner.
+
+    def _executor(self):
+        if getattr(self, '_pool', None) is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._pool = ThreadPoolExecutor(max_workers=1)
+        return self._pool
+
+    async def _offload(self, method):
+        import asyncio
+        return await asyncio.get_event_loop().run_in_executor(self._executor(), method)
+
+    async def astart(self):
+        return await self._offload(self.start)
+
+    async def aget(self):
+        return await self._offload(self.get)
+
+    async def awrite(self):
+        return await self._offload(self.write)
+
+    async def astop(self):
+        return await self._offload(self.stop)
+
+
+class BitBangTransport(object):
     #######################################################
     '''
-    MCP3008(string, float, channel #, channel #, channel #, channel #, 3-element list, string) -> sensor object
+    BitBangTransport(channel #, channel #, channel #, channel #, clock_delay=0) -> transport object
 
-    --Name:     The sensor name that will appear in the title of the data file.
-    --Vref:     The voltage applied to the reference pin of the MCP3008.
-    --Channels: The GPIO pins that will be connected to the I/O pins of the MCP3008.
-    --Pin:      The channel you want to read the sensor from in the form of a
-                    list, i.e. [0,1,0] is channel 2.
-    --conv:     The formula used to convert voltage to the measured units,
-                    i.e. '(volts - 1.25) // 0.005'
+    --Channels:     The GPIO pins connected to CLK, Dout, Din and CS of the chip.
+    --clock_delay:  Seconds to wait after each clock. The chip is fine with
+                        none at all; it is there for long or noisy wiring.
+                        Even 0.0001 makes a conversion about 4.5 ms, so 16x
+                        oversampling of four channels holds the loop up for
+                        over 200 ms, and a 20 Hz sensor cannot keep up.
 
-    Several of my sensors produce some kind of analog output, so I decided that
-    having this class would make the code look nicer. If you have questions
-    about the IC, refer to the datasheet.
+    Talks to an MCP3008 by toggling ordinary GPIO pins. This works on any
+    pins, but it is slow. Use SpiTransport if the chip is on the SPI pins.
     '''
-    ########################################################
-
-    def __init__(self, name, Vref, CLK, Dout, Din, CS, pin, conv):
+    #######################################################
 
-        #self.pin will correspond to the ADC pins of each temp sensor.
-        self.name = name
-        self.pin = pin
-        self.Vref = Vref
+    def __init__(self, CLK, Dout, Din, CS, clock_delay=0):
 
         #These are the same pin names used in the MCP3008 datasheet.
         self.CLK = CLK
@@ -110,10 +299,7 @@ class MCP3008(Sensor):
         self.CS = CS
         GPIO.setup(self.CS, GPIO.OUT)
 
-        #"conv" is a string that you want to run as code. This line
-        #compiles the string into code that can later be run by
-        #calling "eval(conv)".
-        self.conv = parser.expr(conv).compile()
+        self.clock_delay = clock_delay
 
 
     def _clk(self):
@@ -131,16 +317,17 @@ class MCP3008(Sensor):
 
         GPIO.output(self.CLK, True)
         GPIO.output(self.CLK, False)
-        sleep(0.0001)
+        if self.clock_delay:
+            sleep(self.clock_delay)
 
 
-    def _read_chip(self):
+    def convert(self, channel):
         #----------------------------------------
         '''
-        _read_chip() -> floating point number
+        convert(integer) -> integer
 
-        Talks serial to the ADC chip MCP3008 and returns
-        the voltage applied to the specified pin.
+        Talks serial to the ADC chip MCP3008 and returns the 10-bit
+        code for the voltage applied to the channel (0-7).
         '''
         #----------------------------------------
 
@@ -148,64 +335,408 @@ class MCP3008(Sensor):
         #and self.Din high will constitute a start bit."
         GPIO.output(self.CS, False)
         GPIO.output(self.Din, True)
-        sleep(0.0002)
+        if self.clock_delay:
+            sleep(2 * self.clock_delay)
         self._clk()
 
         #The next four input bits tell the chip how to measure the
         #analog input voltage. The first determines single/diff,
         #and the next three tell which pin/pins to read from.
-        command = [1] #1 => single-ended. pin number to follow.
-        for i in self.pin:
-            command.append(i) #add the pin address to the command
+        command = 0b1000 | channel #1 => single-ended. pin number to follow.
 
-        #now read in the command
-        for bit in command:
-            GPIO.output(self.Din, bit) #set the input
+        #now read in the command, MSB first
+        for shift in (3, 2, 1, 0):
+            GPIO.output(self.Din, (command >> shift) & 1) #set the input
             self._clk() #clock that pupper in
 
         #". . . One more clock is required to complete the sample and hold period."
         self._clk()
 
-        #clear the binary buffer
-        binary = ''
         #The next 10 clocks will output the result of the conversion with MSB first . . . "
+        #Each bit is shifted in at the bottom of the code.
+        code = 0
         for bit in range(10):
             self._clk()
-            if GPIO.input(self.Dout) == True:
-                binary = binary + '1'
-            else:
-                binary = binary + '0'
+            code = (code << 1) | (1 if GPIO.input(self.Dout) else 0)
 
         #turn the chip off
         GPIO.output(self.CS, True)
 
-        #int converts the binary to a decimal. 1023 is the max decimal from the ADC.
-        ratio = int(binary, 2) / 1023
+        return code
+
+
+    def close(self):
+        pass
+
+
+class SpiTransport(object):
+    #######################################################
+    '''
+    SpiTransport(port=0, device=0, speed_hz=1000000) -> transport object
+
+    --port:     The SPI port, 0 on the header.
+    --device:   The chip select, 0 for CE0 (pin 24) or 1 for CE1 (pin 26).
+    --speed_hz: The SPI clock. The MCP3008 handles 1.35 MHz at 2.7 V
+                    and 3.6 MHz at 5 V.
+
+    Talks to an MCP3008 on the Pi's hardware SPI pins (SCLK 23, MISO 21,
+    MOSI 19) through spidev. One conversion is a single three-byte
+    transfer, so it is much faster than bit-banging and costs almost no
+    CPU.
+    '''
+    #######################################################
+
+    def __init__(self, port=0, device=0, speed_hz=1000000):
+        self.port = port
+        self.device = device
+        self.spi = get_backend().spidev()
+        self.spi.open(port, device)
+        self.spi.max_speed_hz = speed_hz
+        self.spi.mode = 0
+
+
+    def convert(self, channel):
+        #----------------------------------------
+        '''
+        convert(integer) -> integer
+
+        Returns the 10-bit code for the voltage applied to the channel.
+        '''
+        #----------------------------------------
+
+        #Start bit in the first byte, single-ended and the channel in the
+        #top of the second. The code comes back in the last ten bits.
+        reply = self.spi.xfer2([1, (8 | channel) << 4, 0])
+
+        return ((reply[1] & 3) << 8) | reply[2]
+
+
+    def close(self):
+        self.spi.close()
+
+
+class MCP3008Bus(object):
+    #######################################################
+    '''
+    MCP3008Bus(transport object) -> bus object
+
+    --transport: A BitBangTransport or SpiTransport for the chip.
+
+    All the MCP3008 sensors wired to one chip share one of these (see
+    shared() and spi()). Instead of each sensor doing its own conversation
+    with the chip whenever it gets around to it, scan() reads every
+    channel in use in one back-to-back pass and holds the codes until each
+    sensor takes its own. That way all the channels are sampled at nearly
+    the same moment, and the bus is not left idle between them.
+    '''
+    #######################################################
+
+    #One bus per set of pins.
+    _buses = {}
+
+    def __init__(self, transport, max_age=1.0):
+        self.transport = transport
+
+        #A scanned code older than max_age seconds is not handed out.
+        self.max_age = max_age
+        self.sensors = []
+        self.scan_time = 0
+        self.scans = 0
+        self._pending = {}
+
+        #A burst (see MCP3008.burst()) talks to the chip from its own thread,
+        #so one conversation has to finish before the next starts.
+        self._lock = threading.Lock()
+
+
+    @classmethod
+    def shared(cls, CLK, Dout, Din, CS, clock_delay=0):
+        #----------------------------------------
+        '''
+        shared(CLK, Dout, Din, CS, clock_delay=0) -> bus object
+
+        Returns the bit-banged bus already set up on these pins, or
+        makes one (see BitBangTransport for clock_delay).
+        '''
+        #----------------------------------------
+
+        key = (CLK, Dout, Din, CS)
+        if key not in cls._buses:
+            cls._buses[key] = cls(BitBangTransport(CLK, Dout, Din, CS, clock_delay))
+
+        return cls._buses[key]
+
+
+    @classmethod
+    def spi(cls, port=0, device=0, speed_hz=1000000):
+        #----------------------------------------
+        '''
+        spi(port, device) -> bus object
+
+        Returns the hardware SPI bus already set up for this chip select,
+        or makes one.
+        '''
+        #----------------------------------------
+
+        key = ('spi', port, device)
+        if key not in cls._buses:
+            cls._buses[key] = cls(SpiTransport(port, device, speed_hz))
+
+        return cls._buses[key]
+
+
+    def add(self, sensor):
+        #----------------------------------------
+        '''
+        add(MCP3008)
+
+        Puts a sensor on the list of channels to scan.
+        '''
+        #----------------------------------------
+
+        if sensor not in self.sensors:
+            self.sensors.append(sensor)
+
+
+    def read(self, pin):
+        #----------------------------------------
+        '''
+        read(3-element list) -> integer
+
+        Does one conversion on the specified pin and returns the code.
+        '''
+        #----------------------------------------
+
+        with self._lock:
+            return self.transport.convert((pin[0] << 2) | (pin[1] << 1) | pin[2])
+
+
+    def read_many(self, pin, out):
+        #----------------------------------------
+        '''
+        read_many(3-element list, array) -> array
+
+        Fills the array with back-to-back conversions of the specified
+        pin and returns it.
+        '''
+        #----------------------------------------
+
+        convert = self.transport.convert
+        channel = (pin[0] << 2) | (pin[1] << 1) | pin[2]
+        with self._lock:
+            for i in range(len(out)):
+                out[i] = convert(channel)
+
+        return out
+
+
+    def scan(self, sensors=None):
+        #----------------------------------------
+        '''
+        scan(list of MCP3008s) -> dictionary
+
+        Reads every channel in use (or just the given sensors' channels),
+        one conversion straight after the other, and holds each sensor's
+        code, and when it was converted, until it is taken. Returns
+        {sensor: code}.
+        '''
+        #----------------------------------------
+
+        if sensors is None:
+            sensors = self.sensors
+
+        #Sensors that read a channel the same way share the conversions.
+        codes = {}
+        for sensor in sensors:
+            key = (tuple(sensor.pin), sensor.samples, sensor.reduce, sensor.trim)
+            if key not in codes:
+                code = sensor._acquire()
+                codes[key] = (time(), code)
+
+        self.scan_time = time()
+        self.scans += 1
+        scanned = {}
+        for sensor in sensors:
+            self._pending[sensor] = codes[(tuple(sensor.pin), sensor.samples, sensor.reduce, sensor.trim)]
+            scanned[sensor] = self._pending[sensor][1]
+
+        return scanned
+
+
+    def take(self, sensor):
+        #----------------------------------------
+        '''
+        take(MCP3008) -> (float, number)
+
+        Hands a sensor its code from the last scan, and the time it was
+        converted. If it has already taken that one (or it is too old),
+        the bus converts the sensor's own channel then and there. The
+        other channels wait for their own turn, so no one pays for the
+        conversions of the rest (as in the asyncio runtime, where there
+        is no scan_due()).
+        '''
+        #----------------------------------------
+
+        if sensor not in self._pending or time() - self._pending[sensor][0] > self.max_age:
+            self.scan([sensor])
+
+        return self._pending.pop(sensor)
+
+
+    def executor(self):
+        #----------------------------------------
+        '''
+        executor() -> ThreadPoolExecutor
+
+        The one thread that all the asyncio calls for sensors on this bus
+        go through, so two of them never talk to the chip at once.
+        '''
+        #----------------------------------------
+
+        if getattr(self, '_pool', None) is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._pool = ThreadPoolExecutor(max_workers=1)
+        return self._pool
+
+
+    @staticmethod
+    def scan_due(sensors):
+        #----------------------------------------
+        '''
+        scan_due(list of sensors)
+
+        Scans together the MCP3008s in the list that share a bus, leaving
+        out everything else. Used before running the sensors that are due
+        at the same moment.
+        '''
+        #----------------------------------------
+
+        buses = {}
+        for sensor in sensors:
+            if isinstance(sensor, MCP3008):
+                buses.setdefault(sensor.bus, []).append(sensor)
+
+        for bus, on_bus in buses.items():
+            bus.scan(on_bus)
+
+
+class MCP3008(Sensor):
+    #######################################################
+    '''
+    MCP3008(string, float, channel #, channel #, channel #, channel #, 3-element list, calibration) -> sensor object
+
+    --Name:     The sensor name that will appear in the title of the data file.
+    --Vref:     The voltage applied to the reference pin of the MCP3008.
+    --Channels: The GPIO pins that will be connected to the I/O pins of the MCP3008.
+    --Pin:      The channel you want to read the sensor from in the form of a
+                    list, i.e. [0,1,0] is channel 2.
+    --conv:     The calibration used to convert voltage to the measured units:
+                    a calibration from calibration.py, i.e. Linear(200, -250),
+                    a dictionary describing one, or a formula in terms of
+                    volts, i.e. '(volts - 1.25) / 0.005'.
+    --bus:      Optional. The MCP3008Bus for the chip, if it is not the
+                    bit-banged one on the four pins given.
+    --samples:  Optional. How many conversions to make for each reading.
+    --reduce:   Optional. How to boil those down to one reading: 'mean',
+                    'median' or 'trimmed' (the mean once the highest and
+                    lowest trim fraction of the samples are thrown out).
+    --trim:     Optional. The fraction cut off each end for 'trimmed'.
+    --clock_delay: Optional. For the bit-banged bus (see BitBangTransport).
+
+    Several of my sensors produce some kind of analog output, so I decided that
+    having this class would make the code look nicer. If you have questions
+    about the IC, refer to the datasheet.
+
+    Every MCP3008 on the same pins shares one MCP3008Bus, which reads all
+    of their channels together. The bus is self.bus.
+    '''
+    ########################################################
+
+    record_kind = 'MCP3008'
+
+    def __init__(self, name, Vref, CLK, Dout, Din, CS, pin, conv, bus=None,
+                 samples=1, reduce='mean', trim=0.1, clock_delay=0):
+
+        #self.pin will correspond to the ADC pins of each temp sensor.
+        self.name = name
+        self.pin = pin
+        self.Vref = Vref
+
+        #Oversampling. The buffer is made once and refilled for every reading.
+        if reduce not in ('mean', 'median', 'trimmed'):
+            raise ValueError('reduce must be mean, median or trimmed, not ' + repr(reduce))
+        if not 0 <= trim < 0.5:
+            raise ValueError('trim must be at least 0 and less than 0.5')
+        self.samples = samples
+        self.reduce = reduce
+        self.trim = trim
+        self._buffer = np.empty(samples, dtype=np.float64)
+
+        #The chip itself is looked after by the bus. Pass bus=MCP3008Bus.spi()
+        #for a chip on the hardware SPI pins; the four pins are then ignored.
+        self.bus = bus or MCP3008Bus.shared(CLK, Dout, Din, CS, clock_delay)
+        self.bus.add(self)
+
+        #When the chip converted the code of the last reading.
+        self.code_time = None
+
+        #"conv" is turned into a calibration once, here, rather than
+        #worked out again for every reading.
+        self.calibration = calibration.make(conv)
+
+
+    def _read_chip(self):
+        #----------------------------------------
+        '''
+        _read_chip() -> floating point number
+
+        Talks serial to the ADC chip MCP3008 and returns
+        the voltage applied to the specified pin.
+        '''
+        #----------------------------------------
+
+        #1023 is the max decimal from the ADC.
+        ratio = self.bus.read(self.pin) / 1023
         voltage = ratio * self.Vref #self.Vref is the voltage represented by the 1023 output.
 
         return voltage
 
 
-    def _avg_calc(self):
+    def _executor(self):
+        #All the sensors on one chip share its thread.
+        return self.bus.executor()
+
+
+    def _log_header(self):
+        #Every data file says which calibration made its readings.
+        return {'calibration': self.calibration.describe()}
+
+
+    def _acquire(self):
         #----------------------------------------
         '''
-        _avg_calc() -> floating point number
+        _acquire() -> number
 
-        This takes 100 readings from the sensor and returns the mean.
+        Makes self.samples conversions and returns them reduced to one
+        code (not rounded, so the extra resolution is kept).
         '''
         #----------------------------------------
 
-        Vavg = 0
-        for i in range(100):
-            #get the ratio on pin 0
-            voltage = _read_chip(self.pin, self.Vref)
-            #add last measurement to the running average
-            Vavg = Vavg + voltage
+        if self.samples == 1:
+            return self.bus.read(self.pin)
 
-        #calculate the average
-        Vavg = round((Vavg / 100), 2)
+        buf = self.bus.read_many(self.pin, self._buffer)
+        if self.reduce == 'mean':
+            return float(buf.mean())
 
-        return Vavg
+        #Median and trimmed mean both want the samples in order. Sorting the
+        #buffer in place saves making a copy.
+        buf.sort()
+        n = self.samples
+        if self.reduce == 'median':
+            return float(buf[n // 2] if n % 2 else (buf[n // 2 - 1] + buf[n // 2]) / 2)
+        cut = int(n * self.trim)
+        return float(buf[cut:n - cut].mean())
 
 
     def _name_file(self):
@@ -236,10 +767,7 @@ class MCP3008(Sensor):
         #----------------------------------------
 
         #open a file for the data
-        self.file_name = self._name_file()
-        self.data_file = open(self.file_name, 'a')
-        self.data_file.write('\nNew data.\n\n')
-        self.data_file.close()
+        self._open_log()
 
         print(self.name, 'has started.')
 
@@ -250,24 +778,65 @@ class MCP3008(Sensor):
         get() -> float
 
         Return a sensor reading. This is used to collect
-        a point of data, or to pull a reading out and use
-        it for something else (i.e. get the temperature
-        inside the payload for the heater controller).
+        a point of data. To use a reading for something
+        else (i.e. the temperature inside the payload for
+        the heater controller), take self.latest instead,
+        so the chip is not read again.
         '''
         #----------------------------------------
 
-        #This reads the binary from the ADC chip.
-        volts = self._read_chip()
+        #This takes this channel's code from the latest scan of the chip.
+        self.code_time, code = self.bus.take(self)
+        volts = code / 1023 * self.Vref
 
-        #'conv' contains a piece of code. "eval()" runs the code, using
-        #variables from the environment (just "volts" in this case) and does
-        #whatever the code says to do.
-        reading = eval(self.conv)
+        #The calibration turns the voltage into the measured units.
+        reading = self.calibration(volts)
 
         #And here is what you get.
         return reading
 
+
+    def burst(self, rate, duration=None, buffer_size=4096, buffers=4):
+        #----------------------------------------
+        '''
+        burst(float, duration=None, buffer_size=4096, buffers=4) -> MCP3008Burst
+
+        Starts sampling this channel continuously at rate samples a
+        second, on a thread of its own, alongside the usual readings.
+        See MCP3008Burst.
+        '''
+        #----------------------------------------
+
+        burst = MCP3008Burst(self, rate, duration, buffer_size, buffers)
+        burst.start()
+
+        return burst
+
        
+    def sample(self):
+        #----------------------------------------
+        '''
+        sample() -> (float, list)
+
+        A reading and the time, as write() would log them. The time is
+        when the chip converted it, not when it was taken from the bus.
+        The reading is also kept as self.latest.
+        '''
+        #----------------------------------------
+
+        fields = [self.get()]
+        timestamp = self.code_time
+        self._cache(timestamp, fields)
+
+        return timestamp, fields
+
+
+    def _cache(self, timestamp, fields):
+        #Just the number, i.e. for the heater. (From a worker process it comes
+        #as text; see records.decode().)
+        self.latest = (timestamp, float(fields[0]))
+
+
     def write(self):
         #----------------------------------------
         '''
@@ -277,16 +846,13 @@ class MCP3008(Sensor):
         '''
         #----------------------------------------
 
-        #Open the file.
-        self.data_file = open(self.file_name, 'a')
-
-        #collect the data.
-        reading = self.get()
+        #collect the data. This is done even for samples that are not
+        #kept, so self.latest stays fresh for the heater.
+        timestamp, fields = self.sample()
 
         #write the data to the data file.
-        datum = str(asctime()) + ',' + str(reading) + '\n'
-        self.data_file.write(datum)
-        self.data_file.close()
+        if self._keep():
+            self.log.record(timestamp, fields)
 
 
     def stop(self):
@@ -294,24 +860,281 @@ class MCP3008(Sensor):
         '''
         stop()
 
-        Prints a shutdown message to standard out.
+        Closes the data file and prints a shutdown message to standard out.
         '''
         #----------------------------------------
 
+        self._close_log()
         print(self.name, 'has finished.')
 
 
+class MCP3008Burst(object):
+    #######################################################
+    '''
+    MCP3008Burst(MCP3008, float, duration=None, buffer_size=4096, buffers=4) -> burst object
+
+    --sensor:       The channel to sample.
+    --rate:         Samples per second to aim for.
+    --duration:     Optional. Seconds to sample for. It goes on until
+                        stop() if not given.
+    --buffer_size:  Samples per buffer.
+    --buffers:      How many buffers to go round.
+
+    A time series of one channel, as fast and as evenly spaced as the
+    chip allows. Each sample is the monotonic() time and the raw code,
+    put straight into buffers made ahead of time. A full buffer goes to
+    a second thread, which writes the lot to
+    <name>_burst_data_<date>.bin in one go (times as seconds since the
+    epoch, codes as they came off the chip; the header has the
+    calibration and Vref) and hands the buffer back.
+
+    A sample that could not be taken on time is skipped rather than
+    taken late, and counted in self.missed. If the writer falls so far
+    behind that there is no empty buffer, a full one is thrown away and
+    counted in self.dropped. status() says how it is going.
+
+    The bus is shared with the scheduled readings, so a bit-banged chip
+    will not get much past a couple of hundred samples a second. Use
+    MCP3008Bus.spi() for anything faster.
+    '''
+    #######################################################
+
+    def __init__(self, sensor, rate, duration=None, buffer_size=4096, buffers=4):
+        self.sensor = sensor
+        self.name = sensor.name + '_burst'
+        self.rate = rate
+        self.duration = duration
+        self.buffer_size = buffer_size
+
+        #All the buffers are made here, once, and passed back and forth
+        #between the two threads.
+        self._free = Queue()
+        for i in range(buffers):
+            self._free.put((np.empty(buffer_size, dtype=np.float64), np.empty(buffer_size, dtype=np.uint16)))
+        self._full = Queue()
+
+        self.samples = 0
+        self.written = 0
+        self.missed = 0
+        self.dropped = 0
+        self.started = None
+        self.finished = None
+        self.log = None
+        self._stop = threading.Event()
+        self._sampler = None
+        self._writer = None
+
+
+    def start(self):
+        #----------------------------------------
+        '''
+        start()
+
+        Opens the data file and starts sampling.
+        '''
+        #----------------------------------------
+
+        sensor = self.sensor
+        self.file_name = self.name + '_data_' + asctime().replace(' ', '_') + '.bin'
+        header = dict(sensor._log_header(), rate=self.rate, Vref=sensor.Vref)
+        options = dict(sensor.log_policy)
+        if sensor.log_segments is not None:
+            options.update(sensor.log_segments)
+        writer = BinaryLogWriter if sensor.log_segments is None else SegmentedBinaryLogWriter
+
+        #Not journaled: it would push everything else out of the journal in
+        #minutes, and a buffer is written as soon as it is full anyway.
+        self.log = writer(self.file_name, self.name, 'MCP3008Burst', header=header, **options)
+        self.log.open()
+
+        #monotonic() for the spacing, and this to turn it into the time of day.
+        self.clock_offset = time() - monotonic()
+
+        self._writer = threading.Thread(target=self._write, name=self.name + ' writer', daemon=True)
+        self._writer.start()
+        self._sampler = threading.Thread(target=self._sample, name=self.name, daemon=True)
+        self._sampler.start()
+
+        print(self.name, 'has started at', self.rate, 'samples a second.')
+
+
+    def _sample(self):
+        read = self.sensor.bus.read
+        pin = self.sensor.pin
+        period = 1 / self.rate
+        times, codes = self._free.get()
+        n = 0
+
+        self.started = due = monotonic()
+        end = self.started + self.duration if self.duration else None
+        while not self._stop.is_set() and (end is None or due < end):
+            now = monotonic()
+            if now < due:
+                sleep(due - now)
+            elif now - due >= period:
+                #Too late for some already. Skip them, rather than rushing
+                #to catch up, so the samples stay evenly spaced.
+                late = int((now - due) / period)
+                self.missed += late
+                metrics.count(self.name + '.overruns', late)
+                due += late * period
+
+            #The chip holds the voltage a few clocks into the conversation,
+            #so the time before it is the one that goes with the code.
+            times[n] = monotonic()
+            codes[n] = read(pin)
+            n += 1
+            self.samples += 1
+            due += period
+
+            if n == self.buffer_size:
+                times, codes = self._hand_off(times, codes, n)
+                n = 0
+
+        self.finished = monotonic()
+        if n:
+            self._full.put((times, codes, n))
+        self._full.put(None)
+
+
+    def _hand_off(self, times, codes, n):
+        #----------------------------------------
+        '''
+        _hand_off(array, array, integer) -> (array, array)
+
+        Passes a full buffer to the writer and returns an empty one.
+        '''
+        #----------------------------------------
+
+        try:
+            spare = self._free.get_nowait()
+        except Empty:
+            #The writer is behind and every buffer is full. This one's
+            #samples go, so the sampling can go on.
+            self.dropped += n
+            metrics.count(self.name + '.evictions', n)
+            return times, codes
+
+        self._full.put((times, codes, n))
+        return spare
+
+
+    def _write(self):
+        try:
+            while True:
+                item = self._full.get()
+                if item is None:
+                    break
+                times, codes, n = item
+                try:
+                    began = perf_counter()
+                    self.log.record_block(times[:n] + self.clock_offset, codes[:n])
+                    metrics.time(self.name + '.write', perf_counter() - began)
+                    self.written += n
+                except Exception:
+                    metrics.count(self.name + '.errors')
+                    print(self.name, 'could not write a buffer.')
+                finally:
+                    self._free.put((times, codes))
+        finally:
+            self.log.close()
+            print(self.status())
+
+
+    def status(self):
+        #----------------------------------------
+        '''
+        status() -> string
+
+        The rate it is getting, and what has been missed or dropped.
+        '''
+        #----------------------------------------
+
+        report = self.report()
+        return '%s: %d samples at %.1f a second (aiming for %g), %d missed, %d dropped' % (
+            self.name, report['samples'], report['achieved rate'], self.rate, self.missed, self.dropped)
+
+
+    def report(self):
+        #----------------------------------------
+        '''
+        report() -> dictionary
+
+        The target and achieved rates, and the samples taken, written,
+        missed and dropped.
+        '''
+        #----------------------------------------
+
+        elapsed = (self.finished or monotonic()) - self.started if self.started else 0.0
+
+        return {'target rate': self.rate, 'achieved rate': self.samples / elapsed if elapsed else 0.0,
+                'samples': self.samples, 'written': self.written, 'missed': self.missed,
+                'dropped': self.dropped}
+
+
+    def stop(self):
+        #----------------------------------------
+        '''
+        stop()
+
+        Stops sampling, and waits for the last buffer to be written.
+        '''
+        #----------------------------------------
+
+        self._stop.set()
+        for thread in (self._sampler, self._writer):
+            if thread is not None:
+                thread.join()
+
+
 class CountSensor(Sensor):
     #######################################################
     '''
+    CountSensor(string, pin, capacity=65536, history=60) -> sensor object
+
+    --capacity: How many pulse times to keep between readings. Past that
+                    the oldest times are overwritten, but the count is
+                    still right.
+    --history:  How many readings to keep for rate().
+
     The CountSensor is set up to monitor a pin by waiting for
     a pulse. It counts these pulses and writes the count to a file
     along with the time during which the counts were measured.
+
+    The edge callback only writes the time of the pulse into a ring
+    buffer made ahead of time. get() swaps in the spare buffer in one
+    step, so no pulse can fall between reading the count and resetting
+    it, and then works out the statistics from the full one:
+
+    --intervals:    The times between the pulses of the last reading.
+    --rate():       Counts per second over the last few readings.
+    --interarrival_histogram(): Every time between pulses so far,
+                        binned on a log scale.
     '''
     ########################################################
 
-    def __init__(self, name, signal_pin):
+    record_kind = 'CountSensor'
+
+    #Log-spaced bins for the times between pulses, 1 us to 100 s.
+    HISTOGRAM_EDGES = np.logspace(-6, 2, 33)
+
+    def __init__(self, name, signal_pin, capacity=65536, history=60):
         self.name = name
+        self.capacity = capacity
+
+        #The pulse buffers: one being filled, one spare.
+        self._lock = threading.Lock()
+        self._active = np.zeros(capacity, dtype=np.float64)
+        self._spare = np.zeros(capacity, dtype=np.float64)
+        self._index = 0
+        self.start_time = monotonic()
+
+        #The statistics.
+        self.intervals = np.zeros(0)
+        self.overflows = 0
+        self.windows = deque(maxlen=history)
+        self.histogram = np.zeros(len(self.HISTOGRAM_EDGES) - 1, dtype=np.int64)
+        self._last_pulse = None
 
         #set up the I/O pin
         self.signal_pin = signal_pin
@@ -324,14 +1147,15 @@ class CountSensor(Sensor):
         _signal(pin)
 
         Called when an edge of the specified type is detected on the
-        given pin. Adds one to the running count of pulses since the
-        previous reading.
+        given pin. Puts the time of the pulse in the buffer, and that is
+        all: anything slow here makes the next pulse wait.
         '''
         #----------------------------------------
 
-        #grab those global variables
-        self.count += 1
-        print('hit,', self.count)
+        now = monotonic()
+        with self._lock:
+            self._active[self._index % self.capacity] = now
+            self._index += 1
 
 
     def start(self):
@@ -345,15 +1169,12 @@ class CountSensor(Sensor):
         #----------------------------------------
 
         #open a file for the data
-        self.file_name = self._name_file()
-        self.data_file = open(self.file_name, 'a')
-        self.data_file.write('\nNew data.\n\n')
-        self.data_file.close()
+        self._open_log()
 
         #set up the data variables and event detection.
+        self._index = 0
+        self.start_time = monotonic()
         GPIO.add_event_detect(self.signal_pin, GPIO.FALLING, callback=self._signal) #set up the event detection
-        self.start_time = time()
-        self.count = 0
 
         #send a message
         print(self.name, 'has started.')
@@ -362,29 +1183,78 @@ class CountSensor(Sensor):
     def get(self):
         #----------------------------------------
         '''
-        get() -> float
+        get() -> list
 
-        Returns the calculated Counts Per Minute. This can be used to
+        Returns the number of pulses since the last reading and the
+        seconds they were counted over. This can be used to
         collect a point of data, or to pull a reading out and use it
-        for something else (i.e. get the temperature inside the
-        payload for the heater controller).
+        for something else.
         '''
         #----------------------------------------
 
-        #This gets the change in time and the number of counts.
-        sample_time = time() - self.start_time
+        #Swap the buffers and reset the count, all at once.
+        with self._lock:
+            pulses, count = self._active, self._index
+            self._active, self._index = self._spare, 0
+            now = monotonic()
+        self._spare = pulses
 
         #This is the raw data.
-        data = [self.count, sample_time]
+        sample_time = now - self.start_time
+        self.start_time = now
+        data = [count, sample_time]
+
+        #Put the pulse times back in order if the ring wrapped around.
+        kept = min(count, self.capacity)
+        if count > self.capacity:
+            self.overflows += count - self.capacity
+            metrics.count(self.name + '.evictions', count - self.capacity)
+            start = count % self.capacity
+            times = np.concatenate((pulses[start:], pulses[:start]))
+        else:
+            times = pulses[:kept]
 
-        #reset the data variables
-        self.start_time = time()
-        self.count = 0
+        #The gaps, including the one from the last pulse of the reading before.
+        if kept and self._last_pulse is not None and count <= self.capacity:
+            times = np.concatenate(([self._last_pulse], times))
+        self.intervals = np.diff(times)
+        if kept:
+            self._last_pulse = times[-1]
+        self.histogram += np.histogram(self.intervals, self.HISTOGRAM_EDGES)[0]
+        self.windows.append((count, sample_time))
 
-        print('Markers and small children', data)
         return data
 
 
+    def rate(self, readings=None):
+        #----------------------------------------
+        '''
+        rate(readings=None) -> float
+
+        Counts per second over the last so many readings (all of the
+        ones kept if not given).
+        '''
+        #----------------------------------------
+
+        windows = list(self.windows)[-readings:] if readings else self.windows
+        seconds = sum(window for count, window in windows)
+
+        return sum(count for count, window in windows) / seconds if seconds else 0.0
+
+
+    def interarrival_histogram(self):
+        #----------------------------------------
+        '''
+        interarrival_histogram() -> (array, array)
+
+        The counts in each bin and the bin edges (seconds) of every time
+        between pulses since the start.
+        '''
+        #----------------------------------------
+
+        return self.histogram.copy(), self.HISTOGRAM_EDGES
+
+
     def write(self):
         #----------------------------------------
         '''
@@ -394,16 +1264,30 @@ class CountSensor(Sensor):
         '''
         #----------------------------------------
         
-        #Get the data.
-        data = self.get()
+        #Samples that are not kept are not read either, so the count just
+        #runs on into the next one and no pulses are lost.
+        if not self._keep():
+            return
+
+        #Get the data, and write it as one comma delimited line.
+        self.log.record(*self.sample())
+
+
+    def sample(self):
+        #----------------------------------------
+        '''
+        sample() -> (float, list)
+
+        The count and window since the last one, and the time, as
+        write() would log them. They are also kept as self.latest; get()
+        starts the count over, so nothing else should call it.
+        '''
+        #----------------------------------------
 
-        #Open the file.
-        self.data_file = open(self.file_name, 'a')
+        timestamp, data = time(), self.get()
+        self._cache(timestamp, data)
 
-        #write comma delimited data to a file
-        report = asctime() + ',' + str(data[0]) + ',' + str(data[1]) + '\n'
-        self.data_file.write(report)
-        self.data_file.close()
+        return timestamp, data
 
 
     def stop(self):
@@ -411,54 +1295,143 @@ class CountSensor(Sensor):
         '''
         stop()
 
-        Prints a shutdown message to standard out.
+        Closes the data file and prints a shutdown message to standard out.
         '''
         #----------------------------------------
 
+        GPIO.remove_event_detect(self.signal_pin)
+        self._close_log()
         print(self.name, 'has finished.')
 
 
 class GPS(Sensor):
     ########################################################
     '''
+    GPS(string, device='/dev/ttyUSB0') -> sensor object
+
     This uses the agps3 class from the gps3 module to interface
     with a GNSS unit via the Adafruit USB serial cable.
+
+    A reader thread takes in everything gpsd sends and keeps the latest
+    value of every TPV field, so get() (and anything else that wants
+    the position, through fix()) never has to wait on the socket.
+    If gpsd goes away the thread stops, and get() raises from then on,
+    so the supervisor restarts the sensor (which connects again).
     '''
     ########################################################
 
-    def __init__(self, name):
+    record_kind = 'GPS'
+
+    #The TPV fields that are logged, in order.
+    FIELDS = ('time', 'ept', 'lat', 'lon', 'alt', 'epx', 'epy', 'epv',
+              'track', 'speed', 'climb', 'epd', 'eps', 'epc')
+
+    def __init__(self, name, device='/dev/ttyUSB0'):
         self.name = name
+        self.device = device
+
+        #The latest fix, and when it came in.
+        self._lock = threading.Lock()
+        self._fix = dict.fromkeys(self.FIELDS, 'n/a')
+        self.fix_time = None
+        self.reports = 0
+
+        #self.latest is (time, fix) of the latest report, kept by the reader
+        #thread rather than by sample(), so its age is the fix's age.
 
     def start(self):
         #----------------------------------------
         '''
         start()
 
-        Starts the connection with the GPS board, opens a data file, and
-        prints a message to standard out.
+        Starts the connection with the GPS board, starts the reader
+        thread, opens a data file, and prints a message to standard out.
         '''
         #----------------------------------------
 
         #begin by starting the GPS daemon.
-        system('gpsd /dev/ttyUSB0')
+        backend = get_backend()
+        backend.start_gpsd(self.device)
         #instantiate a socket object, which is an interface with the GPS daemon.
-        self.gps_socket = agps3.GPSDSocket()
-        #instantiate a dot object--basically, one data point--which unpacks the GPS data into attribute values.
-        self.dot = agps3.Dot()
+        self.gps_socket = backend.gps_socket()
         #now start the stream of data
         self.gps_socket.connect()
         self.gps_socket.watch()
 
+        self.error = None
+        self._reading = True
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
         #open a file for the data
-        self.file_name = self._name_file()
-        self.data_file = open(self.file_name, 'a')
-        self.data_file.write('\nNew data.\n\n')
-        self.data_file.close()
+        self._open_log()
 
         #print a confirmation.
         print(self.name, 'has started.')
 
 
+    def _run(self):
+        #----------------------------------------
+        '''
+        _run()
+
+        The reader thread. Merges every TPV report into the latest fix.
+        Reports only carry the fields the receiver knows, so a field
+        keeps its last value until a report updates it.
+        '''
+        #----------------------------------------
+
+        while self._reading:
+            try:
+                new_data = self.gps_socket.next(timeout=1.0)
+            except OSError as error:
+                self.error = error
+                break
+            #None is nothing yet, but '' is gpsd closing the socket. Going
+            #round again would only get '' straight back, as fast as it can.
+            if new_data == '':
+                self.error = ConnectionError('gpsd closed the connection')
+                break
+            if not new_data:
+                continue
+
+            try:
+                report = json.loads(new_data)
+            except ValueError:
+                continue
+            if report.get('class') != 'TPV':
+                continue
+
+            with self._lock:
+                for field in self.FIELDS:
+                    if field in report:
+                        self._fix[field] = report[field]
+                self.fix_time = time()
+                self.reports += 1
+                self.latest = (self.fix_time, dict(self._fix))
+
+
+    def fix(self):
+        #----------------------------------------
+        '''
+        fix() -> (float, dictionary)
+
+        The time the latest report came in (None if none has yet) and a
+        copy of the fix, by TPV field name.
+        '''
+        #----------------------------------------
+
+        with self._lock:
+            return self.fix_time, dict(self._fix)
+
+
+    def _check(self):
+        #Raises if the reader thread has stopped, rather than going on
+        #logging its last fix for the rest of the flight.
+        if not self._thread.is_alive():
+            raise ConnectionError('the GPS reader has stopped: ' + str(self.error))
+
+
     def get(self):
         #----------------------------------------
         '''
@@ -475,21 +1448,10 @@ class GPS(Sensor):
         '''
         #----------------------------------------
 
-        #Apparently this is the black magic that gets the data.
-        for new_data in self.gps_socket:
-            if new_data:
-                self.dot.unpack(new_data)
-                #I only want a single data point, not a continuous stream.
-                break
-
-        #Write the data to a comma-delimited file.
-        gpsd_readout = [asctime(), self.dot.time, self.dot.ept,\
-                        self.dot.lat, self.dot.lon, self.dot.alt,\
-                        self.dot.epx, self.dot.epy, self.dot.epv,\
-                        self.dot.track, self.dot.speed, self.dot.climb,\
-                        self.dot.epd, self.dot.eps, self.dot.epc]
+        self._check()
+        fix_time, fix = self.fix()
 
-        return gpsd_readout
+        return [asctime()] + [fix[field] for field in self.FIELDS]
 
 
     def write(self):
@@ -501,31 +1463,33 @@ class GPS(Sensor):
         '''
         #----------------------------------------
 
-        #Open the file.
-        self.data_file = open(self.file_name, 'a')
+        if not self._keep():
+            return
+
+        #Now write that puppy as one comma-delimited line.
+        self.log.record(*self.sample())
+
+
+    def sample(self):
+        #----------------------------------------
+        '''
+        sample() -> (float, list)
+
+        The latest fix and the time, as write() would log them.
+        '''
+        #----------------------------------------
+
+        #The reader thread already has it; no need for get()'s asctime().
+        self._check()
+        timestamp = time()
+        fix_time, fix = self.fix()
 
-        #Retrieve the data.
-        gpsd_readout = self.get()
+        return timestamp, [fix[field] for field in self.FIELDS]
 
-        #Reverse the list so list.pop() will get them in the right order.
-        gpsd_readout.reverse()
-        #compile all the data
-        data = ''
-        #The reason that I don't just use
-        #    for field in gpsd_readout:
-        #is that I need the index to avoid putting a comma at the end of every line.
-        fields = len(gpsd_readout)
-        for i in range(fields):
-            data = data + str(gpsd_readout.pop())
-            #Add a comma after each field except the last one.
-            if len(gpsd_readout) != 0:
-                data = data + ','
-        #Add a newline character after at the tail end of it all.
-        data = data + '\n'
 
-        #Now write that puppy, and put it to bed.
-        self.data_file.write(data)
-        self.data_file.close()
+    def _cache(self, timestamp, fields):
+        #For a GPS sampled in a worker process (see workers.py).
+        self.latest = (timestamp, dict(zip(self.FIELDS, fields)))
 
 
     def stop(self):
@@ -533,13 +1497,16 @@ class GPS(Sensor):
         '''
         stop()
 
-        Closes the socket connection with the GPS unit and prints a
-        stop message to standard out.
+        Stops the reader thread, closes the socket connection with the GPS
+        unit and prints a stop message to standard out.
         '''
         #----------------------------------------
-        
+
         #Shut it all down.
+        self._reading = False
+        self._thread.join()
         self.gps_socket.close()
+        self._close_log()
 
         #print a confirmation.
         print(self.name, 'has finished.')
@@ -548,69 +1515,160 @@ class GPS(Sensor):
 class Camera(Sensor):
     ########################################################
     '''
+    Camera(string, vid_length=60, video=True, picture_dir='pictures', video_dir='video', queue_size=4, resolution=None) -> sensor object
+
+    --vid_length:   Seconds of video in each file.
+    --video:        Record video at all. Stills are taken either way.
+                        This can be changed while the camera is running.
+    --picture_dir:  Where the pictures go.
+    --video_dir:    Where the videos go.
+    --queue_size:   How many pictures can wait to be taken before more
+                        are turned away.
+    --resolution:   (width, height), or None for the camera's own. This
+                        can also be changed while the camera is running;
+                        the video restarts in a new file to take it.
+
     This is a nice case for the picamera to go in so that it looks like
     all the other sensor objects I made.
+
+    The camera runs on its own thread, so nothing else ever waits on it.
+    It records video the whole time, starting a new file every vid_length
+    seconds, and write() just asks the thread for a still, which it grabs
+    from the video port without stopping the recording.
     '''
     ########################################################
-    
-    def __init__(self, name, vid_period=0, vid_length=10):
+
+    def __init__(self, name, vid_length=60, video=True, picture_dir='pictures',
+                 video_dir='video', queue_size=4, resolution=None):
         self.name = name
-        self.vid_period = vid_period
         self.vid_length = vid_length
+        self.video = video
+        self.resolution = resolution
+        self.picture_dir = picture_dir
+        self.video_dir = video_dir
+        self.queue_size = queue_size
+
+    def _file(self, directory, prefix, number, extension):
+        #generate a time stamp, replacing spaces with file-friendly underlines.
+        #The number keeps two files in the same second apart.
+        date_time = asctime().replace(' ', '_')
+        return os.path.join(directory, prefix + date_time + '_' + str(number) + extension)
 
     def start(self):
         #----------------------------------------
         '''
         start() -> camera object is instantiated
+
+        Starts the camera thread, which starts the video.
         '''
         #----------------------------------------
 
-        self.camera = picamera.PiCamera()
-        self.counter = 0
+        os.makedirs(self.picture_dir, exist_ok=True)
+        os.makedirs(self.video_dir, exist_ok=True)
+
+        self.camera = get_backend().camera()
+        self.commands = Queue(self.queue_size)
+        self.pictures = 0
+        self.videos = 0
+        self.dropped = 0
+        self.error = None
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
         print('Camera has started.')
 
-    def write(self):
+    def _run(self):
         #----------------------------------------
         '''
-        write()
+        _run()
 
-        This uses the camera object from the PiCamera module
-        to take a picture with a timestamp in the name.
+        The camera thread. Takes stills as they are asked for, and splits
+        the video into a new file whenever the current one is long enough.
+        An error from the camera (a full card ...) stops the thread and is
+        kept in self.error.
         '''
         #----------------------------------------
 
-        self.counter += 1
+        try:
+            recording = False
+            split_at = None
+            resolution = None
+            while True:
+                #The resolution can only be changed while the camera is not recording.
+                if self.resolution is not None and self.resolution != resolution:
+                    if recording:
+                        self.camera.stop_recording()
+                        recording = False
+                    self.camera.resolution = resolution = self.resolution
+
+                if self.video and not recording:
+                    #each video will have a unique name.
+                    self.camera.start_recording(self._file(self.video_dir, 'video_', self.videos, '.h264'))
+                    recording = True
+                    split_at = time() + self.vid_length
+                    self.videos += 1
+                elif recording and not self.video:
+                    self.camera.stop_recording()
+                    recording = False
+
+                #Wait for a command, but not past the end of the video file.
+                try:
+                    command = self.commands.get(timeout=max(split_at - time(), 0) if recording else None)
+                except Empty:
+                    command = None
+
+                if recording and time() >= split_at:
+                    self.camera.split_recording(self._file(self.video_dir, 'video_', self.videos, '.h264'))
+                    split_at += self.vid_length
+                    self.videos += 1
+
+                if command == 'still':
+                    #each picture will have a unique name
+                    self.camera.capture(self._file(self.picture_dir, 'picture_', self.pictures, '.jpg'),
+                                        use_video_port=recording)
+                    self.pictures += 1
+                elif command == 'stop':
+                    break
+
+            if recording:
+                self.camera.stop_recording()
+        except Exception as error:
+            #Kept for write() to raise, or nothing would ever hear of it.
+            self.error = error
 
-        #generate a time stamp, replacing spaces with file-friendly underlines
-        date_time = asctime().replace(' ', '_')
-
-        if self.counter >= self.vid_period:
-            self.counter = 0
-
-            #each video will have a unique name.
-            name = 'video_' + date_time + '.h264'
-
-            #get some video.
-            self.camera.start_recording(name)
-            self.camera.wait_recording(timeout=self.vid_length)
-            self.camera.stop_recording()
+    def write(self):
+        #----------------------------------------
+        '''
+        write()
 
-            #convert the video to a useful format.
-            #this is commented out to save space in flight.
-            #command = 'avconv -i ' + name + ' -c copy video_' + date_time + '.mp4'
-            #system(command)
+        Asks the camera thread to take a picture with a timestamp in
+        the name. This never waits: if the thread is too far behind,
+        the picture is skipped and counted in self.dropped. If the
+        thread has stopped, this raises, so the supervisor restarts it.
+        '''
+        #----------------------------------------
 
-        else:
-            #each picture will have a unique name
-            name = 'picture_' + date_time + '.jpg'
+        if not self._thread.is_alive():
+            raise RuntimeError('the camera thread has stopped: ' + str(self.error))
 
-            #take a picture
-            self.camera.capture(name)
+        if not self._keep():
+            return
 
+        try:
+            self.commands.put_nowait('still')
+        except Full:
+            self.dropped += 1
+            metrics.count(self.name + '.evictions')
 
     def stop(self):
+        #Let the thread finish the picture it is on and close the video.
+        while True:
+            try:
+                self.commands.get_nowait()
+            except Empty:
+                break
+        self.commands.put('stop')
+        self._thread.join()
         self.camera.close()
-        system('mv *.jpg pictures/')
         print('Camera stopped.')
 
 
@@ -641,6 +1699,24 @@ def blinky(LED, speed):
     sleep(speed / 2)
 
 
+async def ablinky(LED, speed):
+    #----------------------------------------
+    '''
+    ablinky(pin, seconds) -> single pulse
+
+    The same as blinky(), for the asyncio runtime: the other sensors keep
+    going while the LED is on and off.
+    '''
+    #----------------------------------------
+
+    import asyncio
+
+    GPIO.output(LED, True)
+    await asyncio.sleep(speed / 2)
+    GPIO.output(LED, False)
+    await asyncio.sleep(speed / 2)
+
+
 def launch(trigger_pin, LED):
     #----------------------------------------
     '''
@@ -695,23 +1771,19 @@ def landing(trigger_pin):
 
 
    
-def check_mem(): 
-    #---------------------------------------- 
-    ''' 
-    check_mem() -> integer
-    
-    This returns the amount of free memory remaining in kilobytes.
-    ''' 
-    #---------------------------------------- 
- 
-    #"free" displays basic memory info. 
-    info = popen('df') 
-    info.readline() #the first line is only labels 
-    space = info.readline().split() 
-    free = int(space[3]) 
- 
-    return free 
-   
+def check_mem(path='.'):
+    #----------------------------------------
+    '''
+    check_mem(path='.') -> integer
+
+    This returns the amount of free space left, in kilobytes, on the
+    disk the path is on.
+    '''
+    #----------------------------------------
+
+    #statvfs asks the kernel directly, instead of starting up "df".
+    return free_bytes(path) // 1024
+
 
 def heater(heater_pin, temp):
     #---------------------------------------- 
@@ -1,4 +1,4 @@
-#!/usr/bin/python3.4
+#!/usr/bin/python3
 '''
 This is the flight controller program for a high-altitude balloon
 payload. The process herein allows for easy adding and removing of
@@ -8,105 +8,242 @@ Elaine Jeffery
 14 July 2017
 '''
 
-from fl_objects_2 import *
+import argparse
+from os import system
+from time import time, asctime
 
+#Only what every flight needs is imported up front. The sensor drivers come
+#in as the config asks for them (see sensor_registry.py), and the rest when
+#it is turned on.
+from hardware import GPIO, get_backend
+from scheduler import Scheduler
+from thermal import ThermalController
+from metrics import registry as metrics
+from storage import StorageGovernor
+from journal import Journal
+from supervisor import Supervisor, Timeout
+import sensor_registry
 
-def main():
+
+def main(runtime='schedule', show_metrics=False, burst=None, config=None):
     #------------------------------------------------------------------
     '''
     This is the body of the program.
+
+    --runtime:      'schedule' runs everything from one thread on a deadline
+                        scheduler. 'async' runs each sensor as an asyncio task
+                        with its blocking calls on its own thread. 'process'
+                        samples the sensors in worker processes (see workers.py)
+                        and runs the rest like 'schedule'.
+    --show_metrics: Print the timing summary every time the metrics are
+                        written to their file (once a minute).
+    --burst:        Also sample the burst sensor in the config (the light
+                        channel, for the eclipse) continuously at this many
+                        samples a second (see MCP3008Burst). 0 for none, or
+                        None for the rate in the config.
+    --config:       The flight config file, flight_config.json if not given.
     '''
     #------------------------------------------------------------------
 
+    queue = []
+    local = []
+    pool = None
+    light_burst = None
+    telemetry = None
+    supervisor = None
 
     try:
         ###############################################################
         '''
-        If you are in the business of adding or removing sensors, you are in the right
-        place!  To add a sensor, you must at least instantiate the object and add it
-        to the queue.  It may also be helpful to define some common variables if you
-        have, for example, several sensors that will use the same ADC chip.
+        If you are in the business of adding or removing sensors, you are in the wrong
+        place!  The sensors, their pins, calibrations and rates, and what the heater,
+        the radio and the rest go by, are all in the flight config file (see
+        sensor_registry.py). main() just builds what it says.
 
-        --Variables:    Define any variables that you will need for several sensors.
-        --Sensors:      Instantiate the sensor objects.
-        --Queue:        Add the sensors to the start/write/stop queue.
+        --Config:   Read the config file.
+        --Queue:    Make the sensors, in the order they are started. Any that cannot
+                        be made (i.e. a library is missing) are left out.
 
         '''
 
-        #Variables.
-        Vref            = 5.09
-        CLK             = 11
-        Dout            = 13
-        Din             = 15
-        CS              = 16
-
-        #Sensors.
-        #convert volts to *F then *F to *C for the inside temp.
-        inside          = MCP3008('Inside_temp', Vref, CLK, Dout, Din, CS, [0,0,0], '((volts * 100) - 32) / 9 * 5')
-        outside         = MCP3008('Outside_temp', Vref, CLK, Dout, Din, CS, [0,0,1], '(volts - 1.25) / 0.005')
-        light           = MCP3008('Light', Vref, CLK, Dout, Din, CS, [0,1,0], 'volts')
-        pressure        = MCP3008('Pressure', Vref, CLK, Dout, Din, CS, [0,1,1], '(volts - 4.57) / -0.0040')
-        gps             = GPS('GPS')
-        camera          = Camera('Camera', vid_period=10, vid_length=5)
+        #Config.
+        config = sensor_registry.load(config)
 
         #Queue.
-        #If camera fails, the next thing in the queue gets messed up. IDK why.
-        #queue = [inside, outside, light, pressure, gps, camera]
-        queue = [inside, outside, light, pressure, gps, camera]
+        queue = sensor_registry.build(config)
+
+        def find(name):
+            return sensor_registry.find(queue, name) if name else None
+
+        #Every call to a sensor gets a deadline, and a sensor that keeps failing is
+        #taken out for a while and then started again (see supervisor.py).
+        supervisor = Supervisor(**config.get('supervisor', {}))
 
         ###############################################################
 
+        #Everything the sensors log also goes into the journal, which survives the power
+        #being cut. If the last flight ended that way, its data files are rebuilt first.
+        journal = Journal(config.get('journal', 'journal.dat'))
+        if not journal.clean:
+            print('The last run did not shut down. Recovered:', journal.recover('data'))
+        for sensor in queue:
+            sensor.journal = journal
+
         #Here the indicator LED is set up.
-        comfort_led = 32
+        comfort_led = config.get('led', 32)
         GPIO.setup(comfort_led, GPIO.OUT)
 
-        #Here, the heater pin is defined and set up.
-        heater_pin = 33
-        GPIO.setup(heater_pin, GPIO.OUT)
+        #Here, the heater pin is defined. The heater gets its own control loop on its
+        #own thread, so a camera or GPS that hangs cannot hold it up, and it goes by
+        #the last inside temperature the sensors read instead of reading the ADC.
+        #Without that sensor it runs at its fail-safe duty.
+        heater = dict(config.get('heater', {'pin': 33}))
+        heater_pin = heater.pop('pin')
+        thermostat = ThermalController(heater_pin, find(heater.pop('sensor', None)), **heater)
+
+        #The workers are forked before any other threads are started. The sensors
+        #they do not take are left to this process.
+        local = list(queue)
+        if runtime == 'process':
+            from workers import WorkerPool
+            pool = WorkerPool(queue)
+            local = pool.local
+            pool.start()
 
         #Try to start all the sensors with their identically named "start()"
-        #methods, but kick them out if they give you any trouble.
-        for sensor in queue:
-            try:
-                sensor.start()
-            except:
-                queue.remove(sensor)
-                print(sensor.name, 'failed to start. It was kicked out of the queue.')
-            finally:
-                pass
+        #methods. One that gives you any trouble stays in the queue, but is down
+        #until the supervisor has another go at starting it.
+        for sensor in local:
+            supervisor.start(sensor)
 
-        #This is the main loop that is going to be running for most of the flight.
-        flying = True
-        while flying:
-            #Get all the data.
-            for sensor in queue:
-                try:
-                    sensor.write()
-                    print(sensor.name, sensor.get()) #Use this and a bit below for debugging in the terminal.
-                #except:
-                #    print(sensor.name, 'raised an error.')
-                finally:
-                    pass
-
-            #Report success. Shout it from the rooftops . . . or from a balloon.
-            print('Data collected at', asctime())
-            blinky(comfort_led, 1)
-
-            #Check the temperature, and turn on the heater if necesary.
+        #The eclipse light curve, as a continuous time series. Its thread talks to
+        #the chip too, so it cannot share it with a worker process.
+        burst_config = config.get('burst', {})
+        burst_sensor = find(burst_config.get('sensor'))
+        if burst is None:
+            burst = burst_config.get('rate', 0)
+        if burst and burst_sensor is not None and pool is None:
+            light_burst = burst_sensor.burst(burst)
+        elif burst:
+            print('The burst needs its sensor, on the ADC in this process. It is off.')
+
+        thermostat.start()
+
+        #Watch the free space, and cut back on the camera and then the logging if the
+        #card will fill up before we land.
+        storage_config = dict(config.get('storage', {}))
+        camera = find(storage_config.pop('camera', None))
+        storage = StorageGovernor('.', camera if camera in local else None,
+                                  [sensor for sensor in queue if sensor is not camera],
+                                  **storage_config)
+        storage.start()
+
+        #Tell the ground where we are, every few seconds, over the radio. Nothing
+        #waits on the radio; if it falls behind, the oldest frames are dropped. A
+        #field is "Sensor" for its reading, or "Sensor.field" for part of it (GPS).
+        #A counter's reading is sent as counts a second.
+        radio_config = config.get('telemetry')
+        if radio_config:
+            from telemetry import SerialLink, Telemetry, latest, rate
+            sources = {'time': time}
+            for field, source in radio_config.get('fields', {}).items():
+                name, dot, part = source.partition('.')
+                if find(name) is None:
+                    continue
+                if find(name).record_kind == 'CountSensor':
+                    sources[field] = rate(find(name))
+                else:
+                    sources[field] = latest(find(name), part or None)
             try:
-                temp = inside.get()
-                heater(heater_pin, temp)
-            except:
-                print('The heater has failed.')
-            finally:
-                pass
+                radio = SerialLink(get_backend().serial_port(radio_config['device']),
+                                   baud=radio_config.get('baud', 9600))
+                telemetry = Telemetry(radio, sources, period=radio_config.get('period', 5.0))
+            except OSError:
+                print('The radio could not be opened. There will be no telemetry.')
+
+        #Report success. Shout it from the rooftops . . . or from a balloon. The
+        #readings are the ones the loop last took; printing them reads nothing.
+        def status():
+            readings = ['%s %.2f' % (sensor.name, sensor.latest[1]) for sensor in queue
+                        if sensor.latest is not None and isinstance(sensor.latest[1], float)]
+            print('Data collected at', asctime(), *readings)
+
+        #Write down how long everything is taking, and maybe say so.
+        def dump_metrics():
+            metrics.dump()
+            if show_metrics:
+                print(metrics.summary())
+                print(storage.status())
+            if supervisor.status():
+                print(supervisor.status())
+
+        #Blink the light without holding anything up.
+        led_on = False
+        def comfort():
+            nonlocal led_on
+            led_on = not led_on
+            GPIO.output(comfort_led, led_on)
+
+        if runtime == 'async':
+            import async_runtime
+
+            #Every sensor samples on its own, so one that blocks only holds itself up.
+            async def async_status():
+                status()
 
-            blinky(comfort_led, 1)
+            async def async_comfort():
+                comfort()
 
-            #Use the following (and a bit of code above) for debugging in the terminal.
-            #Make the display easier to read.
-            #sleep(1)
-            #system('clear')
+            jobs = [('Status', async_status, 1.0), ('LED', async_comfort, 1.0),
+                    ('Storage', async_runtime.blocking(storage.check), 10.0),
+                    ('Report', async_runtime.blocking(dump_metrics), 60.0)]
+            if telemetry is not None:
+                #Neither of these blocks, so they run right on the loop.
+                async def async_telemetry():
+                    telemetry.send()
+
+                async def async_radio():
+                    telemetry.pump()
+
+                jobs += [('Telemetry', async_telemetry, telemetry.period), ('Radio', async_radio, 0.1)]
+
+            async_runtime.run(local, jobs, supervisor)
+
+        else:
+            #This is the schedule that is going to be running for most of the flight.
+            #Every sensor writes on its own period, and the ADC channels that come due
+            #at the same moment are read in one scan of the chip.
+            from fl_objects_2 import MCP3008Bus
+            schedule = Scheduler(metrics=metrics)
+            owners = {}
+            for sensor in local:
+                owners[schedule.add(sensor.name, supervisor.watch(sensor), sensor.period, sensor.priority)] = sensor
+            schedule.before_each(supervisor.feed)
+            schedule.before_each(lambda due: MCP3008Bus.scan_due([owners[task] for task in due if task in owners]))
+
+            #Say how the schedule is keeping up.
+            def report():
+                dump_metrics()
+                print(schedule.report())
+
+            jobs = [('Status', status, 1.0), ('LED', comfort, 1.0),
+                    ('Storage', storage.check, 10.0)]
+            if telemetry is not None:
+                jobs += [('Telemetry', telemetry.send, telemetry.period), ('Radio', telemetry.pump, 0.1)]
+            if pool is not None:
+                jobs += [('Workers', pool.drain, 0.1), ('Supervisor', pool.supervise, 1.0)]
+            for name, job, period in jobs:
+                schedule.add(name, supervisor.guard(name, job), period, priority=5 if name == 'Workers' else 0)
+            schedule.add('Report', supervisor.guard('Report', report), 60.0, offset=60.0)
+
+            #If the loop gets stuck somewhere no deadline covers, the watchdog
+            #interrupts it, and it carries on from the next task that is due.
+            supervisor.start_watchdog()
+            while True:
+                try:
+                    schedule.run()
+                except Timeout:
+                    print('The flight loop was stuck, and has been restarted.')
 
 
     #Here are statements for dealing with errors that the rest of the code cannot handle.
@@ -123,14 +260,54 @@ def main():
     finally:
         #We want to stop the sensors, but things may have gotten a bit out of hand by
         #this time. Hence, the try: finally: statement.
-        for sensor in queue:
+        if supervisor is not None:
+            supervisor.stop_watchdog()
+
+        if light_burst is not None:
             try:
-                sensor.stop()
+                light_burst.stop()
+            except:
+                print('The light burst failed while stopping.')
+
+        for sensor in local if supervisor is not None else []:
+            try:
+                supervisor.stop(sensor)
             except:
                 print(sensor.name, 'failed while stopping.')
             finally:
                 pass
 
+        #The workers' sensors are stopped by the workers, and what they sampled
+        #last is written out.
+        if pool is not None:
+            try:
+                pool.stop()
+            except:
+                print('The workers failed while stopping.')
+
+        if telemetry is not None:
+            try:
+                telemetry.close()
+            except:
+                print('The radio failed to close.')
+
+        #Make sure the heater is left off.
+        try:
+            thermostat.stop()
+        except:
+            print('The heater failed while stopping.')
+
+        try:
+            metrics.dump()
+        except:
+            print('The metrics could not be written.')
+
+        #Marks the journal as closed cleanly, so this run is not "recovered" next time.
+        try:
+            journal.close()
+        except:
+            print('The journal failed to close.')
+
         print('Payload was recovered safely at', asctime())
         for i in range(5):
             #blinky(comfort_led, 0.2)
@@ -139,7 +316,18 @@ def main():
         #Put this at the end, ding-dong. You know, AFTER all the GPIO operations.
         GPIO.cleanup()
 
-        system('mv *.txt data/')
-        system('mv *.jpg pictures/')
+        #Every data file (and segment, and index) has _data_ in its name.
+        system('mv *_data_* data/')
+
 
-main()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='The balloon payload flight controller.')
+    parser.add_argument('--runtime', choices=['schedule', 'async', 'process'], default='schedule',
+                        help='how to run the sensors (default: schedule)')
+    parser.add_argument('--metrics', action='store_true',
+                        help='print the timing summary once a minute')
+    parser.add_argument('--burst', type=float, metavar='HZ',
+                        help='also sample the light channel continuously at this rate (default: the config)')
+    parser.add_argument('--config', help='the flight config file (default: flight_config.json)')
+    args = parser.parse_args()
+    main(args.runtime, args.metrics, args.burst, args.config)
@@ -0,0 +1,460 @@
+#!/usr/bin/python3
+'''
+Loads a flight's data files into numpy arrays for the analysis.
+
+Every *_data_* file in a flight directory is read: plain text, the
+compressed segments and binary files. The files the journal rebuilt
+(*_data_recovered_*) repeat the originals, so only what they have from
+after a sensor's last record is kept, i.e. the batch the power cut lost.
+Each sensor becomes one Stream, with its times as seconds since the
+epoch and its fields as columns of floats (NaN where there was no
+number, i.e. 'n/a' from gpsd). The "New data." headers are kept with
+the row they start at.
+
+The lines are sorted into records and headers, and the records split
+into fields, all at once rather than line by line. The timestamps are
+converted all at once too: the asctime() strings are fixed width, so the
+digits are picked out of a byte array by column. Numeric timestamps
+(seconds since the epoch) are taken as they are.
+
+    streams = flight_data.load_flight('flight_data/')
+    t, columns = flight_data.merge(streams, period=1.0)
+    plot(t, columns['Outside_temp'])
+
+load_flight() keeps what it read in flight.npz in the directory, and
+uses that instead next time unless a data file has changed since.
+
+    ./flight_data.py flight_data/ [--period 1.0] [--out merged.csv]
+'''
+
+import argparse
+import glob
+import io
+import json
+import os
+from time import localtime
+
+import numpy as np
+
+import records
+from logwriter import read_segment
+
+
+CACHE_NAME = 'flight.npz'
+
+_MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+#What a record line starts with: an asctime() weekday and a space, or a
+#number and a comma.
+_WEEKDAYS = ['Mon ', 'Tue ', 'Wed ', 'Thu ', 'Fri ', 'Sat ', 'Sun ']
+_NUMBER_START = list('-0123456789.')
+
+
+class Stream(object):
+    #######################################################
+    '''
+    Stream(string, array, 2-d array, list, list) -> stream object
+
+    --name:     The sensor name.
+    --times:    Seconds since the epoch, one per record.
+    --values:   A row of floats per record, a column per field.
+    --columns:  The field names.
+    --headers:  (row, dictionary) for every "New data." block: the row
+                    it starts at, and what its header said.
+
+    stream['reading'] (or whichever column) gives one column.
+    '''
+    #######################################################
+
+    def __init__(self, name, times, values, columns, headers=()):
+        self.name = name
+        self.times = times
+        self.values = values
+        self.columns = list(columns)
+        self.headers = list(headers)
+
+    def __getitem__(self, column):
+        return self.values[:, self.columns.index(column)]
+
+    def __len__(self):
+        return len(self.times)
+
+
+def _days_from_civil(year, month, day):
+    #Days since 1970-01-01 for a proleptic Gregorian date, for whole arrays.
+    year = year - (month <= 2)
+    era = np.floor_divide(year, 400)
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def parse_asctime(stamps):
+    #----------------------------------------
+    '''
+    parse_asctime(array of strings) -> array of floats
+
+    Turns asctime() strings ('Mon Aug 21 10:00:00 2017', local time)
+    into seconds since the epoch, without a Python loop over them.
+    '''
+    #----------------------------------------
+
+    stamps = np.asarray(stamps, dtype='S24')
+    if not len(stamps):
+        return np.zeros(0)
+    chars = stamps.view(np.uint8).reshape(-1, 24).astype(np.int64)
+
+    def number(first, last):
+        digits = chars[:, first:last]
+        #The day of the month is padded with a space, not a zero.
+        digits = np.where(digits == ord(' '), ord('0'), digits) - ord('0')
+        return (digits * 10 ** np.arange(last - first - 1, -1, -1)).sum(axis=1)
+
+    #The month's three letters, as one number to look up.
+    codes = (chars[:, 4] << 16) | (chars[:, 5] << 8) | chars[:, 6]
+    months = np.zeros(len(stamps), dtype=np.int64)
+    for month, name in enumerate(_MONTHS, 1):
+        months[codes == int.from_bytes(name.encode(), 'big')] = month
+
+    days = _days_from_civil(number(20, 24), months, number(8, 10))
+    naive = days * 86400 + number(11, 13) * 3600 + number(14, 16) * 60 + number(17, 19)
+
+    #From local time to UTC. The offset only changes on the hour (if ever in
+    #one flight), so it is looked up once for each hour there is.
+    hours, where = np.unique(naive // 3600, return_inverse=True)
+    offsets = np.array([_utc_offset(hour * 3600) for hour in hours])
+
+    return (naive - offsets[where]).astype(np.float64)
+
+
+def _utc_offset(naive):
+    #How far ahead of UTC local time was, at a local time given as if UTC.
+    naive = int(naive)
+    return localtime(naive - localtime(naive).tm_gmtoff).tm_gmtoff
+
+
+def parse_iso(values):
+    #----------------------------------------
+    '''
+    parse_iso(array of strings) -> array of floats
+
+    gpsd's ISO 8601 times (2017-08-21T17:30:00.000Z) as seconds since
+    the epoch, with NaN for anything else.
+    '''
+    #----------------------------------------
+
+    values = np.char.rstrip(np.asarray(values, dtype=str), 'Z')
+    good = np.char.count(values, 'T') == 1
+    result = np.full(len(values), np.nan)
+    if good.any():
+        stamps = values[good].astype('datetime64[ms]')
+        result[good] = (stamps - np.datetime64(0, 'ms')).astype(np.float64) / 1000
+
+    return result
+
+
+def _column(values):
+    #One column of strings to floats, trying a plain conversion first.
+    try:
+        return values.astype(np.float64)
+    except ValueError:
+        pass
+    iso = parse_iso(values)
+    if np.isfinite(iso).any():
+        return iso
+    numbers = np.char.replace(values, 'None', 'nan')
+    numbers = np.where(np.char.strip(numbers) == '', 'nan', numbers)
+    try:
+        return numbers.astype(np.float64)
+    except ValueError:
+        return np.array([records._number(value) for value in values])
+
+
+def _spread(times):
+    #asctime() only goes to the second. Spread each run of records that
+    #share one evenly across it.
+    if not len(times):
+        return times
+    starts = np.r_[0, np.flatnonzero(np.diff(times)) + 1]
+    lengths = np.diff(np.r_[starts, len(times)])
+    position = np.arange(len(times)) - np.repeat(starts, lengths)
+    return times + position / np.repeat(lengths, lengths)
+
+
+def read_text(text, spread=True):
+    #----------------------------------------
+    '''
+    read_text(string, spread=True) -> (list of headers, array of times, 2-d array of strings)
+
+    Splits the contents of a text data file into its headers (as in
+    Stream), the record times, and the fields. With spread, records
+    that share an asctime() second are spread out across it.
+    '''
+    #----------------------------------------
+
+    lines = np.array(text.splitlines())
+    if not len(lines):
+        return [], np.zeros(0), np.zeros((0, 0), dtype=str)
+    is_record = (np.isin(lines.astype('U4'), _WEEKDAYS)
+                 | (np.isin(lines.astype('U1'), _NUMBER_START) & (np.char.find(lines, ',') > 0)))
+
+    #Only the few lines that are not records are looked at one by one. A
+    #header goes with the record after it, so one with none after it (or
+    #one straight after another) is dropped.
+    before = np.cumsum(is_record)
+    count = int(before[-1])
+    found = {}
+    header = None
+    for i in np.flatnonzero(~is_record):
+        line = str(lines[i])
+        if line == 'New data.':
+            header = found[int(before[i])] = {}
+        elif header is not None and found.get(int(before[i])) is header and ': ' in line:
+            key, _, value = line.partition(': ')
+            try:
+                header[key.lower()] = json.loads(value)
+            except ValueError:
+                header[key.lower()] = value
+    headers = [(row, header) for row, header in found.items() if row < count]
+
+    if not count:
+        return headers, np.zeros(0), np.zeros((0, 0), dtype=str)
+
+    #Every record with the same number of fields is the usual case: then
+    #they are split in one go. Otherwise the short ones are padded.
+    lines = lines[is_record]
+    commas = np.char.count(lines, ',')
+    if (commas == commas[0]).all():
+        table = np.array(','.join(lines.tolist()).split(',')).reshape(count, -1)
+    else:
+        width = int(commas.max()) + 1
+        table = np.array([row + [''] * (width - len(row)) for row in (line.split(',') for line in lines.tolist())])
+    stamps, rows = table[:, 0], table[:, 1:]
+
+    if stamps[0][:1].isdigit() or stamps[0][:1] == '-':
+        times = stamps.astype(np.float64)
+    else:
+        times = parse_asctime(stamps)
+        if spread:
+            times = _spread(times)
+
+    return headers, times, rows
+
+
+def _columns(count):
+    #The field names, going by how many fields there are.
+    for kind, (format, names) in records.KINDS.items():
+        if len(names) - 1 == count:
+            return names[1:]
+    return ['field_%d' % i for i in range(count)]
+
+
+def load_file(file_name, spread=True):
+    #----------------------------------------
+    '''
+    load_file(string, spread=True) -> Stream
+
+    Reads one data file or segment, text or binary, compressed or not.
+    '''
+    #----------------------------------------
+
+    name = os.path.basename(file_name).split('_data_')[0]
+    data = read_segment(file_name)
+
+    if '.bin' in os.path.basename(file_name):
+        headers = []
+        rows = []
+        columns = []
+        block = None
+        for header, record in records.read_records(io.BytesIO(data)):
+            if header is not block:
+                headers.append((len(rows), {key: value for key, value in header.items()
+                                            if key not in records._BLOCK_FIELDS}))
+                block = header
+                columns = header['fields'][1:]
+            rows.append(record)
+        #A header and no records (a segment started just before the end, or a
+        #sensor that never logged) has nothing to reshape.
+        if not rows:
+            return Stream(name, np.zeros(0), np.zeros((0, len(columns))), columns, headers)
+        rows = np.array(rows, dtype=np.float64)
+        return Stream(name, rows[:, 0], rows[:, 1:], columns, headers)
+
+    headers, times, fields = read_text(data.decode(), spread)
+    values = np.column_stack([_column(fields[:, i]) for i in range(fields.shape[1])]) \
+        if len(times) else np.zeros((0, 0))
+
+    return Stream(name, times, values, _columns(values.shape[1]), headers)
+
+
+def _data_files(directory):
+    names = []
+    for file_name in sorted(glob.glob(os.path.join(directory, '*_data_*'))):
+        base = os.path.basename(file_name)
+        if base.startswith('Metrics_') or base.endswith('.index') or base == CACHE_NAME:
+            continue
+        if base.endswith(('.txt', '.bin', '.gz', '.xz')):
+            names.append(file_name)
+    return names
+
+
+def _join(name, streams):
+    #One sensor's files and segments, in time order, as one stream.
+    streams = sorted((s for s in streams if len(s)), key=lambda s: s.times[0])
+    if not streams:
+        return Stream(name, np.zeros(0), np.zeros((0, 0)), [])
+    width = max(s.values.shape[1] for s in streams)
+    headers = []
+    row = 0
+    for s in streams:
+        headers += [(row + start, header) for start, header in s.headers]
+        row += len(s)
+    values = np.vstack([np.pad(s.values, ((0, 0), (0, width - s.values.shape[1])),
+                               constant_values=np.nan) for s in streams])
+    columns = max((s.columns for s in streams), key=len)
+
+    return Stream(name, np.concatenate([s.times for s in streams]), values, columns, headers)
+
+
+def _after(extra, stream):
+    #The records of extra (the journal's copy of a sensor) from after the
+    #last second of stream (the sensor's own files). The text files only go
+    #to the second, so that last second is taken from the sensor's files.
+    if not len(stream) or not len(extra):
+        return extra
+    keep = np.floor(extra.times) > np.floor(stream.times.max())
+    before = np.r_[0, np.cumsum(keep)]
+    #A header goes with the first record kept after it; of several, the last.
+    headers = dict((int(before[row]), header) for row, header in extra.headers if before[row] < keep.sum())
+
+    return Stream(extra.name, extra.times[keep], extra.values[keep], extra.columns, list(headers.items()))
+
+
+def load_flight(directory, cache=True, spread=True):
+    #----------------------------------------
+    '''
+    load_flight(string, cache=True, spread=True) -> dictionary of Streams
+
+    Reads every data file in the flight directory, one Stream per
+    sensor. With cache, the result is saved in flight.npz, and that is
+    loaded instead as long as no data file is newer and none has come
+    or gone.
+    '''
+    #----------------------------------------
+
+    files = _data_files(directory)
+    cache_name = os.path.join(directory, CACHE_NAME)
+    if cache and os.path.exists(cache_name):
+        newest = max([os.path.getmtime(f) for f in files] or [0])
+        if os.path.getmtime(cache_name) >= newest:
+            streams = _load_cache(cache_name, [os.path.basename(f) for f in files])
+            if streams is not None:
+                return streams
+
+    by_sensor = {}
+    recovered = {}
+    for file_name in files:
+        stream = load_file(file_name, spread)
+        found = recovered if '_data_recovered_' in os.path.basename(file_name) else by_sensor
+        found.setdefault(stream.name, []).append(stream)
+    streams = {}
+    for name in sorted(set(by_sensor) | set(recovered)):
+        streams[name] = _join(name, by_sensor.get(name, []))
+        if name in recovered:
+            streams[name] = _join(name, [streams[name], _after(_join(name, recovered[name]), streams[name])])
+
+    if cache:
+        _save_cache(cache_name, streams, [os.path.basename(f) for f in files])
+
+    return streams
+
+
+def _save_cache(cache_name, streams, files):
+    arrays = {'files': np.array(json.dumps(files))}
+    for i, (name, stream) in enumerate(streams.items()):
+        arrays['times_%d' % i] = stream.times
+        arrays['values_%d' % i] = stream.values
+        arrays['meta_%d' % i] = np.array(json.dumps({'name': name, 'columns': stream.columns,
+                                                     'headers': stream.headers}))
+    #Written under another name first, so a half-written cache is never read.
+    with open(cache_name + '.part', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(cache_name + '.part', cache_name)
+
+
+def _load_cache(cache_name, files):
+    with np.load(cache_name) as arrays:
+        if json.loads(str(arrays['files'])) != files:
+            return None
+        streams = {}
+        i = 0
+        while 'meta_%d' % i in arrays:
+            meta = json.loads(str(arrays['meta_%d' % i]))
+            streams[meta['name']] = Stream(meta['name'], arrays['times_%d' % i], arrays['values_%d' % i],
+                                           meta['columns'], [tuple(h) for h in meta['headers']])
+            i += 1
+
+    return streams
+
+
+def merge(streams, period=1.0, start=None, end=None):
+    #----------------------------------------
+    '''
+    merge(dictionary of Streams, period=1.0, start=None, end=None) -> (array, dictionary of arrays)
+
+    Puts every stream on one time base, every period seconds from start
+    to end (by default, the first record of any stream to the last), by
+    interpolating each column between its neighbouring records. Outside
+    a stream's own records, and across its missing values, it is NaN.
+
+    A one-column stream is named after its sensor; otherwise the columns
+    are named 'sensor.column', i.e. 'GPS.alt'.
+    '''
+    #----------------------------------------
+
+    found = [s for s in streams.values() if len(s)]
+    if start is None:
+        start = min(s.times[0] for s in found)
+    if end is None:
+        end = max(s.times[-1] for s in found)
+    t = np.arange(start, end + period / 2, period)
+
+    merged = {}
+    for stream in found:
+        order = np.argsort(stream.times, kind='stable')
+        times = stream.times[order]
+        for i, column in enumerate(stream.columns):
+            values = stream.values[order, i]
+            good = np.isfinite(values)
+            name = stream.name if len(stream.columns) == 1 else stream.name + '.' + column
+            if good.sum() < 1:
+                merged[name] = np.full(len(t), np.nan)
+                continue
+            merged[name] = np.interp(t, times[good], values[good], left=np.nan, right=np.nan)
+
+    return t, merged
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load a flight and put every sensor on one time base.')
+    parser.add_argument('directory', help='the flight data directory')
+    parser.add_argument('--period', type=float, default=1.0, help='seconds between merged rows')
+    parser.add_argument('--out', help='write the merged data to this CSV file')
+    parser.add_argument('--no-cache', action='store_true', help='do not read or write flight.npz')
+    args = parser.parse_args()
+
+    streams = load_flight(args.directory, cache=not args.no_cache)
+    for name, stream in streams.items():
+        print('%-16s %8d records  %s' % (name, len(stream), ', '.join(stream.columns)))
+
+    if args.out:
+        t, merged = merge(streams, args.period)
+        names = sorted(merged)
+        table = np.column_stack([t] + [merged[name] for name in names])
+        np.savetxt(args.out, table, delimiter=',', header=','.join(['time'] + names), comments='')
+        print(len(t), 'rows to', args.out)
+
+
+if __name__ == '__main__':
+    main()
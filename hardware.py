@@ -0,0 +1,841 @@
+#!/usr/bin/python3
+'''
+Hardware backends for the flight controller.
+
+Everything in fl_objects_2 talks to the GPIO header, the camera and the
+GPS daemon through the backend returned by get_backend(). On the Pi that
+is the RPiBackend, which just hands out RPi.GPIO, picamera and gps3. On a
+dev box you can use the SimBackend instead, which fakes all of it well
+enough to run (and time) the whole flight loop:
+
+    --SimGPIO:          stands in for RPi.GPIO.
+    --VirtualMCP3008:   answers the bit-banged protocol in
+                            BitBangTransport.convert() with scripted voltages.
+    --FakeSpiDev:       puts a VirtualMCP3008 behind a spidev-style interface.
+    --PulseGenerator:   drives falling edges into a CountSensor pin.
+    --FakeGPSD:         a local socket that speaks enough of the gpsd JSON
+                            protocol for the GPS class, and can replay a
+                            recorded gpsd JSON or NMEA log.
+    --FakeCamera:       writes placeholder pictures and videos, taking
+                            about as long as the real thing.
+    --serial_port():    hands out one end of a pseudo-terminal pair in
+                            place of the radio's serial port.
+
+Pick the backend by setting BALLOONSAT_BACKEND=sim (or rpi, the default)
+in the environment, or by calling set_backend() before any sensors are
+made.
+'''
+
+import json
+import os
+import random
+import socket
+import threading
+from time import time, sleep, gmtime, strftime
+
+
+class Backend(object):
+    #######################################################
+    '''
+    The things a backend has to hand out. The sensor classes never
+    import hardware libraries themselves; they ask for them here.
+    '''
+    #######################################################
+
+    name = 'none'
+
+    @property
+    def gpio(self):
+        raise NotImplementedError
+
+    def camera(self):
+        raise NotImplementedError
+
+    def spidev(self):
+        raise NotImplementedError
+
+    def start_gpsd(self, device):
+        raise NotImplementedError
+
+    def gps_socket(self):
+        raise NotImplementedError
+
+    def serial_port(self, device):
+        raise NotImplementedError
+
+
+class RPiBackend(Backend):
+    #######################################################
+    '''
+    RPiBackend() -> backend object
+
+    The real hardware. The libraries are imported the first time they
+    are needed, so a missing picamera does not stop the ADC from working.
+    '''
+    #######################################################
+
+    name = 'rpi'
+
+    def __init__(self):
+        self._gpio = None
+
+    @property
+    def gpio(self):
+        if self._gpio is None:
+            import RPi.GPIO as GPIO
+            #All classes in fl_objects_2 use the board numbering system.
+            GPIO.setmode(GPIO.BOARD)
+            self._gpio = GPIO
+        return self._gpio
+
+    def camera(self):
+        import picamera
+        return picamera.PiCamera()
+
+    def spidev(self):
+        import spidev
+        return spidev.SpiDev()
+
+    def start_gpsd(self, device):
+        os.system('gpsd ' + device)
+
+    def gps_socket(self):
+        from gps3 import agps3
+        return agps3.GPSDSocket()
+
+    def serial_port(self, device):
+        return device
+
+
+class SimGPIO(object):
+    #######################################################
+    '''
+    SimGPIO() -> fake RPi.GPIO module
+
+    Keeps a level for every pin. Devices (see VirtualMCP3008 and
+    PulseGenerator) watch the pins the program drives and drive the pins
+    the program reads. Edge callbacks are run in the thread that caused
+    the edge, much like RPi.GPIO runs them in its own callback thread.
+    '''
+    #######################################################
+
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self.mode = None
+        self.levels = {}
+        self.directions = {}
+        self._listeners = {}
+        self._callbacks = {}
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=PUD_OFF, initial=None):
+        self.directions[pin] = direction
+        if initial is not None:
+            self.levels[pin] = int(bool(initial))
+        elif pin not in self.levels:
+            self.levels[pin] = 1 if pull_up_down == self.PUD_UP else 0
+
+    def output(self, pin, value):
+        value = int(bool(value))
+        self.levels[pin] = value
+        for listener in self._listeners.get(pin, ()):
+            listener(pin, value)
+
+    def input(self, pin):
+        return self.levels.get(pin, 0)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self._callbacks[pin] = [edge, []]
+        if callback is not None:
+            self._callbacks[pin][1].append(callback)
+
+    def add_event_callback(self, pin, callback):
+        self._callbacks[pin][1].append(callback)
+
+    def remove_event_detect(self, pin):
+        self._callbacks.pop(pin, None)
+
+    def cleanup(self, *pins):
+        for pin in (pins or list(self.directions)):
+            self.directions.pop(pin, None)
+            self._callbacks.pop(pin, None)
+
+    #The rest is for the simulated devices, not the flight code.
+
+    def listen(self, pin, listener):
+        #----------------------------------------
+        '''
+        listen(pin, function)
+
+        Calls function(pin, level) every time the program drives the pin.
+        '''
+        #----------------------------------------
+
+        self._listeners.setdefault(pin, []).append(listener)
+
+    def drive(self, pin, value):
+        #----------------------------------------
+        '''
+        drive(pin, level)
+
+        Sets the level of an input pin from outside the program and fires
+        any edge callbacks that were registered for it.
+        '''
+        #----------------------------------------
+
+        value = int(bool(value))
+        old = self.levels.get(pin, 0)
+        self.levels[pin] = value
+        if old == value or pin not in self._callbacks:
+            return
+
+        edge, callbacks = self._callbacks[pin]
+        if (edge == self.BOTH or (edge == self.FALLING and not value)
+                or (edge == self.RISING and value)):
+            for callback in callbacks:
+                callback(pin)
+
+
+class VirtualMCP3008(object):
+    #######################################################
+    '''
+    VirtualMCP3008(SimGPIO, float, CLK, Dout, Din, CS, dict) -> fake ADC
+
+    --Vref:     The reference voltage, same as the real chip.
+    --voltages: {channel: source}, where a source is a number, a function
+                    of time that returns a number, or an iterable of
+                    numbers (the last one is held once it runs out).
+
+    Answers the bit-banged conversation in BitBangTransport.convert(): a
+    start bit, four command bits, one sample clock, then ten data bits MSB
+    first, each put on Dout on the falling edge of the clock. Give None
+    for the pins if the chip is only reached through a FakeSpiDev.
+    '''
+    #######################################################
+
+    def __init__(self, gpio, Vref, CLK, Dout, Din, CS, voltages=None):
+        self.gpio = gpio
+        self.Vref = Vref
+        self.CLK = CLK
+        self.Dout = Dout
+        self.Din = Din
+        self.CS = CS
+
+        self._sources = {}
+        self._held = {}
+        for channel, source in (voltages or {}).items():
+            self.set_voltage(channel, source)
+
+        self.conversions = 0
+        self._reset()
+        if gpio is not None:
+            gpio.listen(CLK, self._on_clk)
+            gpio.listen(CS, self._on_cs)
+
+    def set_voltage(self, channel, source):
+        #----------------------------------------
+        '''
+        set_voltage(channel #, source)
+
+        Scripts the voltage on one of the eight input channels.
+        '''
+        #----------------------------------------
+
+        if not callable(source) and not isinstance(source, (int, float)):
+            source = iter(source)
+        self._sources[channel] = source
+
+    def voltage(self, channel):
+        #----------------------------------------
+        '''
+        voltage(channel #) -> float
+
+        The voltage on the channel right now.
+        '''
+        #----------------------------------------
+
+        source = self._sources.get(channel, 0.0)
+        if isinstance(source, (int, float)):
+            return source
+        if callable(source):
+            return source(time())
+        self._held[channel] = next(source, self._held.get(channel, 0.0))
+        return self._held[channel]
+
+    def convert(self, channel):
+        #----------------------------------------
+        '''
+        convert(channel #) -> integer
+
+        Does one conversion and returns the 10-bit code.
+        '''
+        #----------------------------------------
+
+        self.conversions += 1
+        code = int(round(self.voltage(channel) / self.Vref * 1023))
+        return min(max(code, 0), 1023)
+
+    def _reset(self):
+        self._started = False
+        self._command = []
+        self._clocks = 0
+        self._code = 0
+
+    def _on_cs(self, pin, level):
+        #Raising CS ends the conversation; lowering it starts a new one.
+        self._reset()
+        if level:
+            self.gpio.levels[self.Dout] = 0
+
+    def _on_clk(self, pin, level):
+        if self.gpio.levels.get(self.CS, 1):
+            return
+
+        #Rising edge: shift in Din, then count the clocks after the command.
+        if level:
+            if not self._started:
+                self._started = bool(self.gpio.levels.get(self.Din, 0))
+            elif len(self._command) < 4:
+                self._command.append(self.gpio.levels.get(self.Din, 0))
+            else:
+                self._clocks += 1
+            return
+
+        #Falling edge: the sample clock latches the code and puts out the
+        #null bit; the next ten put out the code, MSB first.
+        if self._clocks == 0:
+            return
+        if self._clocks == 1:
+            single, d2, d1, d0 = self._command
+            self._code = self.convert((d2 << 2) | (d1 << 1) | d0)
+            bit = 0
+        elif self._clocks <= 11:
+            bit = (self._code >> (11 - self._clocks)) & 1
+        else:
+            bit = 0
+        self.gpio.levels[self.Dout] = bit
+
+
+class FakeSpiDev(object):
+    #######################################################
+    '''
+    FakeSpiDev(dict) -> fake spidev.SpiDev
+
+    --chips:    {(port, device): VirtualMCP3008}
+
+    Has the parts of spidev.SpiDev that SpiTransport uses. xfer2() answers
+    the three-byte MCP3008 conversation from whichever chip was opened.
+    '''
+    #######################################################
+
+    def __init__(self, chips):
+        self.chips = chips
+        self.chip = None
+        self.max_speed_hz = 500000
+        self.mode = 0
+
+    def open(self, port, device):
+        self.chip = self.chips[(port, device)]
+
+    def xfer2(self, data):
+        #The start bit is the last bit of the first byte, and the command
+        #is the top nibble of the second.
+        reply = [0] * len(data)
+        if len(data) >= 3 and data[0] & 1:
+            code = self.chip.convert((data[1] >> 4) & 7)
+            reply[1] = (code >> 8) & 3
+            reply[2] = code & 0xff
+        return reply
+
+    def close(self):
+        self.chip = None
+
+
+class PulseGenerator(object):
+    #######################################################
+    '''
+    PulseGenerator(SimGPIO, pin, rate, poisson=True) -> pulse source
+
+    --rate:     Pulses per second, or a function of time that returns
+                    pulses per second.
+    --poisson:  Random (Geiger-like) spacing if True, even spacing if not.
+
+    Pulls the pin low and back high on its own thread, which fires the
+    FALLING callbacks a CountSensor registers.
+    '''
+    #######################################################
+
+    def __init__(self, gpio, pin, rate, poisson=True, width=0.0001):
+        self.gpio = gpio
+        self.pin = pin
+        self.rate = rate
+        self.poisson = poisson
+        self.width = width
+        self.pulses = 0
+        self._running = False
+        self._thread = None
+        gpio.levels[pin] = 1
+
+    def _rate(self):
+        return self.rate(time()) if callable(self.rate) else self.rate
+
+    def _run(self):
+        while self._running:
+            rate = self._rate()
+            if rate <= 0:
+                sleep(0.01)
+                continue
+            if self.poisson:
+                sleep(random.expovariate(rate))
+            else:
+                sleep(1 / rate)
+            self.gpio.drive(self.pin, 0)
+            self.pulses += 1
+            sleep(self.width)
+            self.gpio.drive(self.pin, 1)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+
+
+class FakeGPSD(object):
+    #######################################################
+    '''
+    FakeGPSD(fixes, port=0, rate=1.0) -> fake GPS daemon
+
+    --fixes:    A list of TPV dicts that are sent in turn (the last one
+                    repeats), or a function of time that returns one.
+    --port:     TCP port on 127.0.0.1. 0 picks a free one; see self.port.
+    --rate:     TPV reports per second.
+
+    Sends a VERSION message when a client connects and TPV reports once
+    it has asked to ?WATCH, which is all agps3 ever does. Use replay()
+    to send the fixes from a recorded log instead.
+    '''
+    #######################################################
+
+    def __init__(self, fixes, port=0, rate=1.0):
+        self.fixes = fixes
+        self.rate = rate
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(('127.0.0.1', port))
+        self.port = self._server.getsockname()[1]
+        self._running = False
+
+    @classmethod
+    def replay(cls, log_name, port=0, rate=1.0):
+        #----------------------------------------
+        '''
+        replay(string, port=0, rate=1.0) -> fake GPS daemon
+
+        Serves the fixes in a recorded log: gpsd JSON (as gpspipe -w
+        saves it) or raw NMEA from the receiver, or a mix.
+        '''
+        #----------------------------------------
+
+        with open(log_name) as log:
+            return cls(read_gps_log(log), port, rate)
+
+    def _fix(self, index):
+        if callable(self.fixes):
+            fix = dict(self.fixes(time()))
+        else:
+            fix = dict(self.fixes[min(index, len(self.fixes) - 1)])
+        fix.setdefault('class', 'TPV')
+        return fix
+
+    def _serve(self, client):
+        try:
+            version = {'class': 'VERSION', 'release': 'fake', 'proto_major': 3, 'proto_minor': 11}
+            client.sendall((json.dumps(version) + '\n').encode())
+            client.settimeout(None)
+            request = client.recv(1024)
+            if b'?WATCH' not in request:
+                return
+            index = 0
+            while self._running:
+                client.sendall((json.dumps(self._fix(index)) + '\n').encode())
+                index += 1
+                sleep(1 / self.rate)
+        except OSError:
+            pass
+        finally:
+            client.close()
+
+    def _accept(self):
+        while self._running:
+            try:
+                client, address = self._server.accept()
+            except OSError:
+                break
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def start(self):
+        self._running = True
+        self._server.listen(4)
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def stop(self):
+        self._running = False
+        self._server.close()
+
+
+class GPSDClient(object):
+    #######################################################
+    '''
+    GPSDClient(port=2947) -> socket object
+
+    A small stand-in for agps3.GPSDSocket, so the simulator does not need
+    gps3 installed. Iterating over it yields one JSON line at a time,
+    None if nothing came in before the timeout, or '' once gpsd has
+    closed the socket (as agps3's readline() does).
+    '''
+    #######################################################
+
+    def __init__(self, port=2947):
+        self.port = port
+        self.streamSock = None
+        self._buffer = b''
+
+    def connect(self, host='127.0.0.1', port=None):
+        self.streamSock = socket.create_connection((host, port or self.port))
+
+    def watch(self, enable=True, gpsd_protocol='json', devicepath=None):
+        command = '?WATCH={"enable":true,"json":true}' if enable else '?WATCH={"enable":false}'
+        self.streamSock.sendall(command.encode())
+
+    def next(self, timeout=0):
+        if b'\n' not in self._buffer:
+            self.streamSock.settimeout(timeout or None)
+            try:
+                chunk = self.streamSock.recv(4096)
+            except socket.timeout:
+                return None
+            if not chunk:
+                return ''
+            self._buffer += chunk
+        if b'\n' not in self._buffer:
+            return None
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        return line.decode()
+
+    def __iter__(self):
+        return self
+
+    __next__ = next
+
+    def close(self):
+        if self.streamSock is not None:
+            self.streamSock.close()
+            self.streamSock = None
+
+
+class FakeCamera(object):
+    #######################################################
+    '''
+    FakeCamera(still_latency=0.6, still_bytes=65536, bitrate=2000000) -> camera
+
+    Has the parts of the picamera.PiCamera interface the Camera class
+    uses. Stills take still_latency seconds and write still_bytes of
+    placeholder; videos grow at bitrate bits per second while recording.
+    '''
+    #######################################################
+
+    def __init__(self, still_latency=0.6, still_bytes=65536, bitrate=2000000):
+        self.still_latency = still_latency
+        self.still_bytes = still_bytes
+        self.bitrate = bitrate
+        self.resolution = (2592, 1944)
+        self.framerate = 30
+        self.closed = False
+        self._video = None
+        self._video_start = None
+
+    def capture(self, output, format=None, use_video_port=False, **options):
+        #The video port is quicker, but no faster than a frame.
+        sleep(1 / self.framerate if use_video_port else self.still_latency)
+        with open(output, 'wb') as picture:
+            picture.write(b'\xff\xd8\xff\xe0' + bytes(self.still_bytes - 6) + b'\xff\xd9')
+
+    @property
+    def recording(self):
+        return self._video is not None
+
+    def _fill_video(self):
+        now = time()
+        self._video.write(bytes(int((now - self._video_start) * self.bitrate / 8)))
+        self._video_start = now
+
+    def start_recording(self, output, format=None, **options):
+        self._video = open(output, 'wb')
+        self._video_start = time()
+
+    def wait_recording(self, timeout=0):
+        sleep(timeout)
+        self._fill_video()
+
+    def split_recording(self, output, **options):
+        self._fill_video()
+        self._video.close()
+        self._video = open(output, 'wb')
+
+    def stop_recording(self):
+        self._fill_video()
+        self._video.close()
+        self._video = None
+
+    def close(self):
+        if self._video is not None:
+            self.stop_recording()
+        self.closed = True
+
+
+class SimBackend(Backend):
+    #######################################################
+    '''
+    SimBackend() -> backend object
+
+    Fake hardware for the dev box. Add devices with the add_*() methods;
+    bench() builds the wiring that flight_controller_2.main() expects.
+    '''
+    #######################################################
+
+    name = 'sim'
+
+    def __init__(self, gps_fixes=None, gps_rate=1.0, camera_options=None):
+        self._gpio = SimGPIO()
+        self.chips = []
+        self.spi_chips = {}
+        self.pulse_generators = []
+        self.gps_fixes = gps_fixes or [bench_fix(0)]
+        self.gps_rate = gps_rate
+        self.gpsd = None
+        self.camera_options = camera_options or {}
+        self.cameras = []
+        self.serial_ports = {}
+
+    @classmethod
+    def bench(cls):
+        #----------------------------------------
+        '''
+        bench() -> backend object
+
+        An ADC on the pins main() uses, reading a comfortable day on the
+        ground: 21 C inside, 15 C outside, bright light, 1013 mbar. The
+        same chip also answers on SPI port 0, device 0.
+        '''
+        #----------------------------------------
+
+        sim = cls(gps_fixes=bench_fix)
+        chip = sim.add_mcp3008(5.09, 11, 13, 15, 16, {0: 0.6980, 1: 1.325, 2: 2.5, 3: 0.518})
+        sim.attach_spi(chip, 0, 0)
+        return sim
+
+    @property
+    def gpio(self):
+        return self._gpio
+
+    def add_mcp3008(self, Vref, CLK, Dout, Din, CS, voltages=None):
+        chip = VirtualMCP3008(self._gpio, Vref, CLK, Dout, Din, CS, voltages)
+        self.chips.append(chip)
+        return chip
+
+    def attach_spi(self, chip, port=0, device=0):
+        self.spi_chips[(port, device)] = chip
+
+    def spidev(self):
+        return FakeSpiDev(self.spi_chips)
+
+    def add_pulse_generator(self, pin, rate, poisson=True):
+        generator = PulseGenerator(self._gpio, pin, rate, poisson)
+        self.pulse_generators.append(generator)
+        return generator
+
+    def camera(self):
+        camera = FakeCamera(**self.camera_options)
+        self.cameras.append(camera)
+        return camera
+
+    def start_gpsd(self, device):
+        #Like running gpsd again: it starts one if the last has stopped.
+        if self.gpsd is None or not self.gpsd._running:
+            self.gpsd = FakeGPSD(self.gps_fixes, rate=self.gps_rate)
+            self.gpsd.start()
+
+    def gps_socket(self):
+        return GPSDClient(self.gpsd.port if self.gpsd else 2947)
+
+    def serial_port(self, device):
+        #The other end (the "ground") is self.serial_ports[device], to read
+        #what was sent. Nobody reads it unless you do, so it fills up like a
+        #radio that has stopped taking bytes.
+        master, slave = os.openpty()
+        os.set_blocking(master, False)
+        self.serial_ports[device] = master
+        return os.ttyname(slave)
+
+
+def nmea_to_tpv(sentence, fix):
+    #----------------------------------------
+    '''
+    nmea_to_tpv(string, dictionary) -> bool
+
+    Updates a TPV dict with one NMEA sentence, the way gpsd would. GGA
+    and RMC are understood; anything else, or a bad checksum, is ignored.
+    Returns True when the sentence ends a fix (RMC does).
+    '''
+    #----------------------------------------
+
+    body, star, checksum = sentence.strip().lstrip('$').partition('*')
+    if star:
+        total = 0
+        for character in body:
+            total ^= ord(character)
+        if '%02X' % total != checksum.upper():
+            return False
+    fields = body.split(',')
+    kind = fields[0][-3:]
+
+    def degrees(value, hemisphere, width):
+        if not value:
+            return 'n/a'
+        angle = int(value[:width]) + float(value[width:]) / 60
+        return -angle if hemisphere in ('S', 'W') else angle
+
+    def clock(value):
+        return '%s:%s:%s' % (value[0:2], value[2:4], value[4:])
+
+    if kind == 'GGA' and len(fields) > 9:
+        fix['lat'] = degrees(fields[2], fields[3], 2)
+        fix['lon'] = degrees(fields[4], fields[5], 3)
+        if fields[9]:
+            fix['alt'] = float(fields[9])
+            fix['mode'] = 3 if fields[6] not in ('', '0') else 1
+        return False
+
+    if kind == 'RMC' and len(fields) > 9:
+        if fields[2] != 'A':
+            fix['mode'] = 1
+        fix['lat'] = degrees(fields[3], fields[4], 2)
+        fix['lon'] = degrees(fields[5], fields[6], 3)
+        if fields[7]:
+            fix['speed'] = float(fields[7]) * 0.514444
+        if fields[8]:
+            fix['track'] = float(fields[8])
+        date = fields[9]
+        if date and fields[1]:
+            century = '19' if int(date[4:6]) >= 80 else '20'
+            fix['time'] = '%s%s-%s-%sT%sZ' % (century, date[4:6], date[2:4], date[0:2], clock(fields[1]))
+        return True
+
+    return False
+
+
+def read_gps_log(log):
+    #----------------------------------------
+    '''
+    read_gps_log(file) -> list of dictionaries
+
+    Reads the TPV reports out of a gpsd JSON log and/or NMEA log.
+    '''
+    #----------------------------------------
+
+    fixes = []
+    fix = {'class': 'TPV'}
+    for line in log:
+        line = line.strip()
+        if line.startswith('{'):
+            try:
+                report = json.loads(line)
+            except ValueError:
+                continue
+            if report.get('class') == 'TPV':
+                fixes.append(report)
+        elif line.startswith('$') and nmea_to_tpv(line, fix):
+            fixes.append(dict(fix))
+
+    return fixes
+
+
+def bench_fix(t):
+    #----------------------------------------
+    '''
+    bench_fix(seconds) -> dict
+
+    A TPV report for a receiver sitting still on a bench.
+    '''
+    #----------------------------------------
+
+    stamp = strftime('%Y-%m-%dT%H:%M:%S', gmtime(t)) + ('%.3fZ' % (t % 1))[1:]
+    return {'class': 'TPV', 'mode': 3, 'time': stamp, 'ept': 0.005,
+            'lat': 41.6611, 'lon': -91.5302, 'alt': 204.0,
+            'epx': 3.2, 'epy': 4.1, 'epv': 9.0, 'track': 0.0, 'speed': 0.0,
+            'climb': 0.0, 'epd': 'n/a', 'eps': 0.2, 'epc': 18.0}
+
+
+_backend = None
+
+
+def set_backend(backend):
+    #----------------------------------------
+    '''
+    set_backend(backend object or 'rpi' or 'sim')
+
+    Chooses the backend. Do this before making any sensors.
+    '''
+    #----------------------------------------
+
+    global _backend
+    if backend == 'rpi':
+        backend = RPiBackend()
+    elif backend == 'sim':
+        backend = SimBackend.bench()
+    _backend = backend
+
+
+def get_backend():
+    #----------------------------------------
+    '''
+    get_backend() -> backend object
+
+    The backend in use, picked from BALLOONSAT_BACKEND the first time.
+    '''
+    #----------------------------------------
+
+    if _backend is None:
+        set_backend(os.environ.get('BALLOONSAT_BACKEND', 'rpi'))
+    return _backend
+
+
+class _GPIOProxy(object):
+    #Lets "GPIO.output(...)" keep working while the backend picks the module.
+    def __getattr__(self, attr):
+        return getattr(get_backend().gpio, attr)
+
+
+GPIO = _GPIOProxy()
@@ -0,0 +1,333 @@
+#!/usr/bin/python3
+'''
+A write-ahead journal for the sensor data, for when the flight ends the
+way flights end: with the power cut and no finally: clause.
+
+Every record a sensor logs also goes into the journal, a file made to
+its full size ahead of time and mapped into memory. Writing a record is
+copying some bytes; the OS writes the pages out, and msync makes sure of
+it every sync_records records or sync_seconds seconds. When the file is
+full it wraps around and overwrites the oldest records.
+
+The file is a header page, then the ring. Every record in the ring is
+
+    --magic:    4 bytes, b'JRNL'.
+    --crc:      4 bytes, the CRC-32 of everything after it.
+    --sequence: 8 bytes, counting up from the first record ever written.
+    --time:     8 bytes, float64 seconds since the epoch.
+    --type:     1 byte: a data record, a log header, or a clean close.
+    --name:     1 byte of length, then the sensor name.
+    --payload:  2 bytes of length, then the record's fields, comma-
+                    delimited (or the log header, as JSON).
+
+padded to a multiple of 8 bytes. A record half-written when the power
+went, or half-overwritten by the ring, fails its CRC and is skipped.
+
+If the last run did not close the journal cleanly, the next one rebuilds
+its logs before starting. Or by hand:
+
+    ./journal.py journal.dat [--out recovered/] [--all]
+'''
+
+import argparse
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from time import time, asctime, localtime
+
+import records
+
+
+MAGIC = b'BSATJRN\x00'
+VERSION = 1
+HEADER_SIZE = mmap.PAGESIZE
+
+RECORD_MAGIC = b'JRNL'
+_RECORD = struct.Struct('<4sIQdBB')
+_PAYLOAD_LENGTH = struct.Struct('<H')
+
+#Record types.
+DATA, HEADER, CLOSE = 0, 1, 2
+
+
+class Journal(object):
+    #######################################################
+    '''
+    Journal(string, size=16 MiB, sync_records=50, sync_seconds=1.0) -> journal object
+
+    --file_name:    The journal file. It is made if it is not there, and
+                        added to (after the last record in it) if it is.
+    --size:         The size of the ring, in bytes, for a new file.
+    --sync_records: msync once this many records have gone in since the
+    --sync_seconds:     last, or once the oldest of them is this old.
+                        sync_records=1 syncs every record.
+
+    A sensor whose journal attribute is set (see Sensor in fl_objects_2.py)
+    puts every record in, through its log writer.
+    '''
+    #######################################################
+
+    def __init__(self, file_name, size=16 * 2**20, sync_records=50, sync_seconds=1.0):
+        self.file_name = file_name
+        self.sync_records = sync_records
+        self.sync_seconds = sync_seconds
+
+        new = not os.path.exists(file_name)
+        self._fd = os.open(file_name, os.O_RDWR | os.O_CREAT, 0o644)
+        if new:
+            #Have the blocks handed out now, rather than finding out the
+            #card is full halfway through a flight.
+            total = HEADER_SIZE + size
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(self._fd, 0, total)
+            else:
+                os.ftruncate(self._fd, total)
+            os.pwrite(self._fd, MAGIC + struct.pack('<IQ', VERSION, size), 0)
+            os.fsync(self._fd)
+
+        self.map = mmap.mmap(self._fd, 0)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError(file_name + ' is not a journal')
+        version, self.size = struct.unpack_from('<IQ', self.map, len(MAGIC))
+
+        #Carry on after the newest record already in the file.
+        self.clean = True
+        self.sequence = 0
+        self.offset = HEADER_SIZE
+        newest = None
+        for offset, record in _scan(self.map, self.size):
+            if newest is None or record[0] > newest[1][0]:
+                newest = (offset, record)
+        if newest is not None:
+            offset, (sequence, timestamp, kind, name, payload) = newest
+            self.clean = kind == CLOSE
+            self.sequence = sequence + 1
+            self.offset = offset + _length(name.encode(), payload.encode())
+
+        self.records = 0
+        self.syncs = 0
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._pending_since = None
+        self._dirty = None
+
+
+    def append(self, name, timestamp, fields, kind=DATA):
+        #----------------------------------------
+        '''
+        append(string, float, list or string, kind=DATA) -> integer
+
+        Puts a record in the journal and returns its sequence number.
+        '''
+        #----------------------------------------
+
+        if not isinstance(fields, str):
+            fields = ','.join(str(field) for field in fields)
+        name = name.encode()
+        payload = fields.encode()
+        length = _length(name, payload)
+
+        with self._lock:
+            sequence = self.sequence
+            self.sequence += 1
+
+            #Wrap around if it does not fit before the end.
+            if self.offset + length > HEADER_SIZE + self.size:
+                self._sync()
+                self.offset = HEADER_SIZE
+
+            body = (struct.pack('<QdBB', sequence, timestamp, kind, len(name)) + name
+                    + _PAYLOAD_LENGTH.pack(len(payload)) + payload)
+            data = RECORD_MAGIC + struct.pack('<I', zlib.crc32(body)) + body
+            start = self.offset
+            self.map[start:start + len(data)] = data
+            self.offset = start + length
+
+            low, high = self._dirty or (start, start)
+            self._dirty = (min(low, start), max(high, self.offset))
+            self.records += 1
+            if not self._pending:
+                self._pending_since = time()
+            self._pending += 1
+            if self._pending >= self.sync_records or time() - self._pending_since >= self.sync_seconds:
+                self._sync()
+
+        return sequence
+
+
+    def header(self, name, header):
+        #The log header (i.e. the calibration), so the rebuilt log has it too.
+        return self.append(name, time(), json.dumps(header), HEADER)
+
+
+    def _sync(self):
+        if self._dirty is not None:
+            #msync wants a page boundary to start from.
+            low, high = self._dirty
+            low -= low % mmap.PAGESIZE
+            self.map.flush(low, high - low)
+            self.syncs += 1
+        self._dirty = None
+        self._pending = 0
+
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+
+    def recover(self, directory='.'):
+        #----------------------------------------
+        '''
+        recover(directory='.') -> dictionary
+
+        Rebuilds the data files of the run that did not close the
+        journal (see recover() below), then marks them as dealt with so
+        they are not rebuilt again next time.
+        '''
+        #----------------------------------------
+
+        self.sync()
+        counts = recover(self.file_name, directory)
+        self.append('', time(), '', CLOSE)
+        self.sync()
+        self.clean = True
+
+        return counts
+
+
+    def close(self):
+        #----------------------------------------
+        '''
+        close()
+
+        Marks the journal as closed cleanly, syncs and unmaps it.
+        '''
+        #----------------------------------------
+
+        self.append('', time(), '', CLOSE)
+        self.sync()
+        self.map.close()
+        os.close(self._fd)
+
+
+def _length(name, payload):
+    #A record's size in the ring, padded to 8 bytes.
+    length = _RECORD.size + len(name) + _PAYLOAD_LENGTH.size + len(payload)
+    return (length + 7) & ~7
+
+
+def _scan(journal_map, size):
+    #----------------------------------------
+    '''
+    _scan(mmap, integer) -> generator of (offset, (sequence, time, type, name, payload))
+
+    Every record in the ring that passes its CRC, in the order they sit
+    in the file (not sequence order).
+    '''
+    #----------------------------------------
+
+    end = HEADER_SIZE + size
+    offset = HEADER_SIZE
+    while True:
+        #Skip straight to the next thing that looks like a record.
+        offset = journal_map.find(RECORD_MAGIC, offset, end)
+        if offset < 0 or offset + _RECORD.size > end:
+            return
+        if offset % 8:
+            offset += 8 - offset % 8
+            continue
+
+        magic, crc, sequence, timestamp, kind, name_length = _RECORD.unpack_from(journal_map, offset)
+        name_end = offset + _RECORD.size + name_length
+        if name_end + _PAYLOAD_LENGTH.size <= end:
+            payload_length, = _PAYLOAD_LENGTH.unpack_from(journal_map, name_end)
+            payload_end = name_end + _PAYLOAD_LENGTH.size + payload_length
+            if payload_end <= end and zlib.crc32(journal_map[offset + 8:payload_end]) == crc:
+                name = journal_map[offset + _RECORD.size:name_end].decode()
+                payload = journal_map[name_end + _PAYLOAD_LENGTH.size:payload_end].decode()
+                yield offset, (sequence, timestamp, kind, name, payload)
+                offset += _length(name.encode(), payload.encode())
+                continue
+
+        offset += 8
+
+
+def read_journal(file_name, everything=False):
+    #----------------------------------------
+    '''
+    read_journal(string, everything=False) -> list of (sequence, time, type, name, payload)
+
+    The records in a journal file in sequence order. Unless everything
+    is set, only the ones since the last clean close (i.e. the run that
+    did not finish).
+    '''
+    #----------------------------------------
+
+    with open(file_name, 'rb') as f:
+        journal_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if journal_map[:len(MAGIC)] != MAGIC:
+                raise ValueError(file_name + ' is not a journal')
+            version, size = struct.unpack_from('<IQ', journal_map, len(MAGIC))
+            found = sorted(record for offset, record in _scan(journal_map, size))
+        finally:
+            journal_map.close()
+
+    if not everything:
+        closes = [i for i, record in enumerate(found) if record[2] == CLOSE]
+        if closes:
+            found = found[closes[-1] + 1:]
+
+    return [record for record in found if record[2] != CLOSE]
+
+
+def recover(file_name, directory='.', everything=False):
+    #----------------------------------------
+    '''
+    recover(string, directory='.', everything=False) -> dictionary
+
+    Rebuilds a text data file for each sensor in the journal, named
+    <sensor>_data_recovered_<date>.txt, in the directory. Returns the
+    number of records recovered for each sensor.
+    '''
+    #----------------------------------------
+
+    os.makedirs(directory, exist_ok=True)
+    date = asctime().replace(' ', '_')
+    files = {}
+    counts = {}
+    try:
+        for sequence, timestamp, kind, name, payload in read_journal(file_name, everything):
+            if name not in files:
+                files[name] = open(os.path.join(directory, name + '_data_recovered_' + date + '.txt'), 'a')
+                counts[name] = 0
+            if kind == HEADER:
+                files[name].write(records.text_header(json.loads(payload)))
+            else:
+                files[name].write(asctime(localtime(timestamp)) + ',' + payload + '\n')
+                counts[name] += 1
+    finally:
+        for f in files.values():
+            f.close()
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the sensor data files from a journal.')
+    parser.add_argument('journal', help='the journal file')
+    parser.add_argument('--out', default='.', help='where to put the data files (default: here)')
+    parser.add_argument('--all', action='store_true',
+                        help='everything in the journal, not just the last run')
+    args = parser.parse_args()
+
+    for name, count in sorted(recover(args.journal, args.out, args.all).items()):
+        print(name, count, 'records')
+
+
+if __name__ == '__main__':
+    main()
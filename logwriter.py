@@ -0,0 +1,506 @@
+#!/usr/bin/python3
+'''
+Data file writers for the sensor classes.
+
+Opening, appending and closing the data file for every sample is two
+extra syscalls per sample per sensor, and it wears on the SD card. A
+LogWriter instead keeps its file open from start() to stop(), holds
+records in memory, and writes them out (and fsyncs them) in batches.
+
+The price is that whatever is still in memory is lost if the power is
+cut. loss_window() says how much that can be, so the batch size can be
+traded against SD wear and write latency.
+
+BinaryLogWriter does the same with fixed-width packed records instead of
+text (see records.py for the format and the decoder).
+
+SegmentedLogWriter and SegmentedBinaryLogWriter split the data into
+numbered segments of a set size or length of time, each compressed as
+it is written and each starting with its own header. A segment damaged
+by a power cut only loses that segment. Each finished segment gets a
+line in the stream's index file, which says what time range it holds,
+so a loader can go straight to the segments it wants.
+'''
+
+import json
+import lzma
+import os
+import struct
+import zlib
+from time import time, asctime, localtime
+
+import numpy as np
+
+import records
+
+
+#The policy every LogWriter gets unless it is told otherwise.
+DEFAULT_POLICY = {'flush_records': 20, 'flush_seconds': 10.0, 'fsync': True}
+
+
+class LogWriter(object):
+    #######################################################
+    '''
+    LogWriter(string, header=None, flush_records=20, flush_seconds=10.0, fsync=True) -> log object
+
+    --file_name:        The data file. It is appended to, never overwritten.
+    --header:           Optional. A dictionary written under "New data." as
+                            "key: JSON" lines, i.e. the calibration.
+    --flush_records:    Write the batch out once it holds this many records.
+    --flush_seconds:    ...or once the oldest record in it is this old.
+    --fsync:            Also make the OS put it on the card at each flush.
+
+    The time limit is checked when a record comes in, so a sensor that
+    stops writing leaves its last batch in memory until close().
+    '''
+    #######################################################
+
+    #What the batch is made of, and how the file is opened.
+    _empty = ''
+    _mode = 'a'
+
+    def __init__(self, file_name, header=None, flush_records=None, flush_seconds=None, fsync=None):
+        self.file_name = file_name
+        self.header = header or {}
+        self.flush_records = DEFAULT_POLICY['flush_records'] if flush_records is None else flush_records
+        self.flush_seconds = DEFAULT_POLICY['flush_seconds'] if flush_seconds is None else flush_seconds
+        self.fsync = DEFAULT_POLICY['fsync'] if fsync is None else fsync
+
+        self.file = None
+        self.records = 0
+        self.flushes = 0
+        self._batch = []
+        self._batch_start = None
+
+        #Set these to have every record go into a journal.Journal as well,
+        #under the given name.
+        self.journal = None
+        self.journal_name = None
+
+
+    def open(self):
+        #----------------------------------------
+        '''
+        open() -> log object
+
+        Opens the file and marks the start of the new data.
+        '''
+        #----------------------------------------
+
+        self.file = open(self.file_name, self._mode)
+        self.file.write(self._start_marker())
+        self.flush()
+
+        return self
+
+
+    def _start_marker(self):
+        return records.text_header(self.header)
+
+
+    def write(self, line):
+        #----------------------------------------
+        '''
+        write(string)
+
+        Adds a line (newline included) to the batch, and writes the
+        batch out if it is due.
+        '''
+        #----------------------------------------
+
+        if not self._batch:
+            self._batch_start = time()
+        self._batch.append(line)
+        self.records += 1
+
+        if (len(self._batch) >= self.flush_records
+                or time() - self._batch_start >= self.flush_seconds):
+            self.flush()
+
+
+    def record(self, timestamp, fields):
+        #----------------------------------------
+        '''
+        record(float, list)
+
+        Writes one comma-delimited record: the timestamp as asctime(),
+        then the fields.
+        '''
+        #----------------------------------------
+
+        line = ','.join(str(field) for field in fields)
+        if self.journal is not None:
+            self.journal.append(self.journal_name, timestamp, line)
+        self.write(asctime(localtime(timestamp)) + ',' + line + '\n')
+
+
+    def record_block(self, timestamps, *columns):
+        #----------------------------------------
+        '''
+        record_block(array, array, ...)
+
+        Writes a block of records at once: an array of timestamps and an
+        array for each field. The text writer just writes them one by one.
+        '''
+        #----------------------------------------
+
+        for row in zip(timestamps, *columns):
+            LogWriter.record(self, row[0], row[1:])
+
+
+    def flush(self):
+        #----------------------------------------
+        '''
+        flush()
+
+        Writes the batch to the file, and fsyncs it if that is the policy.
+        '''
+        #----------------------------------------
+
+        if self._batch:
+            self.file.write(self._empty.join(self._batch))
+            self._batch = []
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.flushes += 1
+
+
+    def close(self):
+        #----------------------------------------
+        '''
+        close()
+
+        Writes out whatever is left and closes the file.
+        '''
+        #----------------------------------------
+
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+
+    def loss_window(self):
+        #----------------------------------------
+        '''
+        loss_window() -> dictionary
+
+        The most that a power cut could lose from this log:
+
+            --records:  Records in memory at worst.
+            --seconds:  Age of the oldest of them at worst, not counting
+                            the wait for the next record to arrive.
+            --pending:  Records in memory right now.
+            --age:      Age of the oldest of those right now.
+        '''
+        #----------------------------------------
+
+        age = time() - self._batch_start if self._batch else 0.0
+
+        return {'records': self.flush_records - 1, 'seconds': self.flush_seconds,
+                'pending': len(self._batch), 'age': age}
+
+
+class BinaryLogWriter(LogWriter):
+    #######################################################
+    '''
+    BinaryLogWriter(string, string, string, header=None, flush_records=20, flush_seconds=10.0, fsync=True) -> log object
+
+    --file_name:    The data file, usually ending in .bin.
+    --name:         The sensor name, for the header.
+    --kind:         The kind of record (a key of records.KINDS).
+    --header:       Optional. Anything else to put in the block header.
+
+    The rest is the same as LogWriter. record() takes the same fields the
+    text writer does, so the sensors do not care which one they have.
+    '''
+    #######################################################
+
+    _empty = b''
+    _mode = 'ab'
+
+    def __init__(self, file_name, name, kind, header=None, **policy):
+        LogWriter.__init__(self, file_name, header, **policy)
+        self.name = name
+        self.kind = kind
+        self._struct = struct.Struct(records.KINDS[kind][0])
+
+        #The same layout as a numpy record, for record_block().
+        record_format, names = records.KINDS[kind]
+        self._dtype = np.dtype([(name, '<' + code) for name, code in zip(names, record_format[1:])])
+
+
+    def _start_marker(self):
+        return records.pack_header(self.name, self.kind, time(), **self.header)
+
+
+    def record(self, timestamp, fields):
+        #----------------------------------------
+        '''
+        record(float, list)
+
+        Packs one record: the timestamp, then the fields.
+        '''
+        #----------------------------------------
+
+        if self.journal is not None:
+            self.journal.append(self.journal_name, timestamp, fields)
+        self.write(self._struct.pack(*records.encode(self.kind, timestamp, fields)))
+
+
+    def record_block(self, timestamps, *columns):
+        #----------------------------------------
+        '''
+        record_block(array, array, ...)
+
+        Packs a whole block of records in one go, i.e. a buffer of burst
+        samples (see MCP3008.burst()), and writes it out straight away.
+        '''
+        #----------------------------------------
+
+        block = np.empty(len(timestamps), self._dtype)
+        for name, column in zip(self._dtype.names, (timestamps,) + columns):
+            block[name] = column
+        if self.journal is not None:
+            for row in block.tolist():
+                self.journal.append(self.journal_name, row[0], row[1:])
+
+        if not self._batch:
+            self._batch_start = time()
+        self._batch.append(block.tobytes())
+        self.records += len(block)
+        self.flush()
+
+
+class _Segmented(object):
+    #######################################################
+    '''
+    The segment handling shared by SegmentedLogWriter and
+    SegmentedBinaryLogWriter. It goes in front of LogWriter or
+    BinaryLogWriter, which still do the formatting and batching.
+    '''
+    #######################################################
+
+    _extensions = {'zlib': '.gz', 'lzma': '.xz', None: ''}
+
+    def _segments(self, compression='zlib', segment_bytes=2**20, segment_seconds=600.0):
+        if compression not in self._extensions:
+            raise ValueError('compression must be zlib, lzma or None, not ' + repr(compression))
+        self.compression = compression
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+
+        #The stream's file name; the segments and index are named after it.
+        self.stream_name = self.file_name
+        stem = os.path.splitext(self.stream_name)[0]
+        self.index_name = stem + '.index'
+        self.segment = -1
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+
+
+    def _segment_name(self, number):
+        stem, extension = os.path.splitext(self.stream_name)
+        return '%s_%04d%s%s' % (stem, number, extension, self._extensions[self.compression])
+
+
+    def _compressor(self):
+        #gzip framing (wbits=31), so a segment also opens with zcat.
+        if self.compression == 'zlib':
+            return zlib.compressobj(6, zlib.DEFLATED, 31)
+        return None
+
+
+    def _compress(self, data):
+        #----------------------------------------
+        '''
+        _compress(bytes) -> bytes
+
+        Compresses a batch so that everything up to the end of it can be
+        read back even if nothing more is ever written. zlib does that
+        with a sync flush. lzma cannot, so each batch becomes an xz
+        stream of its own (xz reads them back to back); it pays a few
+        dozen bytes per batch for that, so give it bigger batches.
+        '''
+        #----------------------------------------
+
+        if self.compression == 'zlib':
+            return self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+        if self.compression == 'lzma':
+            return lzma.compress(data, format=lzma.FORMAT_XZ) if data else b''
+        return data
+
+
+    def open(self):
+        self._next_segment()
+        return self
+
+
+    def _next_segment(self):
+        self.segment += 1
+        self.file_name = self._segment_name(self.segment)
+        self.file = open(self.file_name, 'ab')
+        self._zlib = self._compressor()
+        self._segment_start = time()
+        self._segment_bytes = 0
+        self._segment_records = 0
+        self._first = self._last = None
+
+        #Every segment starts with the header, so it stands on its own.
+        self._batch.append(self._start_marker())
+        self.flush()
+
+
+    def _end_segment(self):
+        self.flush()
+        if self._zlib is not None:
+            tail = self._zlib.flush(zlib.Z_FINISH)
+            self.file.write(tail)
+            self._segment_bytes += len(tail)
+            self.compressed_bytes += len(tail)
+        self.file.close()
+        self.file = None
+
+        entry = {'segment': os.path.basename(self.file_name), 'first': self._first,
+                 'last': self._last, 'records': self._segment_records, 'bytes': self._segment_bytes}
+        with open(self.index_name, 'a') as index:
+            index.write(json.dumps(entry) + '\n')
+
+
+    def record(self, timestamp, fields):
+        if (self._segment_bytes >= self.segment_bytes
+                or time() - self._segment_start >= self.segment_seconds):
+            self._end_segment()
+            self._next_segment()
+
+        if self._first is None:
+            self._first = timestamp
+        self._last = timestamp
+        self._segment_records += 1
+        super().record(timestamp, fields)
+
+
+    def record_block(self, timestamps, *columns):
+        if not len(timestamps):
+            return
+        if (self._segment_bytes >= self.segment_bytes
+                or time() - self._segment_start >= self.segment_seconds):
+            self._end_segment()
+            self._next_segment()
+
+        if self._first is None:
+            self._first = float(timestamps[0])
+        self._last = float(timestamps[-1])
+        self._segment_records += len(timestamps)
+        super().record_block(timestamps, *columns)
+
+
+    def flush(self):
+        data = self._empty.join(self._batch)
+        self._batch = []
+        if isinstance(data, str):
+            data = data.encode()
+        self.raw_bytes += len(data)
+
+        data = self._compress(data)
+        self._segment_bytes += len(data)
+        self.compressed_bytes += len(data)
+        self.file.write(data)
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.flushes += 1
+
+
+    def close(self):
+        if self.file is not None:
+            self._end_segment()
+
+
+class SegmentedLogWriter(_Segmented, LogWriter):
+    #######################################################
+    '''
+    SegmentedLogWriter(string, header=None, compression='zlib', segment_bytes=2**20, segment_seconds=600, ...) -> log object
+
+    --file_name:        The stream's name, i.e. Light_data_<date>.txt. The
+                            segments are Light_data_<date>_0000.txt.gz and
+                            so on, and the index is Light_data_<date>.index.
+    --compression:      'zlib' (gzip files), 'lzma' (xz files) or None.
+    --segment_bytes:    Start a new segment once this one is this big on
+                            the card...
+    --segment_seconds:  ...or this old, whichever comes first.
+
+    The rest is the same as LogWriter. read_segment() reads a segment
+    back, and read_index() the index.
+    '''
+    #######################################################
+
+    def __init__(self, file_name, header=None, compression='zlib', segment_bytes=2**20,
+                 segment_seconds=600.0, **policy):
+        LogWriter.__init__(self, file_name, header, **policy)
+        self._segments(compression, segment_bytes, segment_seconds)
+
+
+class SegmentedBinaryLogWriter(_Segmented, BinaryLogWriter):
+    #######################################################
+    '''
+    SegmentedBinaryLogWriter(string, string, string, header=None, compression='zlib', ...) -> log object
+
+    The same as SegmentedLogWriter, with BinaryLogWriter records. Each
+    segment read back with read_segment() is a binary data file that
+    records.read_records() can read.
+    '''
+    #######################################################
+
+    def __init__(self, file_name, name, kind, header=None, compression='zlib', segment_bytes=2**20,
+                 segment_seconds=600.0, **policy):
+        BinaryLogWriter.__init__(self, file_name, name, kind, header, **policy)
+        self._segments(compression, segment_bytes, segment_seconds)
+
+
+def read_segment(file_name):
+    #----------------------------------------
+    '''
+    read_segment(string) -> bytes
+
+    Reads a segment back, decompressed. A segment cut short by a power
+    cut gives everything up to its last flush.
+    '''
+    #----------------------------------------
+
+    with open(file_name, 'rb') as f:
+        data = f.read()
+
+    if file_name.endswith('.gz'):
+        return zlib.decompressobj(31).decompress(data)
+
+    if file_name.endswith('.xz'):
+        #One xz stream per flush, back to back. Stop at the first one that
+        #is cut short.
+        out = []
+        while data:
+            decompressor = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+            try:
+                out.append(decompressor.decompress(data))
+            except lzma.LZMAError:
+                break
+            if not decompressor.eof:
+                break
+            data = decompressor.unused_data.lstrip(b'\x00')
+        return b''.join(out)
+
+    return data
+
+
+def read_index(index_name):
+    #----------------------------------------
+    '''
+    read_index(string) -> list of dictionaries
+
+    The entries of a stream's index, oldest segment first.
+    '''
+    #----------------------------------------
+
+    with open(index_name) as index:
+        return [json.loads(line) for line in index if line.strip()]
@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+'''
+Timing and error counts for the flight loop.
+
+Every sensor's start(), get(), write() and stop() are timed (see
+Sensor in fl_objects_2.py), the scheduler times its loop, and anything
+that throws data away counts it here. Everything goes into one
+registry, metrics.registry, in fixed-size counters and histograms, so
+keeping the numbers costs about the same on hour six as on minute one.
+
+dump() appends the lot to the metrics file as one line of JSON, and
+summary() gives a table for the console:
+
+    Inside_temp.get        runs  mean ms   p50 ms   p99 ms   max ms
+'''
+
+import json
+from bisect import bisect_right
+from time import time, asctime
+
+
+#Histogram bucket edges in seconds: four to a decade, from 10 us to 100 s.
+EDGES = [10 ** (e / 4) for e in range(-20, 9)]
+
+
+class Histogram(object):
+    #######################################################
+    '''
+    Histogram(edges=EDGES) -> histogram object
+
+    Counts how many times fell between each pair of edges (the first and
+    last buckets take everything below and above), plus the count, sum
+    and max. add() is only a bisect and a few additions.
+    '''
+    #######################################################
+
+    def __init__(self, edges=EDGES):
+        self.edges = edges
+        self.buckets = [0] * (len(edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+    def add(self, seconds):
+        #Not locked. Two threads adding at the same instant can lose one of
+        #the counts, which is fine for this and much cheaper than a lock.
+        self.buckets[bisect_right(self.edges, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+    def percentile(self, p):
+        #----------------------------------------
+        '''
+        percentile(float) -> float
+
+        The upper edge of the bucket the pth percentile falls in (or the
+        max, if it is in the top bucket), so it errs on the slow side.
+        '''
+        #----------------------------------------
+
+        if not self.count:
+            return 0.0
+        target = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                return min(self.edges[i], self.max) if i < len(self.edges) else self.max
+
+        return self.max
+
+
+    def to_dict(self):
+        return {'count': self.count, 'total': self.total, 'max': self.max, 'buckets': self.buckets}
+
+
+class Metrics(object):
+    #######################################################
+    '''
+    Metrics() -> registry object
+
+    Histograms and counters by name, i.e. 'Camera.write' and
+    'Camera.evictions'. They are made the first time they are used.
+    '''
+    #######################################################
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.started = time()
+        self.file_name = None
+
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+
+    def time(self, name, seconds):
+        self.histogram(name).add(seconds)
+
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+
+    def dump(self, file_name=None):
+        #----------------------------------------
+        '''
+        dump(file_name=None)
+
+        Appends everything so far to the metrics file as one line of
+        JSON. The numbers are totals since the start, so the change
+        between two lines is what happened in between.
+        '''
+        #----------------------------------------
+
+        if file_name is None:
+            if self.file_name is None:
+                self.file_name = 'Metrics_data_' + asctime().replace(' ', '_') + '.txt'
+            file_name = self.file_name
+
+        line = {'time': time(), 'uptime': time() - self.started, 'edges': EDGES,
+                'histograms': dict((name, h.to_dict()) for name, h in sorted(self.histograms.items())),
+                'counters': dict(sorted(self.counters.items()))}
+        with open(file_name, 'a') as f:
+            f.write(json.dumps(line) + '\n')
+
+
+    def summary(self):
+        #----------------------------------------
+        '''
+        summary() -> string
+
+        A table of every histogram in milliseconds, then the counters.
+        '''
+        #----------------------------------------
+
+        lines = ['%-24s %8s %8s %8s %8s %8s' % ('', 'runs', 'mean ms', 'p50 ms', 'p99 ms', 'max ms')]
+        for name, h in sorted(self.histograms.items()):
+            lines.append('%-24s %8d %8.2f %8.2f %8.2f %8.2f' % (
+                name, h.count, h.mean * 1000, h.percentile(50) * 1000,
+                h.percentile(99) * 1000, h.max * 1000))
+        for name, n in sorted(self.counters.items()):
+            lines.append('%-24s %8d' % (name, n))
+
+        return '\n'.join(lines)
+
+
+#The one everything reports to.
+registry = Metrics()
@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+'''
+The binary data file format, and a decoder that turns binary data files
+back into the usual comma-delimited text.
+
+A binary data file is one or more blocks (one per start() of the
+sensor), each of them:
+
+    --magic:    8 bytes, b'BSATLOG' and a zero byte.
+    --length:   4 bytes, little-endian, the length of the header.
+    --header:   JSON, describing the block: the sensor name, the kind of
+                    record, the struct format of a record and the names
+                    of its fields.
+    --records:  Fixed-width records packed with that struct format. The
+                    first field is always the time (float64 seconds since
+                    the epoch).
+
+To decode every binary file in a flight's directory:
+
+    ./records.py flight_data/ [--out decoded/]
+'''
+
+import argparse
+import calendar
+import glob
+import io
+import json
+import math
+import os
+import struct
+from time import asctime, localtime, gmtime, strftime, strptime
+
+
+MAGIC = b'BSATLOG\x00'
+VERSION = 1
+
+#GPS fields after the time, in the order GPS.get() gives them.
+GPS_FIELDS = ['gps_time', 'ept', 'lat', 'lon', 'alt', 'epx', 'epy', 'epv',
+              'track', 'speed', 'climb', 'epd', 'eps', 'epc']
+
+#kind: (struct format, field names). Every format starts with the time.
+KINDS = {'MCP3008': ('<dd', ['time', 'reading']),
+         'CountSensor': ('<dId', ['time', 'count', 'window']),
+         'GPS': ('<d' + 'd' * len(GPS_FIELDS), ['time'] + GPS_FIELDS),
+         #The raw 10-bit codes of an MCP3008 burst (see MCP3008.burst()).
+         'MCP3008Burst': ('<dH', ['time', 'code'])}
+
+
+def _number(value):
+    #gpsd says 'n/a' for anything it does not know yet.
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def _gps_time(value):
+    #gpsd times look like 2017-08-21T17:30:00.000Z.
+    try:
+        seconds, dot, fraction = value.rstrip('Z').partition('.')
+        return calendar.timegm(strptime(seconds, '%Y-%m-%dT%H:%M:%S')) + float('0.' + (fraction or '0'))
+    except (AttributeError, ValueError):
+        return _number(value)
+
+
+def encode(kind, timestamp, fields):
+    #----------------------------------------
+    '''
+    encode(string, float, list) -> tuple
+
+    Turns the fields a sensor would write as text into the numbers that
+    get packed.
+    '''
+    #----------------------------------------
+
+    if kind == 'GPS':
+        return (timestamp, _gps_time(fields[0])) + tuple(_number(field) for field in fields[1:])
+    if kind == 'CountSensor':
+        return (timestamp, int(fields[0]), float(fields[1]))
+    if kind == 'MCP3008Burst':
+        return (timestamp, int(fields[0]))
+
+    return (timestamp,) + tuple(_number(field) for field in fields)
+
+
+def decode(kind, record):
+    #----------------------------------------
+    '''
+    decode(string, tuple) -> (float, list)
+
+    The other way from encode(): the time and the fields of an unpacked
+    record, as the sensor would have written them.
+    '''
+    #----------------------------------------
+
+    if kind == 'GPS':
+        return record[0], [_iso(record[1])] + [_text(value) for value in record[2:]]
+    if kind == 'CountSensor':
+        return record[0], [int(record[1]), record[2]]
+
+    return record[0], [_text(value) for value in record[1:]]
+
+
+def _text(value):
+    return 'n/a' if isinstance(value, float) and math.isnan(value) else str(value)
+
+
+def _iso(value):
+    if math.isnan(value):
+        return 'n/a'
+    return strftime('%Y-%m-%dT%H:%M:%S', gmtime(value)) + ('%.3fZ' % (value % 1))[1:]
+
+
+def to_text(kind, record):
+    #----------------------------------------
+    '''
+    to_text(string, tuple) -> string
+
+    Formats an unpacked record the way the text data files have it.
+    '''
+    #----------------------------------------
+
+    fields = [asctime(localtime(record[0]))]
+    if kind == 'GPS':
+        fields.append(_iso(record[1]))
+        fields.extend(_text(value) for value in record[2:])
+    else:
+        fields.extend(_text(value) for value in record[1:])
+
+    return ','.join(fields) + '\n'
+
+
+def text_header(header):
+    #----------------------------------------
+    '''
+    text_header(dictionary) -> string
+
+    What starts a block of a text data file: "New data.", then a
+    "key: JSON" line for anything in the header, then a blank line.
+    '''
+    #----------------------------------------
+
+    lines = ''.join('%s: %s\n' % (key.capitalize(), json.dumps(value, sort_keys=True))
+                    for key, value in header.items())
+
+    return '\nNew data.\n' + lines + '\n'
+
+
+#What a block header has that is not passed on to the text header.
+_BLOCK_FIELDS = ('version', 'sensor', 'kind', 'started', 'format', 'fields')
+
+
+def pack_header(name, kind, started, **extra):
+    #----------------------------------------
+    '''
+    pack_header(string, string, float) -> bytes
+
+    Makes the magic, length and header that start a block. Anything in
+    extra is added to the header as is.
+    '''
+    #----------------------------------------
+
+    record_format, fields = KINDS[kind]
+    header = {'version': VERSION, 'sensor': name, 'kind': kind, 'started': started,
+              'format': record_format, 'fields': fields}
+    header.update(extra)
+    header = json.dumps(header).encode()
+
+    return MAGIC + struct.pack('<I', len(header)) + header
+
+
+def read_records(binary_file):
+    #----------------------------------------
+    '''
+    read_records(file) -> generator of (header dict, tuple)
+
+    Reads a binary data file front to back and yields every record with
+    the header of the block it is in. A record cut short at the end of
+    the file (a power cut mid-write) is dropped.
+    '''
+    #----------------------------------------
+
+    header = None
+    while True:
+        if header is None:
+            if binary_file.read(len(MAGIC)) != MAGIC:
+                return
+            length, = struct.unpack('<I', binary_file.read(4))
+            header = json.loads(binary_file.read(length).decode())
+            unpack = struct.Struct(header['format'])
+
+        data = binary_file.read(unpack.size)
+        if data.startswith(MAGIC):
+            #The next block starts here. Back up to its magic.
+            binary_file.seek(-len(data), os.SEEK_CUR)
+            header = None
+        elif len(data) < unpack.size:
+            return
+        else:
+            yield header, unpack.unpack(data)
+
+
+def decode_file(binary_name, text_name):
+    #----------------------------------------
+    '''
+    decode_file(string, string) -> integer
+
+    Writes a binary data file (or a compressed segment of one) out as a
+    text data file, in one pass. Returns the number of records.
+    '''
+    #----------------------------------------
+
+    #logwriter imports this module, so this import waits until it is needed.
+    from logwriter import read_segment
+
+    count = 0
+    block = None
+    if binary_name.endswith(('.gz', '.xz')):
+        binary_file = io.BytesIO(read_segment(binary_name))
+    else:
+        binary_file = open(binary_name, 'rb')
+    with binary_file, open(text_name, 'w') as text_file:
+        for header, record in read_records(binary_file):
+            if header is not block:
+                text_file.write(text_header({key: value for key, value in header.items()
+                                             if key not in _BLOCK_FIELDS}))
+                block = header
+            text_file.write(to_text(header['kind'], record))
+            count += 1
+
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Decode binary sensor data files to text.')
+    parser.add_argument('directory', help='the flight data directory')
+    parser.add_argument('--out', help='where to put the text files (default: next to the binary ones)')
+    args = parser.parse_args()
+
+    names = []
+    for pattern in ('*.bin', '*.bin.gz', '*.bin.xz'):
+        names += glob.glob(os.path.join(args.directory, pattern))
+    for binary_name in sorted(names):
+        text_name = os.path.basename(binary_name).split('.bin')[0] + '.txt'
+        text_name = os.path.join(args.out or args.directory, text_name)
+        count = decode_file(binary_name, text_name)
+        print(binary_name, '->', text_name, count, 'records')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+#!/usr/bin/python3
+'''
+Flies a recorded flight again, through the real flight controller.
+
+The text data files from a flight are played back through the simulated
+hardware: each MCP3008 reading is turned back into the voltage that
+would have given it (with the calibration in the file, or the one the
+sensor has now if the file is too old to say) and put on the same
+channel of the simulated ADC, and the GPS fixes are served by the fake
+gpsd. Then flight_controller_2.main() runs as it would on the day, with
+a virtual clock in place of the real one, until the recording runs out.
+
+    ./replay.py flight_data/ [--out replay_out/] [--speed 0]
+
+--speed 1 runs in real time, 10 ten times faster, and 0 (the default)
+as fast as the computer can go: the virtual clock only moves when the
+flight loop sleeps (the ADC's clock delays included), so the time the
+Python itself takes does not make anything late. At the end it reports
+the flight time covered, the wall-clock and CPU time it took, and the
+size of everything written.
+
+Only the deadline scheduler runtime is replayed; asyncio keeps its own
+clock. CountSensor (Geiger counter) logs are not replayed either: if
+the counter is enabled in flight_config.json, nothing pulses its pin,
+so it counts 0 and the Counts telemetry field sends 0.
+'''
+
+import argparse
+import contextlib
+import glob
+import os
+import threading
+import time as _time
+
+import numpy as np
+
+import calibration
+import flight_data
+import hardware
+
+
+class VirtualClock(object):
+    #######################################################
+    '''
+    VirtualClock(float, float, speed=0) -> clock object
+
+    --start:    The time (seconds since the epoch) to start at.
+    --end:      When the recording runs out. The first sleep() of the
+                    main thread after that raises KeyboardInterrupt, which
+                    main() takes as the signal to shut down cleanly.
+    --speed:    0 to jump ahead whenever the main thread sleeps, or how
+                    many times faster than real time to run.
+
+    Has the time(), monotonic(), sleep() and asctime() the flight code
+    uses, so it can be swapped in for them (see install()).
+    '''
+    #######################################################
+
+    def __init__(self, start, end, speed=0):
+        self.start = start
+        self.end = end
+        self.speed = speed
+        self.finished = False
+        self._now = start
+        self._real_start = _time.perf_counter()
+        self._driver = threading.current_thread()
+        self._changed = threading.Condition()
+
+
+    def time(self):
+        if self.speed:
+            return self.start + (_time.perf_counter() - self._real_start) * self.speed
+        return self._now
+
+
+    def monotonic(self):
+        return self.time()
+
+
+    def asctime(self, t=None):
+        return _time.asctime(_time.localtime(self.time()) if t is None else t)
+
+
+    def sleep(self, seconds):
+        #----------------------------------------
+        '''
+        sleep(seconds)
+
+        The main thread moves the clock on (or, at a set speed, waits for
+        it). Any other thread waits until the main thread has moved it
+        far enough.
+        '''
+        #----------------------------------------
+
+        seconds = max(seconds, 0)
+        if threading.current_thread() is self._driver:
+            if self.time() >= self.end:
+                self._finish()
+                raise KeyboardInterrupt
+            if self.speed:
+                _time.sleep(seconds / self.speed)
+            else:
+                with self._changed:
+                    self._now += seconds
+                    self._changed.notify_all()
+            return
+
+        if self.finished:
+            #Shutting down. Let the threads finish in real time.
+            _time.sleep(min(seconds, 0.01))
+        elif self.speed:
+            _time.sleep(seconds / self.speed)
+        else:
+            until = self._now + seconds
+            with self._changed:
+                while self._now < until and not self.finished:
+                    self._changed.wait(0.1)
+
+
+    def _finish(self):
+        with self._changed:
+            self.finished = True
+            self._changed.notify_all()
+
+
+def install(clock, modules):
+    #----------------------------------------
+    '''
+    install(VirtualClock, list of modules)
+
+    Points every module's time(), monotonic(), sleep() and asctime()
+    (and the time module itself, where a module imports it whole) at the
+    virtual clock.
+    '''
+    #----------------------------------------
+
+    for module in modules:
+        for name in ('time', 'monotonic', 'sleep', 'asctime'):
+            value = getattr(module, name, None)
+            if value is _time:
+                setattr(module, name, clock)
+            elif value is not None and value is getattr(_time, name):
+                setattr(module, name, getattr(clock, name))
+
+
+def read_log(file_name):
+    #----------------------------------------
+    '''
+    read_log(string) -> (header dictionary, array of times, 2-d array of strings)
+
+    Reads a text data file (see flight_data.read_text()), keeping the
+    header of its last block, i.e. the calibration.
+    '''
+    #----------------------------------------
+
+    with open(file_name) as f:
+        headers, times, rows = flight_data.read_text(f.read())
+
+    return (headers[-1][1] if headers else {}), times, rows
+
+
+def _sensor_name(file_name):
+    return os.path.basename(file_name).split('_data_')[0]
+
+
+def _channel(pin):
+    return pin[0] * 4 + pin[1] * 2 + pin[2]
+
+
+class ChannelPlayback(object):
+    #######################################################
+    '''
+    ChannelPlayback(dictionary, int, float) -> voltage source
+
+    The voltage on one channel of the simulated ADC, as a function of
+    time. The first time it is asked, it finds the MCP3008 sensor that
+    main() put on the channel, and plays back that sensor's recording.
+    A channel with no recording stays at the default voltage.
+    '''
+    #######################################################
+
+    def __init__(self, logs, channel, default):
+        self.logs = logs
+        self.channel = channel
+        self.default = default
+        self._times = None
+        self._volts = None
+
+
+    def _find(self):
+        from fl_objects_2 import MCP3008Bus
+
+        for bus in MCP3008Bus._buses.values():
+            for sensor in bus.sensors:
+                if _channel(sensor.pin) == self.channel and sensor.name in self.logs:
+                    header, times, rows = self.logs[sensor.name]
+                    readings = flight_data._column(rows[:, 0])
+                    #The calibration the recording was made with, if it says.
+                    if 'calibration' in header:
+                        cal = calibration.make(header['calibration'])
+                    else:
+                        cal = sensor.calibration
+                    self._times = times
+                    self._volts = np.asarray(cal.inverse(readings), dtype=np.float64)
+                    return True
+
+        return False
+
+
+    def __call__(self, t):
+        if self._times is None and not self._find():
+            return self.default
+        return float(np.interp(t, self._times, self._volts))
+
+
+class GPSPlayback(object):
+    #######################################################
+    '''
+    GPSPlayback(header, times, rows) -> fix source
+
+    The recorded GPS fix at a given time, for the fake gpsd.
+    '''
+    #######################################################
+
+    def __init__(self, log):
+        from fl_objects_2 import GPS
+
+        header, self.times, rows = log
+        self.fixes = []
+        for row in rows:
+            fix = {'class': 'TPV', 'mode': 3}
+            for field, value in zip(GPS.FIELDS, row):
+                if value in ('n/a', 'None', ''):
+                    continue
+                try:
+                    fix[field] = float(value)
+                except ValueError:
+                    fix[field] = value
+            self.fixes.append(fix)
+
+
+    def __call__(self, t):
+        index = max(int(np.searchsorted(self.times, t, side='right')) - 1, 0)
+        return self.fixes[index]
+
+
+def _output_bytes(directory):
+    #The journal is made full size before anything is written, so it is
+    #left out.
+    total = 0
+    for root, directories, files in os.walk(directory):
+        for name in files:
+            if name != 'journal.dat':
+                total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def replay(flight_dir, out_dir, speed=0, Vref=5.09, runtime_log='console.txt'):
+    #----------------------------------------
+    '''
+    replay(string, string, speed=0, Vref=5.09) -> dictionary
+
+    Replays the flight recorded in flight_dir through main(), writing
+    everything it writes into out_dir, and returns the figures.
+    '''
+    #----------------------------------------
+
+    logs = {}
+    for file_name in sorted(glob.glob(os.path.join(flight_dir, '*_data_*.txt'))):
+        name = _sensor_name(file_name)
+        if name == 'Metrics' or '_data_recovered_' in file_name:
+            continue
+        log = read_log(file_name)
+        if len(log[1]):
+            logs[name] = log
+    if not logs:
+        raise ValueError('no data files in ' + flight_dir)
+
+    start = min(log[1][0] for log in logs.values())
+    end = max(log[1][-1] for log in logs.values())
+
+    #The simulated hardware, playing the recording.
+    bench = hardware.SimBackend.bench().chips[0]
+    gps = GPSPlayback(logs['GPS']) if 'GPS' in logs else hardware.bench_fix
+    sim = hardware.SimBackend(gps_fixes=gps)
+    chip = sim.add_mcp3008(Vref, 11, 13, 15, 16, dict(
+        (channel, ChannelPlayback(logs, channel, bench.voltage(channel))) for channel in range(8)))
+    sim.attach_spi(chip, 0, 0)
+    hardware.set_backend(sim)
+
+    #Imported after the backend is chosen, like bench_adc.py does.
+    import fl_objects_2
+    import flight_controller_2
+    import async_runtime, journal, logwriter, metrics, scheduler, storage, supervisor
+    import telemetry, thermal, workers
+
+    clock = VirtualClock(start, end, speed)
+    install(clock, [fl_objects_2, flight_controller_2, async_runtime, journal, logwriter,
+                    metrics, scheduler, storage, supervisor, telemetry, thermal, workers, hardware])
+    metrics.registry.started = clock.time()
+
+    os.makedirs(os.path.join(out_dir, 'data'), exist_ok=True)
+    here = os.getcwd()
+    os.chdir(out_dir)
+    wall = _time.perf_counter()
+    cpu = _time.process_time()
+    try:
+        with open(runtime_log, 'w') as console, contextlib.redirect_stdout(console):
+            flight_controller_2.main('schedule')
+    finally:
+        wall = _time.perf_counter() - wall
+        cpu = _time.process_time() - cpu
+        if sim.gpsd is not None:
+            sim.gpsd.stop()
+        os.chdir(here)
+
+    written = sum(h.count for name, h in metrics.registry.histograms.items() if name.endswith('.write'))
+    flown = min(clock.time(), end) - start
+    output = _output_bytes(out_dir)
+
+    return {'flight seconds': flown, 'wall seconds': wall, 'cpu seconds': cpu,
+            'speedup': flown / wall if wall else 0.0, 'writes': written,
+            'writes per second': written / wall if wall else 0.0,
+            'output bytes': output, 'output MB per flight hour': output / 2**20 / (flown / 3600) if flown else 0.0,
+            'conversions': chip.conversions}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded flight through the flight controller.')
+    parser.add_argument('flight', help='the directory of text data files from the flight')
+    parser.add_argument('--out', default='replay_out', help='where the replay writes (default: replay_out)')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='times faster than real time, or 0 for as fast as possible (default)')
+    args = parser.parse_args()
+
+    figures = replay(args.flight, args.out, args.speed)
+    for name, value in figures.items():
+        print('%-26s %14.2f' % (name, value))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+'''
+A deadline scheduler for the flight loop.
+
+Instead of sampling everything once per pass of one big loop (which then
+runs only as fast as its slowest member), every job gets its own period.
+The light sensor can run at 20 Hz for the eclipse while the camera takes
+a picture every 30 seconds.
+
+Each task is due at a fixed rate: start, start + period, start + 2 *
+period, and so on. Whatever is due is run earliest deadline first, with
+the priority breaking ties. A task that falls a whole period or more
+behind skips the deadlines it missed (they are counted as overruns)
+rather than running several times in a row to catch up.
+'''
+
+import heapq
+import time
+
+
+class Task(object):
+    #######################################################
+    '''
+    Task(string, function, float, priority=0) -> task object
+
+    --name:     What to call it in the report.
+    --action:   Called with no arguments each time the task is due.
+    --period:   Seconds between deadlines.
+    --priority: Higher goes first when two tasks are due at once.
+
+    Keeps its own timing figures:
+
+    --runs:         Times it has run.
+    --overruns:     Deadlines it missed entirely.
+    --lateness:     Seconds from the deadline to the start, for the last
+                        run. The mean, max and jitter (the standard
+                        deviation) cover every run.
+    --run_time:     Seconds the last run took; max_run_time is the worst.
+    '''
+    #######################################################
+
+    def __init__(self, name, action, period, priority=0):
+        self.name = name
+        self.action = action
+        self.period = period
+        self.priority = priority
+        self.due = 0
+
+        self.runs = 0
+        self.overruns = 0
+        self.lateness = 0
+        self.max_lateness = 0
+        self.run_time = 0
+        self.max_run_time = 0
+        self._late_sum = 0
+        self._late_squares = 0
+
+
+    def _record(self, lateness, run_time):
+        self.runs += 1
+        self.lateness = lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        self._late_sum += lateness
+        self._late_squares += lateness * lateness
+        self.run_time = run_time
+        self.max_run_time = max(self.max_run_time, run_time)
+
+
+    @property
+    def mean_lateness(self):
+        return self._late_sum / self.runs if self.runs else 0
+
+
+    @property
+    def jitter(self):
+        if not self.runs:
+            return 0
+        mean = self.mean_lateness
+        return max(self._late_squares / self.runs - mean * mean, 0) ** 0.5
+
+
+class Scheduler(object):
+    #######################################################
+    '''
+    Scheduler(clock=time.time, sleep=time.sleep, metrics=None) -> scheduler object
+
+    Add tasks with add(), then call run_pending() (or run(), which
+    sleeps in between) over and over.
+
+    Given a metrics registry (see metrics.py), it also keeps a histogram
+    of every task's lateness ('<task>.lateness'), of the time between
+    batches ('Schedule.period'), and counts overruns ('<task>.overruns').
+    '''
+    #######################################################
+
+    def __init__(self, clock=None, sleep=None, metrics=None):
+        #Looked up now rather than when this was defined, so a replay's
+        #virtual clock (see replay.py) is picked up.
+        self.clock = clock or time.time
+        self.sleep = sleep or time.sleep
+        self.metrics = metrics
+        self._last_batch = None
+        self.tasks = []
+        self._heap = []
+        self._count = 0
+        self._before = []
+
+
+    def add(self, name, action, period, priority=0, offset=0):
+        #----------------------------------------
+        '''
+        add(string, function, float, priority=0, offset=0) -> Task
+
+        Adds a task, first due offset seconds from now.
+        '''
+        #----------------------------------------
+
+        task = Task(name, action, period, priority)
+        task.due = self.clock() + offset
+        self.tasks.append(task)
+        self._push(task)
+
+        return task
+
+
+    def before_each(self, hook):
+        #----------------------------------------
+        '''
+        before_each(function)
+
+        Calls hook(list of Tasks) before running every batch of due
+        tasks, i.e. to read all the ADC channels that are due at once.
+        '''
+        #----------------------------------------
+
+        self._before.append(hook)
+
+
+    def _push(self, task):
+        #The count keeps equal deadlines in the order they were pushed.
+        self._count += 1
+        heapq.heappush(self._heap, (task.due, -task.priority, self._count, task))
+
+
+    def next_due(self):
+        return self._heap[0][0] if self._heap else None
+
+
+    def run_pending(self):
+        #----------------------------------------
+        '''
+        run_pending() -> integer
+
+        Runs every task that is due, earliest deadline first, and
+        returns how many ran.
+        '''
+        #----------------------------------------
+
+        now = self.clock()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap)[3])
+        if not due:
+            return 0
+
+        if self.metrics is not None:
+            if self._last_batch is not None:
+                self.metrics.time('Schedule.period', now - self._last_batch)
+            self._last_batch = now
+
+        try:
+            for hook in self._before:
+                hook(due)
+
+            for task in due:
+                start = self.clock()
+                try:
+                    task.action()
+                finally:
+                    end = self.clock()
+                    task._record(start - task.due, end - start)
+                    if self.metrics is not None:
+                        self.metrics.time(task.name + '.lateness', start - task.due)
+                    self._reschedule(task, end)
+        except BaseException:
+            #If something raised (i.e. the watchdog, see supervisor.py), the
+            #tasks that did not get to run still have to go back on the heap.
+            #This goes by what is on the heap rather than by what ran, so a
+            #task interrupted just after it went back is not pushed twice
+            #(and run twice a period for the rest of the flight).
+            queued = set(entry[3] for entry in self._heap)
+            for task in due:
+                if task not in queued:
+                    self._reschedule(task, self.clock())
+            raise
+
+        return len(due)
+
+
+    def _reschedule(self, task, now):
+        #Move on to the next deadline, skipping any that have passed.
+        task.due += task.period
+        if task.due <= now:
+            missed = int((now - task.due) // task.period) + 1
+            task.overruns += missed
+            if self.metrics is not None:
+                self.metrics.count(task.name + '.overruns', missed)
+            task.due += missed * task.period
+        self._push(task)
+
+
+    def run(self, keep_going=lambda: True):
+        #----------------------------------------
+        '''
+        run(function)
+
+        Runs tasks as they come due, sleeping in between, for as long
+        as keep_going() says so.
+        '''
+        #----------------------------------------
+
+        while keep_going():
+            self.run_pending()
+            wait = self.next_due() - self.clock()
+            if wait > 0:
+                self.sleep(wait)
+
+
+    def report(self):
+        #----------------------------------------
+        '''
+        report() -> string
+
+        A table of each task's timing so far, in milliseconds.
+        '''
+        #----------------------------------------
+
+        lines = ['%-16s %8s %6s %8s %8s %8s %8s %8s' % ('task', 'period', 'runs', 'overrun',
+                                                         'late', 'max late', 'jitter', 'max run')]
+        for task in self.tasks:
+            lines.append('%-16s %8.1f %6d %8d %8.2f %8.2f %8.2f %8.2f' % (
+                task.name, task.period * 1000, task.runs, task.overruns,
+                task.mean_lateness * 1000, task.max_lateness * 1000,
+                task.jitter * 1000, task.max_run_time * 1000))
+
+        return '\n'.join(lines)
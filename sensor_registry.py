@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+'''
+Builds the sensors from the flight config file, so changing the payload
+does not mean changing the flight controller.
+
+The config (flight_config.json, next to flight_controller_2.py) is JSON:
+
+    --chips:    {name: pins} for each MCP3008, i.e. {"Vref": 5.09, "CLK":
+                    11, "Dout": 13, "Din": 15, "CS": 16} for a bit-banged
+                    one (with "clock_delay" for long wiring), or {"Vref": 5.09, "spi": [0, 0]} for one on the
+                    hardware SPI pins (port 0, CE0).
+    --sensors:  A list of sensors, in the order they are started. Each
+                    has a name and a type (a key of DRIVERS). An MCP3008
+                    also names its chip, its pin ([0,1,0] is channel 2)
+                    and its calibration (a formula in terms of volts or a
+                    dictionary, see calibration.make()). period, priority,
+                    deadline, decimation, log_format, log_policy and
+                    log_segments are set on the sensor; "enabled": false leaves it out;
+                    "comment" is ignored. Anything else is passed to the
+                    sensor's class, i.e. "samples" or "vid_length".
+
+and whatever else main() wants to know (the heater, the LED, the radio
+...). Those name the sensors they use.
+
+A sensor's driver module is imported the first time a sensor of that
+type is built, and the hardware libraries (RPi.GPIO, picamera, gps3)
+only when the sensor first uses them (see hardware.py). A sensor that
+cannot be built, i.e. because its library is missing, is left out and
+the rest fly without it.
+'''
+
+import importlib
+import json
+import os
+
+
+#type: (module, class). Add to this (or use register()) for a new driver.
+DRIVERS = {'MCP3008': ('fl_objects_2', 'MCP3008'),
+           'CountSensor': ('fl_objects_2', 'CountSensor'),
+           'GPS': ('fl_objects_2', 'GPS'),
+           'Camera': ('fl_objects_2', 'Camera')}
+
+#What is set on the sensor after it is made, rather than passed to it.
+SETTINGS = ('period', 'priority', 'deadline', 'decimation', 'log_format', 'log_policy', 'log_segments')
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flight_config.json')
+
+
+def register(kind, module, name):
+    #----------------------------------------
+    '''
+    register(string, string, string)
+
+    Adds a sensor type: the module its class is in, and the class.
+    '''
+    #----------------------------------------
+
+    DRIVERS[kind] = (module, name)
+
+
+def driver(kind):
+    #----------------------------------------
+    '''
+    driver(string) -> class
+
+    The class for a sensor type, importing its module if need be.
+    '''
+    #----------------------------------------
+
+    if kind not in DRIVERS:
+        raise ValueError('there is no sensor type ' + repr(kind))
+    module, name = DRIVERS[kind]
+
+    return getattr(importlib.import_module(module), name)
+
+
+def load(file_name=None):
+    #----------------------------------------
+    '''
+    load(file_name=None) -> dictionary
+
+    Reads a flight config (flight_config.json if not given).
+    '''
+    #----------------------------------------
+
+    with open(file_name or DEFAULT_CONFIG) as config_file:
+        return json.load(config_file)
+
+
+def _arguments(spec, chips):
+    #The keyword arguments for the sensor's class.
+    options = {key: value for key, value in spec.items()
+               if key not in SETTINGS + ('name', 'type', 'enabled', 'comment', 'chip', 'calibration')}
+
+    if spec['type'] == 'MCP3008':
+        if spec.get('chip') not in chips:
+            raise ValueError('there is no chip ' + repr(spec.get('chip')))
+        chip = dict(chips[spec['chip']])
+        options['Vref'] = chip.pop('Vref')
+        options['conv'] = spec['calibration']
+        if 'spi' in chip:
+            buses = importlib.import_module(DRIVERS['MCP3008'][0]).MCP3008Bus
+            options['bus'] = buses.spi(*chip['spi'])
+            options.update(CLK=None, Dout=None, Din=None, CS=None)
+        else:
+            options.update(chip)
+
+    return options
+
+
+def build(config):
+    #----------------------------------------
+    '''
+    build(dictionary) -> list of sensors
+
+    Makes every enabled sensor in the config, in order. A sensor that
+    cannot be made is left out, and says why.
+    '''
+    #----------------------------------------
+
+    chips = config.get('chips', {})
+    sensors = []
+    for spec in config.get('sensors', []):
+        if not spec.get('enabled', True):
+            continue
+        try:
+            sensor = driver(spec['type'])(spec['name'], **_arguments(spec, chips))
+            for setting in SETTINGS:
+                if setting in spec:
+                    setattr(sensor, setting, spec[setting])
+        except Exception as error:
+            print(spec.get('name', 'A sensor'), 'could not be set up (%s). It was left out.' % error)
+            continue
+        sensors.append(sensor)
+
+    return sensors
+
+
+def find(sensors, name):
+    #----------------------------------------
+    '''
+    find(list of sensors, string) -> sensor or None
+
+    The sensor with that name, if it was built.
+    '''
+    #----------------------------------------
+
+    for sensor in sensors:
+        if sensor.name == name:
+            return sensor
+
+    return None
@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+'''
+Keeping the SD card from filling up before the payload lands.
+
+The governor looks at the free space on the data directory's disk every
+so often (statvfs, so no df subprocess), works out how fast it is going,
+and from that how long until the disk is full. If that is sooner than
+the flight is expected to end, or the space is below the reserve, it
+steps down one level:
+
+    1   smaller camera resolution, and a picture only every fourth time
+    2   no more video
+    3   only every fourth sensor sample logged
+    4   only every sixteenth
+
+It waits settle seconds after each step so the new rate can be measured
+before it decides whether another is needed. It never steps back up.
+'''
+
+import os
+from time import time
+
+from metrics import registry as metrics
+
+
+def free_bytes(path='.'):
+    #----------------------------------------
+    '''
+    free_bytes(path='.') -> integer
+
+    The bytes an ordinary user can still write on the disk the path is on.
+    '''
+    #----------------------------------------
+
+    stats = os.statvfs(path)
+    return stats.f_bavail * stats.f_frsize
+
+
+class StorageGovernor(object):
+    #######################################################
+    '''
+    StorageGovernor(path='.', camera=None, sensors=(), flight_time=5 * 3600, ...) -> governor object
+
+    --path:         The directory the data are written to.
+    --camera:       The Camera sensor, if there is one.
+    --sensors:      The sensors whose logging can be decimated.
+    --flight_time:  Seconds from start() that the space has to last.
+    --reserve:      Bytes to leave free no matter what.
+    --settle:       Seconds to wait after a step before taking another.
+    --smoothing:    How much of the write rate each check contributes
+                        (0 to 1). Lower is steadier but slower to react.
+    --resolution:   The camera resolution to drop to at level 1.
+    --free:         Optional. A function returning the free bytes, in
+                        place of free_bytes(path).
+
+    check() does the work; call it every ten seconds or so. self.level,
+    self.free, self.rate (bytes/sec) and self.time_to_full say where
+    things stand.
+    '''
+    #######################################################
+
+    LEVELS = 4
+
+    def __init__(self, path='.', camera=None, sensors=(), flight_time=5 * 3600,
+                 reserve=200 * 2**20, settle=120.0, smoothing=0.3, resolution=(1280, 720),
+                 free=None):
+        self.path = path
+        self.camera = camera
+        self.sensors = list(sensors)
+        self.flight_time = flight_time
+        self.reserve = reserve
+        self.settle = settle
+        self.smoothing = smoothing
+        self.resolution = resolution
+        self._free = free or (lambda: free_bytes(self.path))
+
+        self.level = 0
+        self.free = None
+        self.rate = 0.0
+        self.time_to_full = None
+        self.end = None
+        self._last = None
+        self._stepped = 0
+
+
+    def start(self):
+        self.end = time() + self.flight_time
+        self.free = self._free()
+        self._last = (time(), self.free)
+        self._stepped = time()
+
+
+    def check(self):
+        #----------------------------------------
+        '''
+        check() -> integer
+
+        Measures the free space and the rate it is going, steps down a
+        level if the space will not last, and returns the level.
+        '''
+        #----------------------------------------
+
+        if self._last is None:
+            self.start()
+            return self.level
+
+        now = time()
+        self.free = self._free()
+        then, was_free = self._last
+        self._last = (now, self.free)
+        if now > then:
+            rate = (was_free - self.free) / (now - then)
+            self.rate += self.smoothing * (rate - self.rate)
+
+        usable = self.free - self.reserve
+        self.time_to_full = usable / self.rate if self.rate > 0 else None
+        remaining = self.end - now
+
+        short = usable <= 0 or (self.time_to_full is not None and self.time_to_full < remaining)
+        if short and self.level < self.LEVELS and now - self._stepped >= self.settle:
+            self.step()
+            self._stepped = now
+
+        return self.level
+
+
+    def step(self):
+        #----------------------------------------
+        '''
+        step()
+
+        Goes down one level (see the top of this file).
+        '''
+        #----------------------------------------
+
+        self.level += 1
+        metrics.count('Storage.steps')
+        if self.level == 1 and self.camera is not None:
+            self.camera.resolution = self.resolution
+            self.camera.decimation = 4
+            print('Storage: the camera is down to', self.resolution, 'and every fourth picture.')
+        elif self.level == 2 and self.camera is not None:
+            self.camera.video = False
+            print('Storage: the video is off.')
+        elif self.level >= 3:
+            for sensor in self.sensors:
+                sensor.decimation = 4 ** (self.level - 2)
+            print('Storage: logging every', 4 ** (self.level - 2), 'samples.')
+
+
+    def status(self):
+        #----------------------------------------
+        '''
+        status() -> string
+        '''
+        #----------------------------------------
+
+        hours = '%.1f h' % (self.time_to_full / 3600) if self.time_to_full is not None else 'never'
+        return 'Storage: %.0f MB free, %.1f kB/s, full in %s, level %d' % (
+            (self.free or 0) / 2**20, self.rate / 1024, hours, self.level)
@@ -0,0 +1,407 @@
+#!/usr/bin/python3
+'''
+Keeps one bad sensor from taking the flight loop down with it.
+
+Every call the loop makes to a sensor (and to the other jobs) goes
+through the supervisor, which
+
+    --gives it a deadline. In the main thread a timer signal interrupts
+        a call that runs over, so a sensor that hangs costs the loop
+        that long and no longer. The asyncio runtime waits on it for
+        that long instead.
+    --keeps the sensor's health: how its calls have gone, and whether it
+        is ok, failing, or down.
+    --takes a sensor that fails trip_after times in a row out of the
+        loop, then, after backoff seconds, stops it, starts it again and
+        tries it once more. Each time that fails the wait doubles, up to
+        max_backoff. A sensor that fails to start in the first place is
+        tried again the same way, rather than left out for the rest of
+        the flight.
+
+And a watchdog thread interrupts the loop if it has not heard from it
+for watchdog seconds (i.e. it is stuck somewhere no deadline covers),
+and main() starts the loop again.
+'''
+
+import contextlib
+import signal
+import threading
+from time import time, sleep, monotonic
+
+from metrics import registry as metrics
+
+
+class Timeout(Exception):
+    #A call ran past its deadline, or the watchdog lost patience.
+    pass
+
+
+def _alarm(signum, frame):
+    raise Timeout('ran out of time')
+
+
+class Health(object):
+    #######################################################
+    '''
+    Health(string) -> health object
+
+    How one sensor (or job) is doing.
+
+    --state:        'ok', 'failing' (it has failed, but not enough times
+                        in a row to be taken out) or 'down' (out of the
+                        loop until retry_at).
+    --calls:        Calls made.
+    --failures:     Calls that raised or ran out of time.
+    --timeouts:     Calls that ran out of time.
+    --consecutive:  Failures since the last call that worked.
+    --restarts:     Times it was stopped and started again.
+    --last_error:   What went wrong last.
+    --last_ok:      When a call last worked.
+    --started:      Whether it is started (so it needs stopping).
+    '''
+    #######################################################
+
+    def __init__(self, name, backoff):
+        self.name = name
+        self.state = 'ok'
+        self.calls = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.consecutive = 0
+        self.restarts = 0
+        self.last_error = None
+        self.last_ok = None
+        self.started = False
+        self.backoff = backoff
+        self.retry_at = None
+
+
+    def __str__(self):
+        text = '%s: %s, %d calls, %d failed (%d timed out), %d restarts' % (
+            self.name, self.state, self.calls, self.failures, self.timeouts, self.restarts)
+        if self.state == 'down':
+            text += ', retrying in %.0f s' % max(self.retry_at - time(), 0)
+        if self.last_error is not None and self.state != 'ok':
+            text += ', last error: ' + self.last_error
+        return text
+
+
+class Supervisor(object):
+    #######################################################
+    '''
+    Supervisor(deadline=1.0, trip_after=3, backoff=1.0, max_backoff=300.0, watchdog=10.0) -> supervisor object
+
+    --deadline:     Seconds a call may take, for a sensor that does not
+                        set its own (sensor.deadline).
+    --trip_after:   Failures in a row before a sensor is taken out.
+    --backoff:      Seconds before the first try at starting it again.
+    --max_backoff:  The most it will wait between tries.
+    --watchdog:     Seconds the loop can go without feed() before it is
+                        interrupted. 0 for no watchdog.
+
+    Make it in the main thread, so it can set up the timer signal.
+
+    --start(sensor):        Starts a sensor. False if it did not start.
+    --watch(sensor):        The sensor's write(), supervised, for the loop.
+    --guard(name, job):     Any other job, supervised.
+    --stop(sensor):         Stops a sensor, if it is started.
+    --feed():               Tells the watchdog the loop is alive.
+    '''
+    #######################################################
+
+    def __init__(self, deadline=1.0, trip_after=3, backoff=1.0, max_backoff=300.0, watchdog=10.0):
+        self.deadline = deadline
+        self.trip_after = trip_after
+        self.initial_backoff = backoff
+        self.max_backoff = max_backoff
+        self.watchdog = watchdog
+        self.health = {}
+
+        self._main = threading.main_thread()
+        self._timer = (threading.current_thread() is self._main and hasattr(signal, 'setitimer'))
+        if self._timer:
+            signal.signal(signal.SIGALRM, _alarm)
+        self._fed = monotonic()
+        self._watching = False
+        self._watcher = None
+
+
+    def _health(self, name):
+        if name not in self.health:
+            self.health[name] = Health(name, self.initial_backoff)
+        return self.health[name]
+
+
+    @contextlib.contextmanager
+    def limit(self, seconds):
+        #----------------------------------------
+        '''
+        limit(seconds) -> context manager
+
+        Raises Timeout in the block if it is still running after that
+        long. Only in the main thread; anywhere else it does nothing.
+        '''
+        #----------------------------------------
+
+        if not seconds or not self._timer or threading.current_thread() is not self._main:
+            yield
+            return
+        signal.setitimer(signal.ITIMER_REAL, seconds)
+        try:
+            yield
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+    def _deadline(self, sensor):
+        return getattr(sensor, 'deadline', None) or self.deadline
+
+
+    def start(self, sensor):
+        #----------------------------------------
+        '''
+        start(sensor) -> boolean
+
+        Starts a sensor. One that does not start is down, and is tried
+        again after the backoff.
+        '''
+        #----------------------------------------
+
+        health = self._health(sensor.name)
+        try:
+            with self.limit(self._deadline(sensor) * 10):
+                sensor.start()
+        except Exception as error:
+            self._failed(health, error, trip=True)
+            return False
+
+        health.started = True
+        return True
+
+
+    def stop(self, sensor):
+        #----------------------------------------
+        '''
+        stop(sensor)
+
+        Stops a sensor, if it is started.
+        '''
+        #----------------------------------------
+
+        health = self._health(sensor.name)
+        if health.started:
+            health.started = False
+            with self.limit(self._deadline(sensor) * 10):
+                sensor.stop()
+
+
+    def _restart(self, sensor, health):
+        #Stop it (if it will), then start it again.
+        print('Restarting', sensor.name + '.')
+        health.restarts += 1
+        metrics.count(sensor.name + '.restarts')
+        try:
+            self.stop(sensor)
+        except Exception:
+            pass
+
+        if self.start(sensor):
+            #On probation: one more failure and it is straight back out.
+            health.state = 'failing'
+            health.consecutive = self.trip_after - 1
+            return True
+        return False
+
+
+    def _failed(self, health, error, trip=False):
+        health.failures += 1
+        health.consecutive += 1
+        if isinstance(error, Timeout):
+            health.timeouts += 1
+            metrics.count(health.name + '.timeouts')
+        health.last_error = str(error) or type(error).__name__
+
+        if trip or health.consecutive >= self.trip_after:
+            health.state = 'down'
+            health.retry_at = time() + health.backoff
+            print('%s is down (%s). Trying again in %.0f s.' % (health.name, health.last_error, health.backoff))
+            health.backoff = min(health.backoff * 2, self.max_backoff)
+        else:
+            health.state = 'failing'
+
+
+    def _worked(self, health):
+        if health.state != 'ok' and health.restarts:
+            print(health.name, 'is back.')
+        health.state = 'ok'
+        health.consecutive = 0
+        health.backoff = self.initial_backoff
+        health.last_ok = time()
+
+
+    def _ready(self, health, sensor):
+        #Whether to make the call now, restarting the sensor first if its
+        #backoff is up.
+        if health.state != 'down':
+            return True
+        if time() < health.retry_at:
+            return False
+        if sensor is None:
+            return True
+        return self._restart(sensor, health)
+
+
+    def _call(self, name, action, sensor=None):
+        health = self._health(name)
+        if not self._ready(health, sensor):
+            return
+
+        health.calls += 1
+        try:
+            with self.limit(self._deadline(sensor)):
+                action()
+        except Exception as error:
+            self._failed(health, error)
+        else:
+            self._worked(health)
+
+
+    def watch(self, sensor):
+        #----------------------------------------
+        '''
+        watch(sensor) -> function
+
+        The sensor's write(), with a deadline, its health kept, and
+        restarts when it goes down.
+        '''
+        #----------------------------------------
+
+        return lambda: self._call(sensor.name, sensor.write, sensor)
+
+
+    def guard(self, name, job):
+        #----------------------------------------
+        '''
+        guard(string, function) -> function
+
+        Any other job (the status message, the storage check ...), with
+        a deadline and its health kept, so one that raises does not end
+        the flight.
+        '''
+        #----------------------------------------
+
+        return lambda: self._call(name, job)
+
+
+    def awatch(self, sensor):
+        #----------------------------------------
+        '''
+        awatch(sensor) -> coroutine function
+
+        watch() for the asyncio runtime. The sensor's write() runs on its
+        own thread (see Sensor.awrite()), so the deadline is how long it
+        is waited for; a call that hangs only holds up its own sensor.
+        '''
+        #----------------------------------------
+
+        import asyncio
+
+        async def job():
+            health = self._health(sensor.name)
+            if health.state == 'down':
+                if time() < health.retry_at:
+                    return
+                await asyncio.get_event_loop().run_in_executor(sensor._executor(), self._restart, sensor, health)
+                if health.state == 'down':
+                    return
+
+            health.calls += 1
+            try:
+                await asyncio.wait_for(sensor.awrite(), self._deadline(sensor))
+            except asyncio.TimeoutError:
+                self._failed(health, Timeout('ran out of time'))
+            except Exception as error:
+                self._failed(health, error)
+            else:
+                self._worked(health)
+
+        return job
+
+
+    def aguard(self, name, job):
+        #----------------------------------------
+        '''
+        aguard(string, coroutine function) -> coroutine function
+
+        guard() for the asyncio runtime. The deadline is how long the job
+        is waited for.
+        '''
+        #----------------------------------------
+
+        import asyncio
+
+        async def guarded():
+            health = self._health(name)
+            if not self._ready(health, None):
+                return
+
+            health.calls += 1
+            try:
+                await asyncio.wait_for(job(), self.deadline)
+            except asyncio.TimeoutError:
+                self._failed(health, Timeout('ran out of time'))
+            except Exception as error:
+                self._failed(health, error)
+            else:
+                self._worked(health)
+
+        return guarded
+
+
+    def feed(self, *args):
+        #----------------------------------------
+        '''
+        feed()
+
+        Tells the watchdog the loop is still going. Takes (and ignores)
+        arguments so it can be a Scheduler.before_each() hook.
+        '''
+        #----------------------------------------
+
+        self._fed = monotonic()
+
+
+    def start_watchdog(self):
+        if not self.watchdog or not self._timer:
+            return
+        self._fed = monotonic()
+        self._watching = True
+        self._watcher = threading.Thread(target=self._watch, name='Watchdog', daemon=True)
+        self._watcher.start()
+
+
+    def _watch(self):
+        while self._watching:
+            sleep(self.watchdog / 4)
+            stalled = monotonic() - self._fed
+            if self._watching and stalled > self.watchdog:
+                print('The flight loop has not moved for %.0f s. Interrupting it.' % stalled)
+                metrics.count('Watchdog.interrupts')
+                self._fed = monotonic()
+                signal.pthread_kill(self._main.ident, signal.SIGALRM)
+
+
+    def stop_watchdog(self):
+        self._watching = False
+
+
+    def status(self):
+        #----------------------------------------
+        '''
+        status() -> string
+
+        A line for every sensor and job that is not ok.
+        '''
+        #----------------------------------------
+
+        return '\n'.join(str(health) for health in self.health.values() if health.state != 'ok')
@@ -0,0 +1,576 @@
+#!/usr/bin/python3
+'''
+Telemetry down a serial radio, so the ground can follow the flight
+instead of waiting for the payload to be found.
+
+Every so often the latest GPS fix, the four analog readings and the
+counter rates are put in one small frame:
+
+    --sync:     2 bytes, 0xA5 0x5A.
+    --length:   1 byte, the length of the body.
+    --body:     the sequence number (1 byte, counting round), the type
+                    (1 byte, KEY or DELTA), a 2-byte mask of the fields
+                    that are in the frame, then each of those fields as a
+                    zigzag varint.
+    --crc:      2 bytes, the CRC-16/CCITT of the length and the body.
+
+Every field is sent as a whole number of some small unit (see SCHEMA). A
+key frame has the numbers themselves; a delta frame has how much each
+has changed since the frame before, which is usually a byte or two. A
+key frame goes every key_every frames, and whenever a field comes or
+goes, so the ground can pick up the thread after a frame is lost.
+
+The radio is written without ever waiting on it. Frames it has not
+taken yet wait in a small backlog, and when that is full the oldest
+waiting frame is thrown away: the newest position is the one that
+matters.
+
+On the ground:
+
+    ./telemetry.py ground /dev/ttyUSB0 [--baud 9600]
+
+And to try the whole thing over a pseudo-terminal pair, which reports
+the bytes and the encoding time per frame:
+
+    ./telemetry.py bench [--frames 2000]
+'''
+
+import argparse
+import binascii
+import math
+import os
+import struct
+import termios
+import tty
+from collections import deque
+from time import time, sleep, perf_counter, asctime, localtime
+
+from metrics import registry as metrics
+
+
+SYNC = b'\xa5\x5a'
+KEY, DELTA = 1, 2
+
+#(field, units per whole number). The order is the order in the frame,
+#and the bit in the mask.
+SCHEMA = [('time', 1),              #seconds since the epoch
+          ('lat', 10**7),           #1e-7 degrees, about a centimetre
+          ('lon', 10**7),
+          ('alt', 10),              #decimetres
+          ('climb', 100),           #cm/s
+          ('speed', 100),           #cm/s
+          ('Inside_temp', 100),     #0.01 C
+          ('Outside_temp', 100),
+          ('Light', 1000),          #mV
+          ('Pressure', 10),         #0.1 mbar
+          ('Counts', 100)]          #0.01 counts a second
+
+_HEADER = struct.Struct('<BBBH')
+
+
+def _crc(data):
+    #CRC-16/CCITT, done in C by binascii.
+    return binascii.crc_hqx(data, 0xFFFF)
+
+
+def _varint(number, out):
+    #Zigzag, so small negative numbers are small too, then 7 bits a byte.
+    number = (number << 1) ^ (number >> 63)
+    while number > 0x7F:
+        out.append((number & 0x7F) | 0x80)
+        number >>= 7
+    out.append(number)
+
+
+def _read_varint(data, offset):
+    number = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        number |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return (number >> 1) ^ -(number & 1), offset
+
+
+class Encoder(object):
+    #######################################################
+    '''
+    Encoder(schema=SCHEMA, key_every=12) -> encoder object
+
+    Turns a dictionary of readings into frames. encode() remembers what
+    it sent last, for the deltas.
+    '''
+    #######################################################
+
+    def __init__(self, schema=SCHEMA, key_every=12):
+        self.schema = schema
+        self.key_every = key_every
+        self.sequence = 0
+        self._last = None
+        self._since_key = 0
+
+
+    def encode(self, values):
+        #----------------------------------------
+        '''
+        encode(dictionary) -> bytes
+
+        Makes the next frame. A reading that is missing, None or NaN is
+        left out.
+        '''
+        #----------------------------------------
+
+        numbers = []
+        mask = 0
+        for bit, (field, scale) in enumerate(self.schema):
+            value = values.get(field)
+            if value is None or (isinstance(value, float) and math.isnan(value)):
+                continue
+            mask |= 1 << bit
+            numbers.append(int(round(value * scale)))
+
+        key = (self._last is None or self._last[0] != mask or self._since_key >= self.key_every - 1)
+        body = bytearray()
+        if key:
+            for number in numbers:
+                _varint(number, body)
+            self._since_key = 0
+        else:
+            for number, last in zip(numbers, self._last[1]):
+                _varint(number - last, body)
+            self._since_key += 1
+        self._last = (mask, numbers)
+
+        head = _HEADER.pack(len(body) + 4, self.sequence, KEY if key else DELTA, mask)
+        self.sequence = (self.sequence + 1) & 0xFF
+        frame = head[1:] + body
+        crc = _crc(head[:1] + frame)
+
+        return SYNC + head[:1] + frame + struct.pack('<H', crc)
+
+
+class Decoder(object):
+    #######################################################
+    '''
+    Decoder(schema=SCHEMA) -> decoder object
+
+    Finds the frames in whatever comes off the radio and decodes them.
+    feed() can be given any amount of bytes at a time; a frame split
+    between two feeds is put back together.
+
+    --frames:       Frames decoded.
+    --crc_errors:   Frames thrown away for a bad CRC.
+    --lost:         Frames missing, going by the sequence numbers.
+    --waiting:      Delta frames that could not be decoded because the
+                        frame before them was lost. The next key frame
+                        puts things right.
+    '''
+    #######################################################
+
+    def __init__(self, schema=SCHEMA):
+        self.schema = schema
+        self.frames = 0
+        self.crc_errors = 0
+        self.lost = 0
+        self.waiting = 0
+        self._buffer = bytearray()
+        self._last = None
+        self._sequence = None
+
+
+    def feed(self, data):
+        #----------------------------------------
+        '''
+        feed(bytes) -> list of dictionaries
+
+        Every frame completed by the data, as {field: reading}, with the
+        frame's 'sequence' as well.
+        '''
+        #----------------------------------------
+
+        self._buffer += data
+        decoded = []
+        while True:
+            start = self._buffer.find(SYNC)
+            if start < 0:
+                #Keep a last byte that could be half of the sync.
+                del self._buffer[:max(len(self._buffer) - 1, 0)]
+                return decoded
+            del self._buffer[:start]
+            if len(self._buffer) < 3:
+                return decoded
+            end = 3 + self._buffer[2] + 2
+            if len(self._buffer) < end:
+                return decoded
+
+            frame = bytes(self._buffer[2:end])
+            if struct.unpack('<H', frame[-2:])[0] != _crc(frame[:-2]):
+                #Not a frame after all, or a damaged one. Look for the
+                #next sync after this one.
+                self.crc_errors += 1
+                del self._buffer[:1]
+                continue
+            del self._buffer[:end]
+
+            values = self._decode(frame[1:-2])
+            if values is not None:
+                decoded.append(values)
+
+
+    def _decode(self, body):
+        sequence, kind, mask = struct.unpack_from('<BBH', body)
+        if self._sequence is not None:
+            self.lost += (sequence - self._sequence - 1) & 0xFF
+        self._sequence = sequence
+
+        fields = [(field, scale) for bit, (field, scale) in enumerate(self.schema) if mask & (1 << bit)]
+        numbers = []
+        offset = 4
+        for field in fields:
+            number, offset = _read_varint(body, offset)
+            numbers.append(number)
+
+        if kind == DELTA:
+            if self._last is None or self._last[0] != mask or self._last[2] != (sequence - 1) & 0xFF:
+                self.waiting += 1
+                self._last = None
+                return None
+            numbers = [last + delta for last, delta in zip(self._last[1], numbers)]
+        self._last = (mask, numbers, sequence)
+        self.frames += 1
+
+        values = {'sequence': sequence}
+        for (field, scale), number in zip(fields, numbers):
+            values[field] = number / scale if scale != 1 else number
+
+        return values
+
+
+def _configure(fd, baud):
+    #Raw bytes at the given speed: no echo, no line editing, no newline
+    #translation, which would all mangle a binary frame.
+    tty.setraw(fd)
+    attributes = termios.tcgetattr(fd)
+    speed = getattr(termios, 'B%d' % baud)
+    attributes[4] = attributes[5] = speed
+    termios.tcsetattr(fd, termios.TCSANOW, attributes)
+
+
+class SerialLink(object):
+    #######################################################
+    '''
+    SerialLink(string, baud=9600, backlog=512) -> link object
+
+    --device:   The serial port the radio is on, i.e. /dev/serial0.
+    --baud:     The speed of the port.
+    --backlog:  The most bytes to keep waiting for the radio. Past that,
+                    the oldest frames that have not started going out are
+                    thrown away (and counted in self.dropped).
+
+    The port is opened non-blocking, so send() and pump() never wait:
+    they write what the port will take and keep the rest for next time.
+    '''
+    #######################################################
+
+    def __init__(self, device, baud=9600, backlog=512):
+        self.device = device
+        self.backlog = backlog
+        self.fd = os.open(device, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        _configure(self.fd, baud)
+
+        self._frames = deque()
+        self._offset = 0
+        self.waiting = 0
+        self.sent = 0
+        self.dropped = 0
+
+
+    def send(self, frame):
+        #----------------------------------------
+        '''
+        send(bytes)
+
+        Queues a frame and writes as much as the port will take.
+        '''
+        #----------------------------------------
+
+        #Make room, starting with the oldest. The one going out now is
+        #kept, or the ground gets half a frame.
+        while self._frames and self.waiting + len(frame) > self.backlog:
+            index = 1 if self._offset else 0
+            if index >= len(self._frames):
+                break
+            dropped = self._frames[index]
+            del self._frames[index]
+            self.waiting -= len(dropped)
+            self.dropped += 1
+            metrics.count('Telemetry.evictions')
+
+        self._frames.append(frame)
+        self.waiting += len(frame)
+        self.pump()
+
+
+    def pump(self):
+        #----------------------------------------
+        '''
+        pump() -> integer
+
+        Writes as much of the backlog as the port will take, and returns
+        the bytes still waiting.
+        '''
+        #----------------------------------------
+
+        while self._frames:
+            frame = self._frames[0]
+            try:
+                written = os.write(self.fd, frame[self._offset:])
+            except BlockingIOError:
+                break
+            self._offset += written
+            self.waiting -= written
+            self.sent += written
+            if self._offset < len(frame):
+                break
+            self._frames.popleft()
+            self._offset = 0
+
+        return self.waiting
+
+
+    def receive(self, size=4096):
+        #----------------------------------------
+        '''
+        receive(size=4096) -> bytes
+
+        Whatever has come in, without waiting (b'' if nothing has).
+        '''
+        #----------------------------------------
+
+        try:
+            return os.read(self.fd, size)
+        except BlockingIOError:
+            return b''
+
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Telemetry(object):
+    #######################################################
+    '''
+    Telemetry(SerialLink, dictionary, period=5.0, key_every=12) -> telemetry object
+
+    --link:      Where the frames go.
+    --sources:   {field: function} for each field of SCHEMA there is
+                     something for. A function returns the reading, or
+                     None if it does not have one.
+    --period:    Seconds between frames. The flight loop calls send()
+                     this often, and pump() often enough to keep the
+                     radio busy.
+
+    self.frames, self.bytes and the metrics 'Telemetry.encode' and
+    'Telemetry.bytes' say how big and how costly the frames are.
+    '''
+    #######################################################
+
+    def __init__(self, link, sources, period=5.0, key_every=12):
+        self.link = link
+        self.sources = sources
+        self.period = period
+        self.encoder = Encoder(SCHEMA, key_every)
+        self.frames = 0
+        self.bytes = 0
+
+
+    def send(self):
+        values = {}
+        for field, source in self.sources.items():
+            try:
+                values[field] = source()
+            except Exception:
+                values[field] = None
+
+        began = perf_counter()
+        frame = self.encoder.encode(values)
+        metrics.time('Telemetry.encode', perf_counter() - began)
+        metrics.count('Telemetry.bytes', len(frame))
+        self.frames += 1
+        self.bytes += len(frame)
+        self.link.send(frame)
+
+
+    def pump(self):
+        self.link.pump()
+
+
+    def close(self):
+        self.link.close()
+
+
+def latest(sensor, field=None, max_age=30.0):
+    #----------------------------------------
+    '''
+    latest(sensor, field=None, max_age=30.0) -> function
+
+    A source for Telemetry: the sensor's latest reading (the field of it,
+    for the GPS), or None if it is older than max_age seconds.
+    '''
+    #----------------------------------------
+
+    def source():
+        if sensor.latest is None or time() - sensor.latest[0] > max_age:
+            return None
+        value = sensor.latest[1] if field is None else sensor.latest[1].get(field)
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            #gpsd says 'n/a' for anything it does not know yet.
+            return None
+
+    return source
+
+
+def rate(sensor, max_age=30.0):
+    #----------------------------------------
+    '''
+    rate(CountSensor, max_age=30.0) -> function
+
+    A source for Telemetry: a counter's counts a second over its last
+    reading, or None if that is older than max_age seconds. latest()
+    will not do for a counter; its reading is the count and the window.
+    '''
+    #----------------------------------------
+
+    def source():
+        if sensor.latest is None or time() - sensor.latest[0] > max_age:
+            return None
+        count, window = sensor.latest[1][:2]
+        return float(count) / float(window) if float(window) > 0 else None
+
+    return source
+
+
+def ground(device, baud=9600):
+    #----------------------------------------
+    '''
+    ground(string, baud=9600)
+
+    Prints every frame that comes in on the ground station's radio,
+    until Ctrl-C.
+    '''
+    #----------------------------------------
+
+    link = SerialLink(device, baud)
+    decoder = Decoder()
+    try:
+        while True:
+            data = link.receive()
+            if not data:
+                sleep(0.05)
+                continue
+            for values in decoder.feed(data):
+                stamp = asctime(localtime(values['time'])) if 'time' in values else '?'
+                print(stamp, ' '.join('%s=%s' % (field, values[field]) for field, scale in SCHEMA
+                                      if field in values and field != 'time'))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        link.close()
+        print('%d frames, %d lost, %d bad CRC, %d undecodable' % (
+            decoder.frames, decoder.lost, decoder.crc_errors, decoder.waiting))
+
+
+def bench(frames=2000, key_every=12):
+    #----------------------------------------
+    '''
+    bench(frames=2000, key_every=12) -> dictionary
+
+    Sends a made-up flight through a pseudo-terminal pair, decodes it at
+    the other end, and checks that every reading came through to within
+    its unit. Returns the bytes and time per frame.
+    '''
+    #----------------------------------------
+
+    master, slave = os.openpty()
+    os.set_blocking(master, False)
+    link = SerialLink(os.ttyname(slave), backlog=1 << 20)
+    encoder = Encoder(key_every=key_every)
+    decoder = Decoder()
+
+    sent = []
+    decoded = []
+    sizes = {KEY: [], DELTA: []}
+    encoding = 0.0
+    start = time()
+    for i in range(frames):
+        t = start + 5 * i
+        values = {'time': t, 'lat': 41.5 + i * 2e-5, 'lon': -90.2 + i * 3e-5, 'alt': 200 + 5 * i * 5.0,
+                  'climb': 5.0 + math.sin(i / 7), 'speed': 8 + math.cos(i / 5),
+                  'Inside_temp': 21 + math.sin(i / 50), 'Outside_temp': 15 - i * 0.05,
+                  'Light': 2.5 + 0.3 * math.sin(i / 3), 'Pressure': 1013 * math.exp(-i * 25 / 8000),
+                  'Counts': 0.5 + i * 0.01}
+        began = perf_counter()
+        frame = encoder.encode(values)
+        encoding += perf_counter() - began
+        sizes[frame[4]].append(len(frame))
+        sent.append(values)
+
+        link.send(frame)
+        while link.pump():
+            decoded += decoder.feed(_drain(master))
+        decoded += decoder.feed(_drain(master))
+    decoded += decoder.feed(_drain(master))
+    link.close()
+    os.close(master)
+
+    #Everything should come back, to within half a unit.
+    errors = 0
+    for values, back in zip(sent, decoded):
+        for field, scale in SCHEMA:
+            if abs(values[field] - back[field]) > 0.5 / scale + 1e-9:
+                errors += 1
+
+    everything = sizes[KEY] + sizes[DELTA]
+    return {'frames': frames, 'decoded': len(decoded), 'mismatched readings': errors,
+            'bytes per frame': sum(everything) / len(everything),
+            'bytes per key frame': sum(sizes[KEY]) / max(len(sizes[KEY]), 1),
+            'bytes per delta frame': sum(sizes[DELTA]) / max(len(sizes[DELTA]), 1),
+            'encode microseconds per frame': encoding / frames * 1e6}
+
+
+def _drain(fd):
+    data = []
+    while True:
+        try:
+            chunk = os.read(fd, 4096)
+        except (BlockingIOError, OSError):
+            break
+        if not chunk:
+            break
+        data.append(chunk)
+    return b''.join(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Balloon telemetry: the ground station, or a loopback bench.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    ground_parser = commands.add_parser('ground', help='decode frames from the ground radio')
+    ground_parser.add_argument('device', help='the serial port, i.e. /dev/ttyUSB0')
+    ground_parser.add_argument('--baud', type=int, default=9600, help='the port speed (default: 9600)')
+    bench_parser = commands.add_parser('bench', help='send a made-up flight over a pseudo-terminal')
+    bench_parser.add_argument('--frames', type=int, default=2000, help='how many frames (default: 2000)')
+    bench_parser.add_argument('--key-every', type=int, default=12, help='a key frame every so many (default: 12)')
+    args = parser.parse_args()
+
+    if args.command == 'ground':
+        ground(args.device, args.baud)
+    else:
+        for name, value in bench(args.frames, args.key_every).items():
+            print('%-30s %10.2f' % (name, value))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+'''
+The tests run against the simulated hardware in hardware.py, from any
+directory, with nothing but numpy and pytest installed:
+
+    python -m pytest -q tests
+'''
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BALLOONSAT_BACKEND', 'sim')
+
+import hardware
+
+
+@pytest.fixture
+def sim():
+    #A fresh, empty simulator for each test, and no buses left over from
+    #the one before.
+    import fl_objects_2
+    backend = hardware.SimBackend()
+    hardware.set_backend(backend)
+    saved = fl_objects_2.MCP3008Bus._buses
+    fl_objects_2.MCP3008Bus._buses = {}
+    yield backend
+    fl_objects_2.MCP3008Bus._buses = saved
+    if backend.gpsd is not None:
+        backend.gpsd.stop()
+    hardware.set_backend(None)
+
+
+@pytest.fixture
+def in_tmp(tmp_path, monkeypatch):
+    #The sensors write their data files to data/ under the working directory.
+    (tmp_path / 'data').mkdir()
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,67 @@
+'''
+The MCP3008 transports against VirtualMCP3008: the bit-banged one through
+SimGPIO, and the SPI one through FakeSpiDev.
+'''
+
+import pytest
+
+from fl_objects_2 import BitBangTransport, SpiTransport, MCP3008, MCP3008Bus
+
+
+VREF = 5.0
+PINS = (11, 13, 15, 16)
+VOLTAGES = {0: 0.0, 1: 0.7, 2: 1.25, 3: 2.5, 4: 3.3, 5: 4.2, 6: 4.99, 7: VREF}
+
+
+def expected(volts):
+    return min(max(int(round(volts / VREF * 1023)), 0), 1023)
+
+
+@pytest.fixture
+def chip(sim):
+    chip = sim.add_mcp3008(VREF, *PINS, voltages=VOLTAGES)
+    sim.attach_spi(chip, 0, 0)
+    return chip
+
+
+def test_bitbang_reads_every_channel(chip):
+    transport = BitBangTransport(*PINS, clock_delay=0)
+    for channel, volts in VOLTAGES.items():
+        assert transport.convert(channel) == expected(volts)
+    assert chip.conversions == len(VOLTAGES)
+
+
+def test_spi_reads_every_channel(chip):
+    transport = SpiTransport(0, 0)
+    for channel, volts in VOLTAGES.items():
+        assert transport.convert(channel) == expected(volts)
+    assert chip.conversions == len(VOLTAGES)
+
+
+def test_transports_agree_on_a_changing_voltage(chip):
+    #An iterable source gives its next value at every conversion.
+    ramp = [VREF * i / 50 for i in range(51)]
+    chip.set_voltage(2, [volts for volts in ramp for twice in (0, 1)])
+    bitbang = BitBangTransport(*PINS, clock_delay=0)
+    spi = SpiTransport(0, 0)
+    for volts in ramp:
+        assert bitbang.convert(2) == expected(volts)
+        assert spi.convert(2) == expected(volts)
+
+
+def test_out_of_range_voltages_clip(chip):
+    chip.set_voltage(0, -1.0)
+    chip.set_voltage(1, VREF + 1.0)
+    for transport in (BitBangTransport(*PINS, clock_delay=0), SpiTransport(0, 0)):
+        assert transport.convert(0) == 0
+        assert transport.convert(1) == 1023
+
+
+@pytest.mark.parametrize('bus', ['bitbang', 'spi'])
+def test_sensor_reading_is_calibrated(chip, bus):
+    bus = MCP3008Bus.spi(0, 0) if bus == 'spi' else None
+    sensor = MCP3008('Outside_temp', VREF, *PINS, pin=[0, 1, 0], conv='(volts - 1.25) / 0.005',
+                     bus=bus, samples=4)
+    volts = expected(1.25) / 1023 * VREF
+    assert sensor.get() == pytest.approx((volts - 1.25) / 0.005)
+    assert chip.conversions == 4
@@ -0,0 +1,56 @@
+'''
+The asyncio runtime's jobs, guarded by the supervisor.
+'''
+
+import asyncio
+
+import pytest
+
+import async_runtime
+from supervisor import Supervisor
+
+
+def counting(runs, stop_after):
+    #Ends the run by cancelling every task, which the supervisor lets through.
+    async def job():
+        runs.append(1)
+        if len(runs) == stop_after:
+            for task in asyncio.all_tasks():
+                task.cancel()
+    return job
+
+
+def test_a_job_that_raises_does_not_end_the_run():
+    async def storage_check():
+        raise OSError('statvfs failed')
+
+    supervisor = Supervisor(watchdog=None)
+    runs = []
+    with pytest.raises(asyncio.CancelledError):
+        async_runtime.run([], [('Storage', storage_check, 0.01),
+                               ('Status', counting(runs, 10), 0.01)], supervisor)
+    assert len(runs) == 10
+    health = supervisor.health['Storage']
+    assert health.failures == 3 and health.state == 'down'
+    assert health.last_error == 'statvfs failed'
+    assert supervisor.health['Status'].state == 'ok'
+
+
+def test_a_job_that_hangs_runs_out_of_time():
+    async def radio():
+        await asyncio.sleep(10)
+
+    supervisor = Supervisor(deadline=0.05, watchdog=None)
+    runs = []
+    with pytest.raises(asyncio.CancelledError):
+        async_runtime.run([], [('Radio', radio, 0.01),
+                               ('Status', counting(runs, 20), 0.01)], supervisor)
+    assert supervisor.health['Radio'].timeouts >= 1
+
+
+def test_without_a_supervisor_it_ends_the_run():
+    async def storage_check():
+        raise OSError('statvfs failed')
+
+    with pytest.raises(OSError):
+        async_runtime.run([], [('Storage', storage_check, 0.01)])
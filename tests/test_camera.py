@@ -0,0 +1,68 @@
+'''
+The camera thread against FakeCamera.
+'''
+
+import errno
+from time import time, sleep
+
+import pytest
+
+import hardware
+from fl_objects_2 import Camera
+from supervisor import Supervisor
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time() + timeout
+    while not condition():
+        if time() > deadline:
+            raise AssertionError('gave up waiting')
+        sleep(0.01)
+
+
+@pytest.fixture
+def camera(sim, in_tmp):
+    sim.camera_options = {'still_latency': 0.01, 'still_bytes': 64}
+    sensor = Camera('Camera', vid_length=0.2)
+    yield sensor
+    if getattr(sensor, '_thread', None) is not None:
+        sensor.stop()
+
+
+def full_card(*args, **kwargs):
+    raise OSError(errno.ENOSPC, 'No space left on device')
+
+
+def test_takes_stills_and_splits_the_video(sim, camera):
+    camera.start()
+    for i in range(3):
+        camera.write()
+        sleep(0.15)
+    wait_for(lambda: camera.pictures == 3)
+    assert camera.videos >= 2
+    assert camera.error is None and camera.dropped == 0
+
+
+def test_dead_thread_is_flagged_and_restarted(sim, camera):
+    #The card fills up: the thread stops, and the next write raises
+    #instead of quietly counting the pictures it can no longer take.
+    camera.start()
+    sim.cameras[-1].capture = full_card
+    camera.write()
+    wait_for(lambda: not camera._thread.is_alive())
+    assert camera.error.errno == errno.ENOSPC
+    with pytest.raises(RuntimeError):
+        camera.write()
+
+    supervisor = Supervisor(trip_after=1, backoff=0.1, watchdog=None)
+    write = supervisor.watch(camera)
+    write()
+    assert supervisor.health['Camera'].state == 'down'
+
+    #Room again, and a new camera.
+    sleep(0.2)
+    write()
+    assert camera._thread.is_alive() and sim.cameras[-1] is camera.camera
+    write()
+    wait_for(lambda: camera.pictures >= 1)
+    assert supervisor.health['Camera'].state == 'ok'
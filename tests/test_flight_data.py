@@ -0,0 +1,64 @@
+'''
+Loading a flight's data files back for the analysis.
+'''
+
+from time import asctime, localtime
+
+import numpy as np
+
+import flight_data
+from logwriter import BinaryLogWriter, SegmentedBinaryLogWriter
+
+
+T = 1503336600.0
+
+
+def test_binary_file_with_no_records(tmp_path):
+    #A sensor that opened its log and never recorded, and a segment that
+    #rolled over just before the end, next to one that did record.
+    BinaryLogWriter(str(tmp_path / 'Light_data_x.bin'), 'Light', 'MCP3008', fsync=False).open().close()
+    log = SegmentedBinaryLogWriter(str(tmp_path / 'Pressure_data_x.bin'), 'Pressure', 'MCP3008',
+                                   segment_bytes=1, fsync=False).open()
+    log.record(T, [1013.0])
+    log._end_segment()
+    log._next_segment()
+    log.close()
+
+    empty = flight_data.load_file(str(tmp_path / 'Light_data_x.bin'))
+    assert len(empty) == 0
+
+    streams = flight_data.load_flight(str(tmp_path), cache=False)
+    assert len(streams['Light']) == 0
+    assert streams['Pressure'].times.tolist() == [T]
+    assert np.array_equal(streams['Pressure']['reading'], [1013.0])
+
+
+def test_read_text_headers_and_ragged_rows():
+    text = ('\nNew data.\nCalibration: {"gain": 2}\n\n'
+            '1503336600.0,1.0,2.0\n1503336601.0,3.0\n'
+            '\nNew data.\n\nNew data.\nCalibration: "volts"\n\n'
+            '1503336602.0,5.0,6.0\n'
+            '\nNew data.\nCalibration: "never used"\n\n')
+    headers, times, rows = flight_data.read_text(text)
+    assert headers == [(0, {'calibration': {'gain': 2}}), (2, {'calibration': 'volts'})]
+    assert times.tolist() == [1503336600.0, 1503336601.0, 1503336602.0]
+    assert rows.tolist() == [['1.0', '2.0'], ['3.0', ''], ['5.0', '6.0']]
+
+
+def test_recovered_files_add_only_what_was_lost(tmp_path):
+    #The journal's copy repeats the sensor's own file, and has the last few
+    #records the power cut kept from reaching it.
+    def write(name, seconds):
+        with open(str(tmp_path / name), 'w') as f:
+            f.write('\nNew data.\n\n')
+            f.writelines('%s,%d\n' % (asctime(localtime(T + second)), second) for second in seconds)
+
+    write('Light_data_Mon.txt', range(10))
+    write('Light_data_recovered_Tue.txt', range(13))
+    write('Pressure_data_recovered_Tue.txt', range(3))
+
+    streams = flight_data.load_flight(str(tmp_path), cache=False)
+    assert streams['Light']['reading'].tolist() == list(range(13))
+    assert np.all(np.diff(streams['Light'].times) > 0)
+    #With the sensor's own files gone, the journal's copy is all there is.
+    assert streams['Pressure']['reading'].tolist() == [0, 1, 2]
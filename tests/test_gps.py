@@ -0,0 +1,126 @@
+'''
+The GPS reader thread against FakeGPSD.
+'''
+
+from time import time, sleep, perf_counter, process_time
+
+import pytest
+
+import hardware
+from fl_objects_2 import GPS
+from supervisor import Supervisor
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time() + timeout
+    while not condition():
+        if time() > deadline:
+            raise AssertionError('gave up waiting')
+        sleep(0.01)
+
+
+@pytest.fixture
+def gps(sim):
+    sensor = GPS('GPS')
+    sensor.logging = False
+    yield sensor
+    if getattr(sensor, '_thread', None) is not None:
+        sensor.stop()
+
+
+def test_reader_merges_reports(sim, gps):
+    #The second report only has the position. Everything else keeps its
+    #value from the first; the last report repeats from then on.
+    first = hardware.bench_fix(1500000000)
+    second = {'class': 'TPV', 'lat': 41.7, 'lon': -91.6}
+    sim.gps_fixes, sim.gps_rate = [first, second], 50.0
+    gps.start()
+    wait_for(lambda: gps.reports >= 2)
+
+    fix_time, fix = gps.fix()
+    assert fix['lat'] == 41.7 and fix['lon'] == -91.6
+    assert fix['alt'] == first['alt'] and fix['time'] == first['time']
+    assert time() - fix_time < 1.0
+    assert gps.latest[0] == pytest.approx(fix_time, abs=0.1)
+    assert gps.latest[1]['lat'] == 41.7
+
+
+def test_get_does_not_wait_on_gpsd(sim, gps):
+    #One report every 10 s. Reading in between must not block on the socket.
+    sim.gps_fixes, sim.gps_rate = [hardware.bench_fix(1500000000)], 0.1
+    gps.start()
+    wait_for(lambda: gps.reports >= 1)
+
+    start = perf_counter()
+    for i in range(100):
+        fields = gps.get()
+    assert perf_counter() - start < 0.1
+    assert fields[1:] == [hardware.bench_fix(1500000000)[field] for field in GPS.FIELDS]
+
+
+def test_nothing_yet_is_na(sim, gps):
+    sim.gps_fixes, sim.gps_rate = [hardware.bench_fix(1500000000)], 0.1
+    fix_time, fix = gps.fix()
+    assert fix_time is None
+    assert set(fix.values()) == {'n/a'}
+
+
+def test_non_tpv_reports_are_ignored(sim, gps):
+    sky = {'class': 'SKY', 'lat': 0.0}
+    sim.gps_fixes, sim.gps_rate = lambda t: sky, 50.0
+    gps.start()
+    sleep(0.2)
+    #FakeGPSD marks anything without a class as TPV, so SKY is sent as is.
+    assert gps.reports == 0
+    assert gps.latest is None
+
+
+def test_replayed_nmea_log(sim, gps, tmp_path):
+    log = tmp_path / 'gps.nmea'
+    #The GGA with the bad checksum is dropped.
+    log.write_text('$GPGGA,173000.00,4139.666,N,09131.812,W,1,08,0.9,230.5,M,,,,*25\n'
+                   '$GPGGA,173000.00,4139.666,N,09131.812,W,1,08,0.9,999.9,M,,,,*25\n'
+                   '$GPRMC,173000.00,A,4139.666,N,09131.812,W,10.0,90.0,210817,,*29\n')
+    fixes = hardware.read_gps_log(open(log))
+    assert len(fixes) == 1
+    sim.gps_fixes, sim.gps_rate = fixes, 50.0
+    gps.start()
+    wait_for(lambda: gps.reports >= 1)
+
+    fix_time, fix = gps.fix()
+    assert fix['lat'] == pytest.approx(41 + 39.666 / 60)
+    assert fix['lon'] == pytest.approx(-(91 + 31.812 / 60))
+    assert fix['alt'] == 230.5
+    assert fix['speed'] == pytest.approx(10.0 * 0.514444)
+    assert fix['time'] == '2017-08-21T17:30:00.00Z'
+
+
+def test_gpsd_going_away_is_flagged_and_restarted(sim, gps, in_tmp):
+    #Once gpsd closes the socket the reader stops (rather than spinning on
+    #the empty reads) and get() raises. The supervisor then restarts the
+    #sensor, which starts gpsd again and connects to it.
+    sim.gps_fixes, sim.gps_rate = [hardware.bench_fix(1500000000)], 50.0
+    gps.logging = True
+    gps.start()
+    wait_for(lambda: gps.reports >= 1)
+
+    cpu = process_time()
+    sim.gpsd.stop()
+    wait_for(lambda: not gps._thread.is_alive())
+    sleep(0.5)
+    assert process_time() - cpu < 0.3
+    with pytest.raises(ConnectionError):
+        gps.get()
+
+    supervisor = Supervisor(trip_after=1, backoff=0.1, watchdog=None)
+    write = supervisor.watch(gps)
+    write()
+    assert supervisor.health['GPS'].state == 'down'
+
+    reports = gps.reports
+    sleep(0.2)
+    write()
+    assert gps._thread.is_alive()
+    wait_for(lambda: gps.reports > reports)
+    write()
+    assert supervisor.health['GPS'].state == 'ok'
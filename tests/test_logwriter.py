@@ -0,0 +1,90 @@
+'''
+Segmented, compressed data files: what goes in comes back out of
+read_segment(), segment by segment, and the index says where it is.
+'''
+
+import io
+import os
+
+import pytest
+
+import records
+from logwriter import SegmentedLogWriter, SegmentedBinaryLogWriter, read_segment, read_index
+
+
+T = 1503336600.0
+SAMPLES = [(T + i * 0.05, [20.0 + (i % 97) / 8]) for i in range(2000)]
+
+
+def read_binary(names):
+    out = []
+    for name in names:
+        out.extend(record for header, record in records.read_records(io.BytesIO(read_segment(name))))
+    return out
+
+
+@pytest.mark.parametrize('compression', ['zlib', 'lzma', None])
+def test_binary_segments_round_trip(tmp_path, compression):
+    stream = str(tmp_path / 'Light_data_today.bin')
+    log = SegmentedBinaryLogWriter(stream, 'Light', 'MCP3008', compression=compression,
+                                   segment_bytes=4096, flush_records=50, fsync=False).open()
+    for timestamp, fields in SAMPLES:
+        log.record(timestamp, fields)
+    log.close()
+
+    index = read_index(str(tmp_path / 'Light_data_today.index'))
+    assert len(index) > 1
+    names = [str(tmp_path / entry['segment']) for entry in index]
+    assert read_binary(names) == [(timestamp, fields[0]) for timestamp, fields in SAMPLES]
+
+    #Each entry says what its segment holds.
+    assert sum(entry['records'] for entry in index) == len(SAMPLES)
+    for entry, name in zip(index, names):
+        held = read_binary([name])
+        assert (entry['first'], entry['last'], entry['records']) == (held[0][0], held[-1][0], len(held))
+        assert entry['bytes'] == os.path.getsize(name)
+    if compression is not None:
+        assert log.compressed_bytes < log.raw_bytes
+
+
+def test_text_segments_round_trip(tmp_path):
+    stream = str(tmp_path / 'Light_data_today.txt')
+    log = SegmentedLogWriter(stream, header={'calibration': 'volts'}, segment_bytes=2048,
+                             flush_records=50, fsync=False).open()
+    for timestamp, fields in SAMPLES:
+        log.record(timestamp, fields)
+    log.close()
+
+    lines = []
+    for entry in read_index(str(tmp_path / 'Light_data_today.index')):
+        text = read_segment(str(tmp_path / entry['segment'])).decode()
+        #Every segment starts with the header, so it stands on its own.
+        assert text.startswith('\nNew data.\nCalibration: "volts"\n\n')
+        lines.extend(text.splitlines()[4:])
+    assert [line.split(',', 1)[1] for line in lines] == [str(fields[0]) for timestamp, fields in SAMPLES]
+
+
+@pytest.mark.parametrize('compression', ['zlib', 'lzma'])
+def test_segment_cut_short_keeps_what_was_flushed(tmp_path, compression):
+    #A power cut mid-segment: no end to the compressed stream, and half a
+    #batch torn off.
+    stream = str(tmp_path / 'Light_data_today.bin')
+    log = SegmentedBinaryLogWriter(stream, 'Light', 'MCP3008', compression=compression,
+                                   flush_records=100, fsync=False).open()
+    for timestamp, fields in SAMPLES[:500]:
+        log.record(timestamp, fields)
+    log.flush()
+    flushed = log.file.tell()
+    for timestamp, fields in SAMPLES[500:550]:
+        log.record(timestamp, fields)
+    log.flush()
+    log.file.close()
+    with open(log.file_name, 'r+b') as f:
+        f.truncate(flushed + (os.path.getsize(log.file_name) - flushed) // 2)
+
+    #Everything flushed comes back, then as much of the torn batch as can
+    #be decompressed, up to the last whole record.
+    read = read_binary([log.file_name])
+    written = [(timestamp, fields[0]) for timestamp, fields in SAMPLES[:550]]
+    assert 500 <= len(read) < 550
+    assert read == written[:len(read)]
@@ -0,0 +1,69 @@
+'''
+Binary data files: records packed by BinaryLogWriter come back out of
+records.py the same as the text LogWriter would have written them.
+'''
+
+import pytest
+
+import records
+from logwriter import LogWriter, BinaryLogWriter
+
+
+T = 1503336600.25
+
+SAMPLES = {
+    'MCP3008': [(T, [20.921038340393178]), (T + 0.2, [-3.5]), (T + 0.4, [1013.1353861192571])],
+    'CountSensor': [(T, [0, 1.0]), (T + 1, [212, 1.0003]), (T + 2, [70000, 0.9998])],
+    'GPS': [(T, ['2017-08-21T17:30:00.250Z', 0.005, 41.6611, -91.5302, 204.0, 3.2, 4.1, 9.0,
+                 0.0, 0.0, 0.0, 'n/a', 0.2, 18.0]),
+            (T + 1, ['n/a'] * 14)],
+}
+
+
+def write_both(tmp_path, kind, samples, header=None):
+    text = LogWriter(str(tmp_path / 'log.txt'), header=header, fsync=False).open()
+    binary = BinaryLogWriter(str(tmp_path / 'log.bin'), 'Sensor', kind, header=header, fsync=False).open()
+    for timestamp, fields in samples:
+        text.record(timestamp, fields)
+        binary.record(timestamp, fields)
+    text.close()
+    binary.close()
+    return str(tmp_path / 'log.txt'), str(tmp_path / 'log.bin')
+
+
+@pytest.mark.parametrize('kind', sorted(SAMPLES))
+def test_encode_decode(kind):
+    for timestamp, fields in SAMPLES[kind]:
+        packed = records.encode(kind, timestamp, fields)
+        assert len(packed) == len(records.KINDS[kind][1])
+        assert records.decode(kind, packed) == (timestamp, [str(field) if kind != 'CountSensor' else field
+                                                            for field in fields])
+
+
+@pytest.mark.parametrize('kind', sorted(SAMPLES))
+def test_decoded_file_matches_text(tmp_path, kind):
+    header = {'calibration': {'type': 'linear', 'gain': 200.0, 'offset': -250.0}}
+    text_name, binary_name = write_both(tmp_path, kind, SAMPLES[kind], header)
+
+    decoded_name = str(tmp_path / 'decoded.txt')
+    assert records.decode_file(binary_name, decoded_name) == len(SAMPLES[kind])
+    assert open(decoded_name).read() == open(text_name).read()
+
+
+def test_blocks_and_a_torn_record(tmp_path):
+    #Two starts make two blocks; a record cut short by a power cut is dropped.
+    name = str(tmp_path / 'log.bin')
+    for start in (0, 10):
+        log = BinaryLogWriter(name, 'Light', 'MCP3008', fsync=False).open()
+        log.record(T + start, [1.0])
+        log.record(T + start + 1, [2.0])
+        log.close()
+    with open(name, 'ab') as f:
+        f.write(b'\x01\x02\x03')
+
+    with open(name, 'rb') as f:
+        read = list(records.read_records(f))
+    assert [record for header, record in read] == [(T, 1.0), (T + 1, 2.0), (T + 10, 1.0), (T + 11, 2.0)]
+    assert read[0][0] is read[1][0] and read[1][0] is not read[2][0]
+    assert read[0][0]['sensor'] == 'Light'
+
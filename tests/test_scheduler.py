@@ -0,0 +1,77 @@
+'''
+The deadline scheduler, on a clock the test moves by hand.
+'''
+
+import pytest
+
+from scheduler import Scheduler
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class Interrupt(Exception):
+    pass
+
+
+def make(*periods):
+    clock = Clock()
+    schedule = Scheduler(clock=clock, sleep=clock.sleep)
+    runs = []
+    tasks = [schedule.add(str(period), lambda period=period: runs.append(period), period)
+             for period in periods]
+    return clock, schedule, runs, tasks
+
+
+def on_heap(schedule):
+    return sorted(entry[3].name for entry in schedule._heap)
+
+
+def test_runs_each_task_on_its_period():
+    clock, schedule, runs, tasks = make(0.5, 1.0)
+    for step in range(20):
+        schedule.run_pending()
+        clock.sleep(0.25)
+    assert runs.count(0.5) == 10 and runs.count(1.0) == 5
+    assert on_heap(schedule) == ['0.5', '1.0']
+
+
+def test_interrupted_batch_puts_every_task_back_once():
+    clock, schedule, runs, tasks = make(1.0, 1.0, 1.0)
+    tasks[1].action = lambda: (_ for _ in ()).throw(Interrupt())
+    with pytest.raises(Interrupt):
+        schedule.run_pending()
+    assert on_heap(schedule) == ['1.0', '1.0', '1.0']
+
+
+def test_interrupted_just_after_going_back_on_the_heap():
+    #The watchdog's signal lands after a task is pushed back, before the
+    #batch has moved on. It must still be on the heap only once.
+    clock, schedule, runs, tasks = make(1.0, 2.0)
+    push = schedule._push
+    interrupted = []
+
+    def push_then_interrupt(task):
+        push(task)
+        if task is tasks[0] and not interrupted:
+            interrupted.append(task)
+            raise Interrupt()
+    schedule._push = push_then_interrupt
+
+    with pytest.raises(Interrupt):
+        schedule.run_pending()
+    assert on_heap(schedule) == ['1.0', '2.0']
+
+    del runs[:]
+    for step in range(10):
+        clock.sleep(1.0)
+        schedule.run_pending()
+    assert runs.count(1.0) == 10 and runs.count(2.0) == 5
@@ -0,0 +1,153 @@
+'''
+The telemetry frames: what the encoder sends, the decoder gets back,
+over a lossy or noisy link and over a pseudo-terminal like the radio.
+'''
+
+import math
+from time import time, sleep
+
+import pytest
+
+import telemetry
+from telemetry import Encoder, Decoder, SerialLink, SCHEMA
+
+
+def flight(frames):
+    #A made-up climb, with the odd reading missing.
+    for i in range(frames):
+        values = {'time': 1503336600 + 5 * i, 'lat': 41.6611 + i * 1e-5, 'lon': -91.5302 - i * 2e-5,
+                  'alt': 204.0 + 25.3 * i, 'climb': 5.06, 'speed': 3.2 + math.sin(i),
+                  'Inside_temp': 21.0 - i / 50, 'Outside_temp': 15.0 - i / 3, 'Light': 2.5,
+                  'Pressure': 1013.2 - i * 1.1, 'Counts': 12.5 + i / 10}
+        if i % 17 == 5:
+            values['lat'] = values['lon'] = None
+        if i % 23 == 7:
+            values['Light'] = math.nan
+        yield values
+
+
+def check(sent, received):
+    for field, scale in SCHEMA:
+        if sent.get(field) is None or (isinstance(sent[field], float) and math.isnan(sent[field])):
+            assert field not in received
+        else:
+            assert received[field] == pytest.approx(sent[field], abs=0.5 / scale + 1e-9)
+
+
+def test_round_trip():
+    encoder, decoder = Encoder(key_every=12), Decoder()
+    sent = list(flight(300))
+    frames = [encoder.encode(values) for values in sent]
+    received = decoder.feed(b''.join(frames))
+
+    assert len(received) == len(sent)
+    for values, got, sequence in zip(sent, received, range(300)):
+        check(values, got)
+        assert got['sequence'] == sequence & 0xFF
+    assert (decoder.frames, decoder.crc_errors, decoder.lost, decoder.waiting) == (300, 0, 0, 0)
+    #Delta frames are what keeps them small.
+    assert sum(map(len, frames)) / len(frames) < 30
+
+
+def test_byte_at_a_time():
+    encoder, decoder = Encoder(), Decoder()
+    sent = list(flight(40))
+    data = b''.join(encoder.encode(values) for values in sent)
+    received = []
+    for i in range(len(data)):
+        received += decoder.feed(data[i:i + 1])
+    assert len(received) == len(sent)
+    for values, got in zip(sent, received):
+        check(values, got)
+
+
+def test_lost_frame_waits_for_the_next_key():
+    encoder, decoder = Encoder(key_every=12), Decoder()
+    sent = list(flight(30))
+    frames = [encoder.encode(values) for values in sent]
+    #Frame 3 never arrives. The delta frames after it wait for the next
+    #key frame.
+    received = decoder.feed(b''.join(frames[:3] + frames[4:]))
+    sequences = [got['sequence'] for got in received]
+
+    assert decoder.lost == 1
+    assert 3 not in sequences and 4 not in sequences
+    assert sequences[-1] == 29
+    assert decoder.waiting == len(sent) - 1 - len(received)
+    for got in received:
+        check(sent[got['sequence']], got)
+
+
+def test_damaged_frame_is_dropped():
+    encoder, decoder = Encoder(key_every=4), Decoder()
+    sent = list(flight(8))
+    frames = [bytearray(encoder.encode(values)) for values in sent]
+    frames[4][6] ^= 0x40
+    #And some noise between frames, with a stray sync in it.
+    received = decoder.feed(b'\x00\xa5\x5a\x07junk' + b''.join(frames))
+
+    assert decoder.crc_errors >= 1
+    assert [got['sequence'] for got in received] == [0, 1, 2, 3, 5, 6, 7]
+    for got in received:
+        check(sent[got['sequence']], got)
+
+
+def test_over_a_pseudo_terminal(sim):
+    device = sim.serial_port('/dev/serial0')
+    ground = sim.serial_ports['/dev/serial0']
+    link = SerialLink(device, baud=9600)
+    encoder, decoder = Encoder(), Decoder()
+    sent = list(flight(50))
+    received = []
+    try:
+        for values in sent:
+            link.send(encoder.encode(values))
+            deadline = time() + 2.0
+            while link.pump() and time() < deadline:
+                received += decoder.feed(telemetry._drain(ground))
+                sleep(0.001)
+            received += decoder.feed(telemetry._drain(ground))
+        deadline = time() + 2.0
+        while len(received) < len(sent) and time() < deadline:
+            received += decoder.feed(telemetry._drain(ground))
+            sleep(0.001)
+    finally:
+        link.close()
+
+    assert len(received) == len(sent) and link.dropped == 0
+    for values, got in zip(sent, received):
+        check(values, got)
+
+
+def test_full_radio_drops_the_oldest(sim):
+    #Nobody reads the ground end, so the port fills and the backlog with it.
+    link = SerialLink(sim.serial_port('/dev/serial0'), backlog=256)
+    encoder = Encoder()
+    try:
+        for values in flight(20000):
+            link.send(encoder.encode(values))
+            if link.dropped:
+                break
+    finally:
+        link.close()
+    assert link.dropped
+    assert link.waiting <= 256
+
+
+class Reading(object):
+    latest = None
+
+
+def test_sources():
+    gps, counter = Reading(), Reading()
+    assert telemetry.latest(gps, 'lat')() is None
+    assert telemetry.rate(counter)() is None
+
+    gps.latest = (time(), {'lat': 41.66, 'climb': 'n/a'})
+    counter.latest = (time(), [212, 1.0003])
+    assert telemetry.latest(gps, 'lat')() == 41.66
+    assert telemetry.latest(gps, 'climb')() is None
+    assert telemetry.rate(counter)() == pytest.approx(212 / 1.0003)
+
+    counter.latest = (time() - 60, [212, 1.0003])
+    assert telemetry.rate(counter, max_age=30)() is None
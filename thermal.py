@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+'''
+The heater's own control loop.
+
+The heater used to be checked once per pass of the data loop, so a pass
+held up by the camera or the GPS held up the heater too. Here it runs on
+its own thread at a fixed period, and it never reads the ADC itself: it
+takes the latest reading the data loop made of the inside temperature.
+If that reading gets too old, it stops trusting it and runs the heater
+at a fixed fail-safe duty until a fresh one comes in.
+
+The heater is driven with slow PWM: on for duty * period seconds, then
+off for the rest of the period.
+'''
+
+import threading
+from time import time, monotonic, sleep
+
+from hardware import GPIO
+from metrics import registry as metrics
+
+
+class ThermalController(object):
+    #######################################################
+    '''
+    ThermalController(pin, sensor object, period=2.0, mode='hysteresis', ...) -> controller object
+
+    --heater_pin:   The GPIO pin that switches the heater.
+    --sensor:       The inside temperature sensor. Its latest reading is
+                        used, never a fresh one.
+    --period:       Seconds per control cycle (and per PWM cycle).
+    --mode:         'hysteresis' or 'pid'.
+    --on_below:     Hysteresis: heater on at or below this temperature...
+    --off_above:    ...and off at or above this one. In between it keeps
+                        doing what it was doing.
+    --setpoint:     PID: the temperature to hold.
+    --kp, ki, kd:   PID: the gains, in duty per degree (per second).
+    --min_duty:     The least and most of each cycle the heater may be on,
+    --max_duty:         i.e. to keep it from flattening the battery.
+    --stale_after:  Seconds after which a reading is too old to use.
+    --fail_duty:    The duty to run at while there is no usable reading.
+    --deadline:     Seconds late a cycle may start before it counts as a
+                        missed deadline.
+
+    self.duty, self.temperature, self.deadline_misses and self.max_lateness
+    say how it is getting on.
+    '''
+    #######################################################
+
+    def __init__(self, heater_pin, sensor, period=2.0, mode='hysteresis',
+                 on_below=21.0, off_above=25.0, setpoint=23.0, kp=0.2, ki=0.005, kd=0.0,
+                 min_duty=0.0, max_duty=1.0, stale_after=10.0, fail_duty=0.5, deadline=0.1):
+        if mode not in ('hysteresis', 'pid'):
+            raise ValueError('mode must be hysteresis or pid, not ' + repr(mode))
+        if not 0 <= min_duty <= max_duty <= 1:
+            raise ValueError('duty limits must have 0 <= min_duty <= max_duty <= 1')
+
+        self.heater_pin = heater_pin
+        self.sensor = sensor
+        self.period = period
+        self.mode = mode
+        self.on_below = on_below
+        self.off_above = off_above
+        self.setpoint = setpoint
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.min_duty = min_duty
+        self.max_duty = max_duty
+        self.stale_after = stale_after
+        self.fail_duty = fail_duty
+        self.deadline = deadline
+
+        self.duty = 0.0
+        self.temperature = None
+        self.cycles = 0
+        self.deadline_misses = 0
+        self.max_lateness = 0.0
+        self.stale = False
+        self._heating = False
+        self._integral = 0.0
+        self._last_temperature = None
+        self._running = False
+        self._thread = None
+
+
+    def _clamp(self, duty):
+        return min(max(duty, self.min_duty), self.max_duty)
+
+
+    def _hysteresis(self, temperature):
+        if temperature <= self.on_below:
+            self._heating = True
+        elif temperature >= self.off_above:
+            self._heating = False
+
+        return self.max_duty if self._heating else self.min_duty
+
+
+    def _pid(self, temperature):
+        error = self.setpoint - temperature
+
+        #Derivative on the measurement, so a setpoint change does not kick.
+        derivative = 0.0
+        if self._last_temperature is not None:
+            derivative = -(temperature - self._last_temperature) / self.period
+        self._last_temperature = temperature
+
+        #Stop integrating while the output is pinned at a limit (anti-windup),
+        #unless the error would pull it back off the limit.
+        duty = self.kp * error + self.ki * self._integral + self.kd * derivative
+        if (duty < self.max_duty or error < 0) and (duty > self.min_duty or error > 0):
+            self._integral += error * self.period
+
+        return self._clamp(self.kp * error + self.ki * self._integral + self.kd * derivative)
+
+
+    def update(self):
+        #----------------------------------------
+        '''
+        update() -> float
+
+        Works out this cycle's duty from the latest reading.
+        '''
+        #----------------------------------------
+
+        latest = getattr(self.sensor, 'latest', None)
+        if latest is None or time() - latest[0] > self.stale_after:
+            if not self.stale:
+                print('The heater has no recent temperature. Running at', self.fail_duty)
+            self.stale = True
+            self.duty = self._clamp(self.fail_duty)
+            return self.duty
+
+        if self.stale:
+            print('The heater has a temperature again.')
+        self.stale = False
+        self.temperature = latest[1]
+
+        was_heating = self.duty > 0
+        if self.mode == 'pid':
+            self.duty = self._pid(self.temperature)
+        else:
+            self.duty = self._hysteresis(self.temperature)
+        if (self.duty > 0) != was_heating:
+            print('Heater is on.' if self.duty > 0 else 'Heater is off.')
+
+        return self.duty
+
+
+    def _run(self):
+        #----------------------------------------
+        '''
+        _run()
+
+        The control thread. Each cycle is due at a fixed rate; one that
+        starts more than self.deadline late is counted as a miss.
+        '''
+        #----------------------------------------
+
+        due = monotonic()
+        while self._running:
+            lateness = monotonic() - due
+            self.max_lateness = max(self.max_lateness, lateness)
+            metrics.time('Heater.lateness', lateness)
+            if lateness > self.deadline:
+                self.deadline_misses += 1
+                metrics.count('Heater.deadline_misses')
+
+            duty = self.update()
+            self.cycles += 1
+
+            #On for the first part of the cycle, off for the rest.
+            on_time = duty * self.period
+            if on_time > 0:
+                GPIO.output(self.heater_pin, True)
+                sleep(on_time)
+            if duty < 1:
+                GPIO.output(self.heater_pin, False)
+
+            due += self.period
+            now = monotonic()
+            if due < now:
+                due = now
+            sleep(due - now)
+
+
+    def start(self):
+        GPIO.setup(self.heater_pin, GPIO.OUT)
+        GPIO.output(self.heater_pin, False)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='Heater', daemon=True)
+        self._thread.start()
+        print('Heater control has started.')
+
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        GPIO.output(self.heater_pin, False)
+        print('Heater control has finished.')
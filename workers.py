@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+'''
+Runs the sensors in worker processes of their own.
+
+In one process, bit-banging the ADC, parsing gpsd's JSON, running the
+camera and printing to the console all take turns with the GIL. With
+--runtime process, each group of sensors is sampled by its own worker
+process instead: every MCP3008 on one chip is a group (they share the
+chip), and every other sensor that can be sampled is a group of one.
+The camera, which is mostly waiting on picamera anyway, stays behind.
+
+A worker puts its samples in a ring buffer in shared memory. The main
+process drains the rings and writes the data files, so the logging, the
+journal, the storage governor and the heater all work as they do in the
+other runtimes.
+
+A worker that dies is started again, after 1, 2, 4 ... up to 60 seconds,
+rather than its sensors being dropped for the rest of the flight.
+
+Workers are forked, so this needs Linux (the Pi is fine). Timing metrics
+from inside a worker stay in the worker.
+'''
+
+import multiprocessing
+import signal
+from multiprocessing import shared_memory
+from time import time
+
+import numpy as np
+
+import records
+from metrics import registry as metrics
+from scheduler import Scheduler
+
+
+#Room in a slot for the widest record (GPS: the time and 14 fields).
+WIDTH = max(len(names) for format, names in records.KINDS.values())
+
+
+class SampleRing(object):
+    #######################################################
+    '''
+    SampleRing(slots=4096) -> ring object
+
+    A ring of fixed-size slots in shared memory, written by one process
+    (put()) and read by another (drain()). When the reader falls a whole
+    ring behind, the oldest samples are overwritten and counted as lost.
+
+    Each slot holds a sequence number, which sensor of the group the
+    sample is from, and the encoded record (see records.encode()). The
+    sequence number is written last, so the reader can tell a slot that
+    is only half written.
+    '''
+    #######################################################
+
+    SLOT = np.dtype([('sequence', np.uint64), ('sensor', np.uint64), ('data', np.float64, (WIDTH,))])
+
+    def __init__(self, slots=4096):
+        self.slots = slots
+        self.memory = shared_memory.SharedMemory(create=True, size=8 + slots * self.SLOT.itemsize)
+        self._written = np.ndarray((1,), np.uint64, buffer=self.memory.buf)
+        self._ring = np.ndarray((slots,), self.SLOT, buffer=self.memory.buf, offset=8)
+        self._written[0] = 0
+        self._ring['sequence'] = 0
+        self.read = 0
+        self.lost = 0
+
+
+    def put(self, sensor, record):
+        #----------------------------------------
+        '''
+        put(int, tuple)
+
+        Adds an encoded record from the group's sensor number sensor.
+        '''
+        #----------------------------------------
+
+        n = int(self._written[0])
+        i = n % self.slots
+        self._ring['sequence'][i] = 0
+        self._ring['sensor'][i] = sensor
+        self._ring['data'][i, :len(record)] = record
+        self._ring['sequence'][i] = n + 1
+        self._written[0] = n + 1
+
+
+    def drain(self):
+        #----------------------------------------
+        '''
+        drain() -> array of slots
+
+        Everything written since the last drain(), oldest first.
+        '''
+        #----------------------------------------
+
+        written = int(self._written[0])
+        if written - self.read > self.slots:
+            self.lost += written - self.read - self.slots
+            self.read = written - self.slots
+        if written == self.read:
+            return self._ring[:0]
+
+        numbers = np.arange(self.read, written, dtype=np.uint64)
+        taken = self._ring[numbers % self.slots]
+        #A slot overwritten (or still being written) while it was copied
+        #has the wrong sequence number.
+        good = taken['sequence'] == numbers + 1
+        self.lost += int(len(taken) - good.sum())
+        self.read = written
+
+        return taken[good]
+
+
+    def close(self):
+        self.memory.close()
+        self.memory.unlink()
+
+
+def _work(ring, sensors, stop):
+    #----------------------------------------
+    '''
+    _work(SampleRing, list of sensors, Event)
+
+    The worker process: starts its sensors and samples each on its own
+    period into the ring until told to stop.
+    '''
+    #----------------------------------------
+
+    #Ctrl-C goes to every process. The main process does the stopping.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    #Imported here, after the fork, so MCP3008Bus is this process's copy.
+    from fl_objects_2 import MCP3008Bus
+
+    for sensor in sensors:
+        sensor.logging = False
+        sensor.start()
+
+    schedule = Scheduler()
+    owners = {}
+    for number, sensor in enumerate(sensors):
+        def sample(number=number, sensor=sensor):
+            ring.put(number, records.encode(sensor.record_kind, *sensor.sample()))
+        owners[schedule.add(sensor.name, sample, sensor.period, sensor.priority)] = sensor
+    schedule.before_each(lambda due: MCP3008Bus.scan_due([owners[task] for task in due]))
+
+    try:
+        schedule.run(lambda: not stop.is_set())
+    finally:
+        for sensor in sensors:
+            try:
+                sensor.stop()
+            except Exception:
+                print(sensor.name, 'failed while stopping.')
+
+
+class Worker(object):
+    #######################################################
+    '''
+    Worker(list of sensors, context, Event) -> worker object
+
+    One group of sensors, the process sampling them and their ring.
+    '''
+    #######################################################
+
+    def __init__(self, sensors, context, stop):
+        self.sensors = sensors
+        self.name = '+'.join(sensor.name for sensor in sensors)
+        self.ring = SampleRing()
+        self.context = context
+        self.stop = stop
+        self.process = None
+        self.failures = 0
+        self.restarts = 0
+        self.restart_at = None
+        self.started = None
+
+
+    def start(self):
+        self.process = self.context.Process(target=_work, args=(self.ring, self.sensors, self.stop),
+                                            name=self.name, daemon=True)
+        self.process.start()
+        self.started = time()
+
+
+class WorkerPool(object):
+    #######################################################
+    '''
+    WorkerPool(list of sensors) -> pool object
+
+    Splits the sensors into groups for the workers. self.local is the
+    list of sensors left for the main process to run as usual.
+
+    --start():      Opens the data files and starts the workers.
+    --drain():      Writes out everything the workers have sampled. Call
+                        it often (every 0.1 s or so).
+    --supervise():  Starts any worker that has died again, once its
+                        backoff is up. Call it every second or so.
+    --stop():       Stops the workers, writes out the rest and closes the
+                        data files.
+    '''
+    #######################################################
+
+    def __init__(self, sensors):
+        self.context = multiprocessing.get_context('fork')
+        self._stop = self.context.Event()
+        self.local = []
+
+        groups = {}
+        for sensor in sensors:
+            if sensor.record_kind is None or not hasattr(sensor, 'sample'):
+                self.local.append(sensor)
+            else:
+                #Sensors on one ADC chip share its worker.
+                groups.setdefault(id(getattr(sensor, 'bus', sensor)), []).append(sensor)
+        self.workers = [Worker(group, self.context, self._stop) for group in groups.values()]
+
+
+    def start(self):
+        for worker in self.workers:
+            for sensor in worker.sensors:
+                sensor._open_log()
+            worker.start()
+            print(worker.name, 'has started in process', worker.process.pid)
+
+
+    def drain(self):
+        for worker in self.workers:
+            for slot in worker.ring.drain():
+                sensor = worker.sensors[int(slot['sensor'])]
+                size = len(records.KINDS[sensor.record_kind][1])
+                timestamp, fields = records.decode(sensor.record_kind, slot['data'][:size].tolist())
+                #The heater and the telemetry go by these.
+                sensor._cache(timestamp, fields)
+                if sensor._keep():
+                    sensor.log.record(timestamp, fields)
+            if worker.ring.lost:
+                metrics.count(worker.name + '.evictions', worker.ring.lost)
+                worker.ring.lost = 0
+
+
+    def supervise(self):
+        now = time()
+        for worker in self.workers:
+            if worker.process.is_alive():
+                #A minute without dying wipes the slate clean.
+                if worker.failures and now - worker.started > 60:
+                    worker.failures = 0
+                continue
+
+            if worker.restart_at is None:
+                worker.failures += 1
+                wait = min(2 ** (worker.failures - 1), 60)
+                worker.restart_at = now + wait
+                metrics.count(worker.name + '.errors')
+                print(worker.name, 'died (exit code %s). Restarting in %d s.' % (worker.process.exitcode, wait))
+            elif now >= worker.restart_at:
+                worker.restart_at = None
+                worker.restarts += 1
+                metrics.count(worker.name + '.restarts')
+                worker.start()
+                print(worker.name, 'has restarted in process', worker.process.pid)
+
+
+    def stop(self):
+        self._stop.set()
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(5)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+                    worker.process.join()
+        self.drain()
+        for worker in self.workers:
+            for sensor in worker.sensors:
+                sensor._close_log()
+            worker.ring.close()
+            print(worker.name, 'has finished.')